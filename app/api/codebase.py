@@ -6,7 +6,7 @@ from typing import Dict, Any
 
 from app.db.codebase import get_executive_summary_from_db, get_project_diagrams_from_db
 from app.db.codebase import get_files_list, get_file_summary
-from app.db.connections import get_vector_db_connection
+from app.db.connections import vector_db_connection
 from app.utils.path_utils import decode_path, encode_path
 
 router = APIRouter()
@@ -80,13 +80,27 @@ async def get_project_files_with_details(project_id: str):
             if cached["expires_at"] is None or cached["expires_at"] > now:
                 return cached["data"]
 
-        conn = None
         try:
-            conn = await get_vector_db_connection()
-
-            # Step 1: Check if embeddings exist
-            count_query = "SELECT COUNT(*) FROM embeddings WHERE project_id = $1"
-            embeddings_count = await conn.fetchval(count_query, project_id)
+            async with vector_db_connection() as conn:
+                # Step 1: Check if embeddings exist
+                count_query = "SELECT COUNT(*) FROM embeddings WHERE project_id = $1"
+                embeddings_count = await conn.fetchval(count_query, project_id)
+
+                records = []
+                if embeddings_count:
+                    # Step 2: Fetch latest version of each file
+                    files_query = """
+                        SELECT DISTINCT ON (file_path)
+                            file_path,
+                            file_name,
+                            summary,
+                            content
+                        FROM embeddings
+                        WHERE project_id = $1
+                        ORDER BY file_path ASC, created_at DESC
+                    """
+
+                    records = await conn.fetch(files_query, project_id)
 
             if embeddings_count == 0:
                 result = {
@@ -94,20 +108,6 @@ async def get_project_files_with_details(project_id: str):
                     "files": []
                 }
             else:
-                # Step 2: Fetch latest version of each file
-                files_query = """
-                    SELECT DISTINCT ON (file_path)
-                        file_path,
-                        file_name,
-                        summary,
-                        content
-                    FROM embeddings
-                    WHERE project_id = $1
-                    ORDER BY file_path ASC, created_at DESC
-                """
-
-                records = await conn.fetch(files_query, project_id)
-
                 files = []
                 for record in records:
                     file_path = record.get("file_path") or ""
@@ -167,7 +167,3 @@ async def get_project_files_with_details(project_id: str):
                 "project_id": project_id,
                 "files": []
             }
-
-        finally:
-            if conn:
-                await conn.close()
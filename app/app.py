@@ -5,9 +5,11 @@ There are redundant function definitions throughout the api routes, its done to
 The idea is that at one point we can turn the api into microservices architecture without introducing complex interdependencies.
 Along the same lines, Im trying out a architecture where the code block become self contained since its mostly by AI 
 """
+import asyncio
 import json
+import os
+from contextlib import asynccontextmanager
 
-import tiktoken
 from dotenv import load_dotenv
 from fastapi import (
     FastAPI, HTTPException, Security, Depends,
@@ -15,11 +17,21 @@ from fastapi import (
 )
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security.api_key import APIKeyHeader
+from starlette.websockets import WebSocketState
 
 import app.core.chat.chat_pro as chat_pro
-from app.constants import TOKEN_LIMIT, API_KEY, API_KEY_NAME
+from app.constants import API_KEY, API_KEY_NAME
 from app.api import codebase
-from app.db.codebase import get_summary_from_db
+from app.core.embeddings.embedding_cache import prune_shared_cache_periodically
+from app.db.chat import get_conversation_history_from_db
+from app.db.codebase import get_chat_summary_from_db
+from app.db.connections import init_db_pools, close_db_pools, check_db_pools
+from app.db.notifications import start_project_listener, stop_project_listener
+from app.db.schema import bootstrap_schema, bootstrap_vector_schema
+from app.db.write_behind import WRITE_BEHIND
+from app.utils import background, metrics
+from app.utils.disconnect import run_until_disconnect
+from app.utils.stream_coalescer import StreamCoalescer
 
 load_dotenv()
 
@@ -34,7 +46,25 @@ async def get_api_key(api_key_header: str = Security(api_key_header)):
             detail="Invalid or missing API Key",
         )
 
-combined_app = FastAPI()
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # Database pools live for the whole worker process and are shared by every route
+    await init_db_pools()
+    try:
+        await bootstrap_schema()
+        await bootstrap_vector_schema()
+        await WRITE_BEHIND.start()
+        await start_project_listener()
+        background.spawn(prune_shared_cache_periodically(), name="embedding_cache.prune")
+        yield
+    finally:
+        await stop_project_listener()
+        await background.shutdown()
+        # Flush queued writes while the pools are still open
+        await WRITE_BEHIND.stop()
+        await close_db_pools()
+
+combined_app = FastAPI(lifespan=lifespan)
 combined_app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Or specify allowed frontend origins
@@ -52,6 +82,19 @@ app.add_middleware(
 app.include_router(codebase.router, tags=["Codebase"])
 
 
+@combined_app.get("/health", description="Liveness and database pool health of this worker.")
+async def health():
+    pools = await check_db_pools()
+    healthy = all(p.get("status") == "ok" for p in pools.values())
+    if not healthy:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail={"db": pools})
+    return {"status": "ok", "db": pools}
+
+@app.get("/metrics", description="In-process counters, gauges and timings of this worker.")
+async def get_metrics():
+    return metrics.snapshot()
+
+
 #$~ Websocket 1 ~$############################################################################################################################
 #$~ Description ~$#
 """
@@ -86,33 +129,35 @@ async def chat_pro_version (websocket: WebSocket):
         else:
             uploaded_files = []
 
-        async def on_stream(content_chunk: str):
-            await websocket.send_text(content_chunk)
-
-        # Fetch summary from PostgreSQL
-        summary_content = await get_summary_from_db(email, project_id)
+        # Fetch summary from PostgreSQL, already cut to the chat prompt's budget when it was stored,
+        # together with the conversation history chat needs
+        summary_content, conversation_messages = await asyncio.gather(
+            get_chat_summary_from_db(email, project_id),
+            get_conversation_history_from_db(email, project_id),
+        )
         if not summary_content:
             raise HTTPException(status_code=404, detail="Summary not found")
-        
-        enc = tiktoken.encoding_for_model("gpt-4")  # Modify as needed for Anthropic
-        tokens = enc.encode(summary_content)
-        token_count = len(tokens)
-        if token_count > TOKEN_LIMIT:
-            truncated_tokens = tokens[:TOKEN_LIMIT]
-            summary_content = enc.decode(truncated_tokens)
 
 
     except Exception as e:
         await websocket.send_text(f"[ERROR] Failed to read summary: {str(e)}")
+    async def answer():
+        # Deltas are batched into frames by size and age instead of one frame each
+        async with StreamCoalescer(websocket.send_text) as stream:
+            await chat_pro.chat(email, project_id, summary_content, user_question, checklistAssistant, uploaded_files, stream.write,
+                                conversation_messages)
+
     try:
-        await chat_pro.chat(email, project_id, summary_content, user_question, checklistAssistant, uploaded_files, on_stream)
+        # A closed tab cancels the turn, including the OpenAI stream and pending searches
+        await run_until_disconnect(websocket, answer(), name="chat")
 
     except WebSocketDisconnect:
         print("WebSocket disconnected.")
     except Exception as e:
         await websocket.send_text(f"[ERROR] {str(e)}")
     finally:
-        await websocket.close()
+        if websocket.client_state != WebSocketState.DISCONNECTED:
+            await websocket.close()
 
 ############################################################################################################################
 
@@ -120,4 +165,6 @@ combined_app.mount("/", app)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(combined_app, host="0.0.0.0", port=8000)
+    # Same variable the uvicorn CLI reads for --ws-per-message-deflate, see the Dockerfile
+    ws_per_message_deflate = os.getenv("UVICORN_WS_PER_MESSAGE_DEFLATE", "true").lower() == "true"
+    uvicorn.run(combined_app, host="0.0.0.0", port=8000, ws_per_message_deflate=ws_per_message_deflate)
@@ -1,164 +1,189 @@
 import os
-import json
 import re
-import asyncio
 import time
 from app.constants import OPEN_AI_CLIENT
-from app.core.codebase.truncator import open_ai_truncator
 from app.core.embeddings.query_embeddings import query_vectorDB
 from app.core.misc.checklist import create_checklist
-from app.db.chat import get_conversation_history_from_db
-from app.utils.chat_utils import store_chat_in_db, summarize_early_exchanges
-
-async def chat(email_id: str, project_id: str, summary: str, user_question: str, checklistAssistant: bool, uploaded_files: list, on_stream: callable) -> str:
+from app.core.chat.stages import StageScheduler
+from app.core.chat.tool_engine import ToolEngine
+from app.db.chat import get_conversation_history_from_db, get_rolling_summary_from_db
+from app.utils import background, metrics
+from app.utils.chat_utils import store_chat_in_db, update_rolling_summary
+
+# Retrieved chunks are packed into this many tokens per search instead of truncating the joined text
+RETRIEVAL_TOKEN_BUDGET = 20000
+# The retrieval started on the raw question is kept when this share of the generated query's
+# terms already appears in the question
+SPECULATIVE_OVERLAP_THRESHOLD = float(os.getenv("SPECULATIVE_OVERLAP_THRESHOLD", 0.6))
+_OVERLAP_STOP_WORDS = {
+    "the", "and", "for", "with", "that", "this", "from", "what", "how", "does", "are",
+    "code", "codebase", "find", "show", "explain", "about", "where", "which", "all", "any", "used",
+}
+
+def _terms(text: str) -> set[str]:
+    return {word for word in re.findall(r"[a-z0-9_]{3,}", (text or "").lower()) if word not in _OVERLAP_STOP_WORDS}
+
+def query_overlap(generated_query: str, user_question: str) -> float:
+    """Share of the generated query's terms that already appear in the user's question."""
+    generated = _terms(generated_query)
+    if not generated:
+        return 0.0
+    return len(generated & _terms(user_question)) / len(generated)
+
+async def _generate_rag_query(query_prompt: list[dict]) -> str:
+    query_response = await OPEN_AI_CLIENT.chat.completions.create(
+        model="gpt-4.1-nano",
+        messages=query_prompt,
+        max_tokens=500,
+        temperature=0.1
+    )
+    return query_response.choices[0].message.content
+
+async def chat(email_id: str, project_id: str, summary: str, user_question: str, checklistAssistant: bool, uploaded_files: list, on_stream: callable,
+               conversation_messages: list | None = None) -> str:
     try:
-        t0 = time.monotonic()
-
-        # Parallelize all async calls
-        conversation_task = get_conversation_history_from_db(email_id, project_id)
-        summary_task = open_ai_truncator(text=summary, max_tokens=10000, model="gpt-4.1-mini")
-        conversation_messages, summary = await asyncio.gather(conversation_task, summary_task)
-
-        system_message = [
-            {"role": "system", "content": "You are a senior software architect expert in code analysis."},
-            {"role": "system", "content": f"Codebase summary: {summary}"},
-            {"role": "system", "content": "Checklist = call CHECKLIST_ASSISTANT. Missing code = call Querycodebase."}
-        ]
-        t1 = time.monotonic()
-
-        api_messages = []
-        if conversation_messages:
-            early_summary_task = summarize_early_exchanges(conversation_messages[:-2])
-            last_msgs = [{"role": "user" if i % 2 == 0 else "assistant", "content": msg["content"]}
-                         for i, msg in enumerate(conversation_messages[-2:])]
-            api_messages.extend(last_msgs)
-            early_summary = await early_summary_task
-            if early_summary:
-                system_message.append({"role": "system", "content": f"Earlier summary: {early_summary}"})
-        api_messages.append({"role": "user", "content": user_question})
-
-        # Step 1: Generate a ChromaDB search query
-        query_prompt = system_message + api_messages + [
-            {"role": "system", "content": "Generate a vector search query to retrieve code snippets or documents."}
-        ]
-        query_response = await OPEN_AI_CLIENT.chat.completions.create(
-            model="gpt-4.1-nano",
-            messages=query_prompt,
-            max_tokens=500,
-            temperature=0.1
-        )
-        t2 = time.monotonic()
-        rag_query = query_response.choices[0].message.content
-
-        # Step 2: Query DB and format result
-        db_result = await query_vectorDB(project_id, rag_query)
-        retrieved_context = await open_ai_truncator(text=db_result, max_tokens=20000, model="gpt-4.1-mini")
-
-        t3 = time.monotonic()
+        async with StageScheduler() as stages:
+            await _chat(stages, email_id, project_id, summary, user_question, checklistAssistant, uploaded_files, on_stream, conversation_messages)
+    except Exception as e:
+        await on_stream(f"[ERROR] {str(e)}")
+
+async def _chat(stages: StageScheduler, email_id: str, project_id: str, summary: str, user_question: str, checklistAssistant: bool,
+                uploaded_files: list, on_stream: callable, conversation_messages: list | None):
+    t0 = time.monotonic()
+
+    # Retrieval on the raw question starts right away; it is used if the generated query turns out
+    # to ask for the same thing
+    stages.start("speculative_retrieval", query_vectorDB(project_id, user_question, token_budget=RETRIEVAL_TOKEN_BUDGET))
+
+    # summary is the stored 10k-token chat variant, see app.db.summary_repository. The websocket
+    # prefetches the history together with it
+    if conversation_messages is None:
+        conversation_messages = await get_conversation_history_from_db(email_id, project_id)
+
+    system_message = [
+        {"role": "system", "content": "You are a senior software architect expert in code analysis."},
+        {"role": "system", "content": f"Codebase summary: {summary}"},
+        {"role": "system", "content": "Checklist = call CHECKLIST_ASSISTANT. Missing code = call Querycodebase."}
+    ]
+    t1 = time.monotonic()
+
+    api_messages = []
+    if conversation_messages:
+        # Kept up to date in the background after each turn, see update_rolling_summary
+        stages.start("rolling_summary", get_rolling_summary_from_db(email_id, project_id))
+        last_msgs = [{"role": "user" if i % 2 == 0 else "assistant", "content": msg["content"]}
+                     for i, msg in enumerate(conversation_messages[-2:])]
+        api_messages.extend(last_msgs)
+    api_messages.append({"role": "user", "content": user_question})
+
+    # Step 1: Generate a ChromaDB search query, concurrently with reading the rolling summary; the
+    # query sees the last exchange but not the summary of older ones
+    query_prompt = system_message + api_messages + [
+        {"role": "system", "content": "Generate a vector search query to retrieve code snippets or documents."}
+    ]
+    stages.start("query_generation", _generate_rag_query(query_prompt))
+    rag_query = await stages.result("query_generation")
+    t2 = time.monotonic()
+
+    # Step 2: Query DB and format result, reusing the speculative search when the queries overlap
+    search_query = rag_query
+    db_result = None
+    if query_overlap(rag_query, user_question) >= SPECULATIVE_OVERLAP_THRESHOLD:
+        try:
+            db_result = await stages.result("speculative_retrieval")
+            search_query = user_question
+            metrics.incr("chat.speculative_retrieval.kept")
+        except Exception as e:
+            print(f"An error occurred during speculative retrieval: {e}")
+    if db_result is None:
+        # Cancels the search and its embedding request, unless another turn waits on the same query
+        stages.discard("speculative_retrieval")
+        metrics.incr("chat.speculative_retrieval.discarded")
+        db_result = await query_vectorDB(project_id, rag_query, token_budget=RETRIEVAL_TOKEN_BUDGET)
+    retrieved_context = db_result
+
+    if conversation_messages:
+        early_summary, _ = await stages.result("rolling_summary")
+        if early_summary:
+            system_message.append({"role": "system", "content": f"Earlier summary: {early_summary}"})
+
+    t3 = time.monotonic()
+    system_message.extend([
+        {"role": "system", "content": f"Search query: {search_query}"},
+        {"role": "system", "content": f"Retrieved codebase info: {retrieved_context}"},
+        {"role": "system", "content": f"Original User question: {user_question}"}
+    ])
+
+    if uploaded_files:
         system_message.extend([
-            {"role": "system", "content": f"Search query: {rag_query}"},
-            {"role": "system", "content": f"Retrieved codebase info: {retrieved_context}"},
-            {"role": "system", "content": f"Original User question: {user_question}"}
+            {"role": "system", "content": f"""The user has also uploaded one or more files. 
+            Here are the names and summaries of the files (Each object contains a fileName and fileSummary):
+            {uploaded_files}
+            """},
         ])
 
-        if uploaded_files:
-            system_message.extend([
-                {"role": "system", "content": f"""The user has also uploaded one or more files. 
-                Here are the names and summaries of the files (Each object contains a fileName and fileSummary):
-                {uploaded_files}
-                """},
-            ])
-
-        final_prompt = system_message + api_messages + [
-            {"role": "system", "content": """
-                Analyze all context and provide a precise, implementation-ready answer to the question.
-                If explaining multiple items (components, files, functions, etc.):
-                - List each explicitly in a structured format (numbered list or table)
-                - Explain purpose, functionality, dependencies, and key implementation details of each
-                - Don’t skip or merge items, even minor ones
-                - Include examples, configs, code-snippets, relationships, and usage considerations where relevant
-                Make the answer exhaustive and developer-friendly.
-            """},
-        ]
-
-        if "No relevant codebase content found" in db_result:
-            final_prompt.append({"role": "user", "content": f"Call Querycodebase with query: {rag_query}."})
-
-        tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "Querycodebase",
-                    "description": "Run a code-level search using a specific query.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "Query": {"type": "string", "description": "The query to run."}
-                        },
-                        "required": ["Query"]
-                    }
-                }
-            }
-        ]
-
-        t4 = time.monotonic()
-        # Step 3: Tool interaction loop
-        while True:
-            model_response = await OPEN_AI_CLIENT.chat.completions.create(
-                model="gpt-4.1-nano",
-                messages=final_prompt,
-                max_tokens=2000,
-                tool_choice="auto",
-                tools=tools
-            )
-            finish_reason = model_response.choices[0].finish_reason
-
-            if finish_reason == "tool_calls":
-                for tool_call in model_response.choices[0].message.tool_calls:
-                    tool_name = tool_call.function.name
-                    tool_args = json.loads(tool_call.function.arguments)
-
-                    if tool_name == "Querycodebase":
-                        query = tool_args.get("Query", "")
-                        tool_result = await query_vectorDB(project_id, query)
-                        formatted_result = await open_ai_truncator(tool_result, max_tokens=20000, model="gpt-4.1-mini")
-                        final_prompt.append({"role": "user", "content": formatted_result})
-            else:
-                break
-
-        t5 = time.monotonic()
-        print(f"Initial setup time: {t1 - t0:.2f} sec")
-        print(f"Early summary and query generation time: {t2 - t1:.2f} sec")
-        print(f"ChromaDB search time: {t3 - t2:.2f} sec")
-        print(f"Variables time: {t4 - t3:.2f} sec")
-        print(f"Tools run time: {t5 - t4:.2f} sec")
-        print(f"Total time: {t5 - t0:.2f} sec")
-
-        raw_response_full = ""
-        checklist_title = ""
-        if not checklistAssistant:
-            final_response_stream = await OPEN_AI_CLIENT.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=final_prompt,
-                max_tokens=10000,
-                stream=True
-            )
+    final_prompt = system_message + api_messages + [
+        {"role": "system", "content": """
+            Analyze all context and provide a precise, implementation-ready answer to the question.
+            If explaining multiple items (components, files, functions, etc.):
+            - List each explicitly in a structured format (numbered list or table)
+            - Explain purpose, functionality, dependencies, and key implementation details of each
+            - Don’t skip or merge items, even minor ones
+            - Include examples, configs, code-snippets, relationships, and usage considerations where relevant
+            Make the answer exhaustive and developer-friendly.
+        """},
+    ]
+
+    if "No relevant codebase content found" in db_result:
+        # The same query would only be deduped by the tool engine, ask for another one
+        final_prompt.append({"role": "user", "content": f"The search for \"{search_query}\" found nothing. "
+                             "Call Querycodebase with a different query, e.g. specific file, function or class names."})
+
+    t4 = time.monotonic()
+    # Step 3: Tool interaction loop, bounded in iterations and in retrieved tokens
+    tool_engine = ToolEngine(project_id, token_budget=RETRIEVAL_TOKEN_BUDGET)
+    tool_engine.mark_searched(search_query)
+    await tool_engine.run(final_prompt)
+
+    t5 = time.monotonic()
+    print(f"Initial setup time: {t1 - t0:.2f} sec")
+    print(f"Early summary and query generation time: {t2 - t1:.2f} sec")
+    print(f"ChromaDB search time: {t3 - t2:.2f} sec")
+    print(f"Variables time: {t4 - t3:.2f} sec")
+    print(f"Tools run time: {t5 - t4:.2f} sec")
+    print(f"Total time: {t5 - t0:.2f} sec")
+
+    raw_response_full = ""
+    checklist_title = ""
+    if not checklistAssistant:
+        final_response_stream = await OPEN_AI_CLIENT.chat.completions.create(
+            model="gpt-4.1-mini",
+            messages=final_prompt,
+            max_tokens=10000,
+            stream=True
+        )
 
+        try:
             async for chunk in final_response_stream:
                 delta = chunk.choices[0].delta
                 content = delta.content
                 if content:
                     raw_response_full += content
                     await on_stream(content)
-
-        else:
-            checklist = await create_checklist(project_id, user_question)
-            checklist_title = checklist.get("title")
-            res = f"Checklist created: {checklist_title}. The checklist will appear in the 'Task Checklist' section after some time. If not, please refresh the page to view it."
-            for content in res:
-                await on_stream(content)
-
-        asyncio.create_task(store_chat_in_db(email_id, project_id, user_question, raw_response_full, checklist_title, checklistAssistant))
-
-    except Exception as e:
-        await on_stream(f"[ERROR] {str(e)}")
\ No newline at end of file
+        finally:
+            # Closes the HTTP response right away when the turn is cancelled mid-answer
+            await final_response_stream.close()
+
+    else:
+        checklist = await create_checklist(project_id, user_question)
+        checklist_title = checklist.get("title")
+        res = f"Checklist created: {checklist_title}. The checklist will appear in the 'Task Checklist' section after some time. If not, please refresh the page to view it."
+        await on_stream(res)
+
+    # Queued for the write-behind batcher, this only waits when the queue is full
+    await store_chat_in_db(email_id, project_id, user_question, raw_response_full, checklist_title, checklistAssistant)
+
+    # The previous exchange leaves the verbatim window with this turn, fold it into the summary
+    if conversation_messages:
+        background.spawn(update_rolling_summary(email_id, project_id, conversation_messages[-1]["id"]),
+                         name="chat.rolling_summary")
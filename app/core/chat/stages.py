@@ -0,0 +1,61 @@
+"""
+Stage scheduler for the chat pipeline. Stages that do not depend on each other are started
+together and awaited where their result is first needed; every stage's wall time is reported
+as chat.stage.<name>. Leaving the scheduler cancels stages nobody awaited, e.g. a speculative
+retrieval that lost, or everything when the turn fails.
+"""
+import asyncio
+import time
+from typing import Any, Coroutine
+
+from app.utils import metrics
+
+
+class StageScheduler:
+    def __init__(self):
+        self._tasks: dict[str, asyncio.Task] = {}
+        self.timings: dict[str, float] = {}
+
+    async def __aenter__(self) -> "StageScheduler":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.cancel_pending()
+
+    def start(self, name: str, coro: Coroutine) -> asyncio.Task:
+        """Run coro as stage `name` from now on."""
+        async def timed():
+            started = time.monotonic()
+            try:
+                return await coro
+            finally:
+                self.timings[name] = time.monotonic() - started
+                metrics.observe(f"chat.stage.{name}", self.timings[name])
+
+        task = asyncio.create_task(timed(), name=f"chat.{name}")
+        self._tasks[name] = task
+        return task
+
+    async def result(self, name: str) -> Any:
+        return await self._tasks[name]
+
+    def discard(self, name: str):
+        """Give up on a stage; it is cancelled if still running."""
+        task = self._tasks.pop(name, None)
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+            metrics.incr(f"chat.stage.{name}.cancelled")
+        elif not task.cancelled():
+            task.exception()
+
+    async def cancel_pending(self):
+        pending = [task for task in self._tasks.values() if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        # Retrieve exceptions of finished stages nobody awaited so asyncio does not log them
+        for task in self._tasks.values():
+            if task.done() and not task.cancelled():
+                task.exception()
@@ -0,0 +1,160 @@
+"""
+Tool loop for the chat pipeline. All tool calls of one model response run concurrently, calls of
+the same tool as one batch (Querycodebase searches share one embeddings request and one SQL
+query). A query already answered earlier in the turn is not searched again. Results go back as
+`tool` messages tied to their call ids, and the loop stops after MAX_TOOL_ITERATIONS model
+responses or once the results would exceed MAX_TOOL_CONTEXT_TOKENS.
+"""
+import asyncio
+import json
+import os
+import re
+import time
+
+from app.constants import OPEN_AI_CLIENT
+from app.core.codebase.tokenization import count_tokens, truncate
+from app.core.embeddings.query_embeddings import query_vectorDB_batch
+from app.utils import metrics
+
+MAX_TOOL_ITERATIONS = int(os.getenv("MAX_TOOL_ITERATIONS", 4))
+MAX_TOOL_CONTEXT_TOKENS = int(os.getenv("MAX_TOOL_CONTEXT_TOKENS", 60000))
+TOOL_MODEL = "gpt-4.1-nano"
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "Querycodebase",
+            "description": "Run a code-level search using a specific query.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "Query": {"type": "string", "description": "The query to run."}
+                },
+                "required": ["Query"]
+            }
+        }
+    }
+]
+
+
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query or "").strip().lower()
+
+
+class ToolEngine:
+    def __init__(self, project_id: str, token_budget: int, max_iterations: int = MAX_TOOL_ITERATIONS,
+                 max_context_tokens: int = MAX_TOOL_CONTEXT_TOKENS):
+        self.project_id = project_id
+        self.token_budget = token_budget
+        self.max_iterations = max_iterations
+        self.max_context_tokens = max_context_tokens
+        self.context_tokens = 0
+        self.iterations = 0
+        # Normalized query -> the query it was first searched as
+        self._searched: dict[str, str] = {}
+
+    def mark_searched(self, query: str):
+        """Record a search made before the loop, e.g. the retrieval for the generated query."""
+        self._searched.setdefault(normalize_query(query), query)
+
+    async def run(self, messages: list[dict]):
+        """Let the model call tools until it answers or a limit is hit; appends to messages."""
+        while self.iterations < self.max_iterations:
+            self.iterations += 1
+            model_response = await OPEN_AI_CLIENT.chat.completions.create(
+                model=TOOL_MODEL,
+                messages=messages,
+                max_tokens=2000,
+                tool_choice="auto",
+                tools=TOOLS
+            )
+            choice = model_response.choices[0]
+            if choice.finish_reason != "tool_calls" or not choice.message.tool_calls:
+                break
+
+            messages.append({
+                "role": "assistant",
+                "content": choice.message.content,
+                "tool_calls": [
+                    {
+                        "id": tool_call.id,
+                        "type": "function",
+                        "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments},
+                    }
+                    for tool_call in choice.message.tool_calls
+                ],
+            })
+            results = await self._execute(choice.message.tool_calls)
+            within_budget = await self._append_results(messages, choice.message.tool_calls, results)
+            if not within_budget:
+                metrics.incr("chat.tools.budget_stops")
+                break
+        else:
+            metrics.incr("chat.tools.iteration_stops")
+        metrics.incr("chat.tools.iterations", self.iterations)
+
+    async def _execute(self, tool_calls) -> dict[str, str]:
+        """Result text per tool call id."""
+        results: dict[str, str] = {}
+        searches: dict[str, list[str]] = {}
+        for tool_call in tool_calls:
+            try:
+                tool_args = json.loads(tool_call.function.arguments or "{}")
+            except json.JSONDecodeError as e:
+                results[tool_call.id] = f"Invalid arguments: {e}"
+                continue
+
+            if tool_call.function.name != "Querycodebase":
+                results[tool_call.id] = f"Unknown tool: {tool_call.function.name}"
+                continue
+
+            query = tool_args.get("Query", "")
+            normalized = normalize_query(query)
+            if normalized in self._searched and normalized not in searches:
+                # Answered earlier in this turn, its result is already in the conversation
+                metrics.incr("chat.tools.deduped")
+                results[tool_call.id] = f"Already searched for \"{self._searched[normalized]}\" in this conversation, see the result above."
+                continue
+            searches.setdefault(normalized, []).append(tool_call.id)
+            self._searched.setdefault(normalized, query)
+
+        # Handlers for other tools would be gathered alongside
+        handlers = []
+        if searches:
+            handlers.append(self._search(searches))
+        for handler_results in await asyncio.gather(*handlers):
+            results.update(handler_results)
+        return results
+
+    async def _search(self, searches: dict[str, list[str]]) -> dict[str, str]:
+        t0 = time.monotonic()
+        queries = [self._searched[normalized] for normalized in searches]
+        tool_results = await query_vectorDB_batch(self.project_id, queries, token_budget=self.token_budget)
+        metrics.observe("chat.tools.search_seconds", time.monotonic() - t0)
+        metrics.incr("chat.tools.searches", len(queries))
+
+        results = {}
+        for call_ids, tool_result in zip(searches.values(), tool_results):
+            results[call_ids[0]] = tool_result
+            # The same query twice in one response is answered once
+            for call_id in call_ids[1:]:
+                metrics.incr("chat.tools.deduped")
+                results[call_id] = "Same search as another call in this response, see its result."
+        return results
+
+    async def _append_results(self, messages: list[dict], tool_calls, results: dict[str, str]) -> bool:
+        """Append one tool message per call, cut to what is left of the budget. False once it is spent."""
+        within_budget = True
+        for tool_call in tool_calls:
+            content = results.get(tool_call.id, "")
+            remaining = self.max_context_tokens - self.context_tokens
+            tokens = await count_tokens(content)
+            if tokens > remaining:
+                content, _ = await truncate(content, max(remaining, 0))
+                tokens = max(remaining, 0)
+                within_budget = False
+            self.context_tokens += tokens
+            # Every call id needs an answer, even an empty one, or the next request is rejected
+            messages.append({"role": "tool", "tool_call_id": tool_call.id, "content": content})
+        return within_budget
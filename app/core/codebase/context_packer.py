@@ -0,0 +1,168 @@
+"""
+Rendering and token-budget packing of retrieved chunks.
+
+render_chunk turns a chunk into the title and display text the chat prompt shows, with its
+token count. The result is stored per chunk in embedding_chunk_meta (see app.db.chunk_meta), so
+requests normally only read it.
+
+Chunks arrive best first. Each one is added whole while it fits; a chunk that does not fit, or
+that would take more than MAX_CHUNK_SHARE of the budget, is cut down to its line windows that
+mention the most query terms. A chunk that mostly repeats lines of an already packed chunk of
+the same file is skipped. Budgets are in o200k_base tokens, the gpt-4.1 family's encoding.
+"""
+import json
+import os
+import re
+from collections import defaultdict
+
+from app.core.codebase.tokenization import count_tokens_sync, get_encoder
+from app.utils import metrics
+
+PACKING_ENCODING = "o200k_base"
+# "Document N — " and the distance line around a rendered chunk, plus the separator
+ENTRY_OVERHEAD_TOKENS = 30
+MAX_CHUNK_SHARE = 0.5
+MIN_CHUNK_TOKENS = 200
+WINDOW_LINES = 30
+DUPLICATE_LINE_OVERLAP = 0.6
+ELISION = "..."
+
+_STOP_WORDS = {
+    "the", "and", "for", "with", "that", "this", "from", "how", "what", "where", "which", "does",
+    "are", "was", "use", "used", "code", "file", "files", "function", "class", "into", "when",
+}
+
+# Fence language by file extension
+CODE_LANGUAGES = {
+    ".py": "python", ".js": "javascript", ".jsx": "jsx", ".ts": "typescript", ".tsx": "tsx",
+    ".dart": "dart", ".java": "java", ".kt": "kotlin", ".kts": "kotlin", ".cs": "csharp",
+    ".c": "c", ".h": "c", ".cpp": "cpp", ".hpp": "cpp", ".go": "go", ".rs": "rust", ".rb": "ruby",
+    ".php": "php", ".swift": "swift", ".scala": "scala", ".lua": "lua", ".sql": "sql",
+    ".sh": "bash", ".ps1": "powershell", ".html": "html", ".css": "css", ".scss": "scss",
+    ".vue": "vue", ".json": "json", ".yml": "yaml", ".yaml": "yaml", ".toml": "toml", ".xml": "xml",
+}
+# What used to decide code fencing for files with an unknown extension
+_CODE_MARKERS = ("def ", "class ", "import ", "{", "=>", ";")
+
+
+def count_tokens(text: str) -> int:
+    return count_tokens_sync(text, PACKING_ENCODING)
+
+def _parse_metadata(metadata) -> dict:
+    # metadata may be stored as JSON string
+    if isinstance(metadata, str):
+        try:
+            metadata = json.loads(metadata)
+        except Exception:
+            return {}
+    return metadata if isinstance(metadata, dict) else {}
+
+def detect_language(file_path: str, document: str) -> str | None:
+    """Fence language of a chunk, "" for code of an unknown language, None for prose."""
+    language = CODE_LANGUAGES.get(os.path.splitext(file_path or "")[1].lower())
+    if language is not None:
+        return language
+    return "" if any(marker in document for marker in _CODE_MARKERS) else None
+
+def render_chunk(row: dict) -> dict:
+    """title, display_text, language and token_count (of title + display_text) of one chunk."""
+    meta = _parse_metadata(row.get("metadata"))
+    file_name = meta.get("file_name") or row.get("file_name") or "unknown"
+    file_path = meta.get("file_path") or row.get("file_path") or "unknown"
+    summary = row.get("summary") or meta.get("summary") or ""
+    document = row.get("document") or ""
+    language = detect_language(file_path, document)
+    content_display = document if language is None else f"```{language}\n{document}\n```"
+    title = f"File: {file_name} (path: {file_path})"
+    display_text = f"Summary: {summary}\n\nContent:\n{content_display}"
+    return {
+        "title": title,
+        "display_text": display_text,
+        "language": language,
+        "token_count": count_tokens(title) + count_tokens(display_text),
+    }
+
+def _query_terms(query: str | None) -> set[str]:
+    terms = set()
+    for word in re.findall(r"[A-Za-z_][A-Za-z0-9_]*", query or ""):
+        for part in [word, *word.split("_")]:
+            part = part.lower()
+            if len(part) >= 3 and part not in _STOP_WORDS:
+                terms.add(part)
+    return terms
+
+def _significant_lines(text: str) -> set[str]:
+    # Braces, blank lines and other short lines say nothing about overlap
+    return {line.strip() for line in text.splitlines() if len(line.strip()) >= 4}
+
+def _overlap(lines: set[str], other: set[str]) -> float:
+    if not lines or not other:
+        return 0.0
+    return len(lines & other) / min(len(lines), len(other))
+
+def trim_to_windows(text: str, terms: set[str], max_tokens: int) -> str:
+    """The WINDOW_LINES windows of text that mention the most terms, in file order, within max_tokens."""
+    lines = text.splitlines()
+    windows = ["\n".join(lines[i:i + WINDOW_LINES]) for i in range(0, len(lines), WINDOW_LINES)]
+    if not windows:
+        return text
+    scores = [sum(window.lower().count(term) for term in terms) for window in windows]
+    costs = [count_tokens(window) + 1 for window in windows]
+
+    chosen, used = set(), 0
+    # Without query terms every score is 0 and the head of the chunk wins
+    for i in sorted(range(len(windows)), key=lambda i: (-scores[i], i)):
+        if used + costs[i] <= max_tokens:
+            chosen.add(i)
+            used += costs[i]
+    if not chosen:
+        encoder = get_encoder(PACKING_ENCODING)
+        return encoder.decode(encoder.encode_ordinary(windows[0])[:max_tokens])
+
+    parts = []
+    for i in range(len(windows)):
+        if i in chosen:
+            parts.append(windows[i])
+        elif not parts or parts[-1] != ELISION:
+            parts.append(ELISION)
+    return "\n".join(parts)
+
+def pack_chunks(rows: list[dict], token_budget: int, query: str | None = None) -> list[dict]:
+    """
+    The rows to show, in the given order, fitting token_budget. Rows carry their rendering
+    (title, display_text, token_count) from hydration, so budgeting is integer arithmetic; only a
+    chunk that has to be trimmed is tokenized and rendered again.
+    """
+    terms = _query_terms(query)
+    chunk_cap = max(int(token_budget * MAX_CHUNK_SHARE), MIN_CHUNK_TOKENS)
+    remaining = token_budget
+    packed = []
+    packed_lines: dict[str, list[set[str]]] = defaultdict(list)
+    for row in rows:
+        document = row.get("document") or ""
+        file_path = row.get("file_path") or ""
+        lines = _significant_lines(document)
+        if any(_overlap(lines, other) >= DUPLICATE_LINE_OVERLAP for other in packed_lines[file_path]):
+            metrics.incr("context_packer.duplicates")
+            continue
+
+        available = min(remaining - ENTRY_OVERHEAD_TOKENS, chunk_cap)
+        if available < MIN_CHUNK_TOKENS:
+            metrics.incr("context_packer.dropped")
+            continue
+        if row.get("display_text") is None:
+            row = dict(row, **render_chunk(row))
+        if row["token_count"] > available:
+            # Everything but the document stays, the document gets what is left
+            document_budget = available - (row["token_count"] - count_tokens(document))
+            if document_budget < MIN_CHUNK_TOKENS // 2:
+                metrics.incr("context_packer.dropped")
+                continue
+            row = dict(row, document=trim_to_windows(document, terms, document_budget))
+            row.update(render_chunk(row))
+            metrics.incr("context_packer.trimmed")
+
+        packed.append(row)
+        packed_lines[file_path].append(lines)
+        remaining -= ENTRY_OVERHEAD_TOKENS + row["token_count"]
+    return packed
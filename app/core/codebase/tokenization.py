@@ -0,0 +1,156 @@
+"""
+Tokenization off the event loop.
+
+Encoders are loaded once per process. Counting and truncation run in a small thread pool
+(tiktoken releases the GIL while encoding), so a 170k-token summary does not stall every other
+websocket in the worker. Results are memoized by (sha256 of the text, budget, encoding), so the
+same summary truncated again on the next turn costs a hash and a dict lookup.
+
+Truncation only encodes as much of the text as the cut needs, see _prefix_cut: keeping the first
+10k tokens of a 170k-token summary encodes roughly 40k characters instead of all of them.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import tiktoken
+
+from app.utils import metrics
+
+DEFAULT_ENCODING = "o200k_base"
+TOKENIZER_THREADS = int(os.getenv("TOKENIZER_THREADS", 2))
+TOKENIZER_MEMO_ENTRIES = int(os.getenv("TOKENIZER_MEMO_ENTRIES", 4096))
+
+# Truncation encodes a prefix of max_tokens * PREFIX_CHARS_PER_TOKEN characters first and grows
+# it PREFIX_GROWTH-fold until it holds the cut plus a piece boundary; only these encodings'
+# pre-tokenizer patterns are known to have the boundary property it relies on
+PREFIX_SAFE_ENCODINGS = {"cl100k_base", "o200k_base"}
+PREFIX_CHARS_PER_TOKEN = 4
+PREFIX_GROWTH = 2
+PREFIX_VERIFY_TOKENS = 16
+PREFIX_VERIFY_CHARS = 1024
+_PIECE_BOUNDARY = re.compile(r"\n[^\s/]")
+
+_executor = ThreadPoolExecutor(max_workers=TOKENIZER_THREADS, thread_name_prefix="tokenizer")
+# (text digest, budget or None, encoding) -> _measure result
+_memo: OrderedDict[tuple, tuple[int | None, int, bool]] = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_encoder(encoding: str = DEFAULT_ENCODING) -> tiktoken.Encoding:
+    return tiktoken.get_encoding(encoding)
+
+@lru_cache(maxsize=None)
+def encoding_for_model(model: str) -> str:
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        return DEFAULT_ENCODING
+
+def _memo_get(key: tuple):
+    with _memo_lock:
+        value = _memo.get(key)
+        if value is not None:
+            _memo.move_to_end(key)
+        return value
+
+def _memo_set(key: tuple, value: tuple[int | None, int, bool]):
+    with _memo_lock:
+        _memo[key] = value
+        _memo.move_to_end(key)
+        while len(_memo) > TOKENIZER_MEMO_ENTRIES:
+            _memo.popitem(last=False)
+
+def count_tokens_sync(text: str, encoding: str = DEFAULT_ENCODING) -> int:
+    """Token count without the memo, for short texts on the calling thread."""
+    return len(get_encoder(encoding).encode_ordinary(text)) if text else 0
+
+def _boundary_after(text: str, start: int, end: int) -> bool:
+    """
+    True if the encoder's pre-tokenizer must split text somewhere in [start, end): for the
+    cl100k/o200k patterns a newline followed by anything but whitespace or "/" always ends a
+    piece. Pieces are encoded independently, so every token before such a split is the same
+    whether or not the text goes on after `end`.
+    """
+    return _PIECE_BOUNDARY.search(text, max(start - 1, 0), end) is not None
+
+def _prefix_cut(text: str, max_tokens: int, encoder: tiktoken.Encoding) -> tuple[int | None, int, bool] | None:
+    """
+    Cut for max_tokens found by encoding growing prefixes of text, or None when the prefixes
+    reached the whole text. Same result as encoding everything, see _boundary_after.
+    """
+    window = max_tokens * PREFIX_CHARS_PER_TOKEN + PREFIX_VERIFY_CHARS
+    while window < len(text):
+        tokens = encoder.encode_ordinary(text[:window])
+        if len(tokens) > max_tokens + PREFIX_VERIFY_TOKENS:
+            head = encoder.decode_bytes(tokens[:max_tokens])
+            prefix = head.decode("utf-8", errors="ignore")
+            # The two characters before the window end may still merge with what follows it
+            if _boundary_after(text, len(prefix), window - 1):
+                metrics.incr("tokenization.prefix_cuts")
+                return None, len(prefix), len(prefix.encode("utf-8")) != len(head)
+        window *= PREFIX_GROWTH
+    return None
+
+def _measure(text: str, max_tokens: int | None, encoding: str) -> tuple[int | None, int, bool]:
+    """
+    (token count, character offset of the cut, whether the cut splits a character), memoized.
+    The count is None when only a prefix was encoded, which means the text is over max_tokens.
+    """
+    key = (hashlib.sha256(text.encode("utf-8")).digest(), max_tokens, encoding)
+    cached = _memo_get(key)
+    if cached is not None:
+        metrics.incr("tokenization.memo_hits")
+        return cached
+    metrics.incr("tokenization.memo_misses")
+
+    encoder = get_encoder(encoding)
+    result = None
+    if max_tokens is not None and encoding in PREFIX_SAFE_ENCODINGS:
+        result = _prefix_cut(text, max_tokens, encoder)
+    if result is None:
+        tokens = encoder.encode_ordinary(text)
+        if max_tokens is None or len(tokens) <= max_tokens:
+            result = (len(tokens), len(text), False)
+        else:
+            head = encoder.decode_bytes(tokens[:max_tokens])
+            prefix = head.decode("utf-8", errors="ignore")
+            result = (len(tokens), len(prefix), len(prefix.encode("utf-8")) != len(head))
+    _memo_set(key, result)
+    return result
+
+async def count_tokens(text: str, encoding: str = DEFAULT_ENCODING) -> int:
+    if not text:
+        return 0
+    count, _, _ = await asyncio.get_running_loop().run_in_executor(_executor, _measure, text, None, encoding)
+    return count
+
+def truncate_sync(text: str, max_tokens: int, encoding: str = DEFAULT_ENCODING) -> tuple[str, int | None]:
+    """
+    The first max_tokens tokens of text decoded, exactly what decoding a full encode gives
+    (a character split by the cut becomes U+FFFD), and the token count of the whole text if
+    it had to be known: None means the text was over max_tokens.
+    """
+    if not text:
+        return text, 0
+    if max_tokens <= 0:
+        return "", None
+    count, offset, split = _measure(text, max_tokens, encoding)
+    return text[:offset] + ("\ufffd" if split else ""), count
+
+def cut_offset(text: str, max_tokens: int, encoding: str = DEFAULT_ENCODING) -> int:
+    """Character offset of the longest prefix of text within max_tokens, never inside a character."""
+    if not text or max_tokens <= 0:
+        return 0
+    _, offset, _ = _measure(text, max_tokens, encoding)
+    return offset
+
+async def truncate(text: str, max_tokens: int, encoding: str = DEFAULT_ENCODING) -> tuple[str, int | None]:
+    """truncate_sync in the tokenizer pool."""
+    return await asyncio.get_running_loop().run_in_executor(_executor, truncate_sync, text, max_tokens, encoding)
@@ -1,69 +1,137 @@
-import tiktoken
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
 from app.constants import ANTHROPIC_CLIENT
+from app.core.codebase.tokenization import count_tokens_sync, cut_offset, encoding_for_model, truncate
+from app.utils import metrics
+
+# anthropic_truncator estimates Claude token counts from local o200k counts times a per-model
+# ratio, starting from ANTHROPIC_DEFAULT_RATIO and moved towards every observed count
+ANTHROPIC_ESTIMATE_ENCODING = "o200k_base"
+ANTHROPIC_DEFAULT_RATIO = 1.15
+ANTHROPIC_CALIBRATION_ALPHA = 0.2
+ANTHROPIC_MIN_SAMPLES = 3
+# Estimates this far from the limit are trusted without asking
+ANTHROPIC_SKIP_MARGIN = 0.15
+# Cuts aim this far under the limit so the first verification usually passes
+ANTHROPIC_SAFETY_MARGIN = 0.02
+# count_tokens calls per truncation, the whole-text count included
+ANTHROPIC_MAX_REMOTE_CALLS = 2
+# A cut nobody could verify is shrunk this much further
+ANTHROPIC_UNVERIFIED_MARGIN = 0.10
+ANTHROPIC_COUNT_MEMO_ENTRIES = int(os.getenv("ANTHROPIC_COUNT_MEMO_ENTRIES", 1024))
+
+# model -> (remote tokens per local token, samples)
+_calibration: dict[str, tuple[float, int]] = {}
+# (sha256 of text, model) -> remote count
+_prefix_counts: OrderedDict[tuple, int] = OrderedDict()
+_count_lock = threading.Lock()
 
 
 async def open_ai_truncator(text: str, model: str, max_tokens: int):
     try:
-        # Initialize the tokenizer
-        enc = tiktoken.get_encoding("o200k_base")
-        
-        # Encode the text to tokens
-        tokens = enc.encode(text)
-        
-        # Check if the number of tokens is within the limit
-        if len(tokens) <= max_tokens:
-            print(f'length of untruncated file: {len(tokens)}')
-            return text
-        
-        # If too long, truncate and decode the tokens
+        # Encoding runs in the tokenizer pool, stops after the cut, and repeat calls on the same text are memoized
+        truncated, token_count = await truncate(text, max_tokens, encoding_for_model(model))
+
+        # Check if the number of tokens is within the limit; an over-limit text is only encoded up to the cut
+        if token_count is not None and token_count <= max_tokens:
+            print(f'length of untruncated file: {token_count}')
         else:
             print('file truncated')
-            return enc.decode(tokens[:max_tokens])
-        
+        return truncated
+
     except Exception as e:
         # Log the exception details
         print(f"An error occurred during truncation: {str(e)}")
         return None
 
-def anthropic_truncator(text, max_tokens=160000, model="claude-haiku-4-5"):
-    """Use binary search to efficiently truncate text to fit token limit."""
-    
-    # Initial check
-    count = ANTHROPIC_CLIENT.messages.count_tokens(
-        model=model,
-        messages=[{"role": "user", "content": text}]
-    )
-    
-    if count.input_tokens <= max_tokens:
-        return text
-    
-    # Binary search for the right length
-    low = 0
-    high = len(text)
-    
-    while high - low > 5000:  # Stop when we're close enough
-        mid = (low + high) // 2
-        truncated = text[:mid]
-        
-        count = ANTHROPIC_CLIENT.messages.count_tokens(
-            model=model,
-            messages=[{"role": "user", "content": truncated}]
-        )
-        
-        if count.input_tokens <= max_tokens:
-            low = mid
-        else:
-            high = mid
-    
-    # Fine-tune the final result
-    while True:
-        truncated = text[:high]
-        count = ANTHROPIC_CLIENT.messages.count_tokens(
+def _remote_count(client, model: str, text: str) -> int | None:
+    """count_tokens of text as one user message, memoized; None if the call failed."""
+    key = (hashlib.sha256(text.encode("utf-8")).digest(), model)
+    with _count_lock:
+        count = _prefix_counts.get(key)
+        if count is not None:
+            _prefix_counts.move_to_end(key)
+            metrics.incr("anthropic_truncator.memo_hits")
+            return count
+    try:
+        count = client.messages.count_tokens(
             model=model,
-            messages=[{"role": "user", "content": truncated}]
-        )
-        
-        if count.input_tokens <= max_tokens:
+            messages=[{"role": "user", "content": text}]
+        ).input_tokens
+    except Exception as e:
+        print(f"An error occurred while counting tokens with {model}: {e}")
+        return None
+    metrics.incr("anthropic_truncator.count_calls")
+    with _count_lock:
+        _prefix_counts[key] = count
+        while len(_prefix_counts) > ANTHROPIC_COUNT_MEMO_ENTRIES:
+            _prefix_counts.popitem(last=False)
+    return count
+
+def _observe(model: str, local_tokens: int, remote_tokens: int):
+    """Fold one (local, remote) count pair into the model's tokens-per-local-token ratio."""
+    if local_tokens <= 0:
+        return
+    ratio, samples = _calibration.get(model, (ANTHROPIC_DEFAULT_RATIO, 0))
+    observed = remote_tokens / local_tokens
+    ratio = observed if samples == 0 else ratio + ANTHROPIC_CALIBRATION_ALPHA * (observed - ratio)
+    _calibration[model] = (ratio, samples + 1)
+
+def anthropic_truncator(text, max_tokens=160000, model="claude-haiku-4-5", client=None):
+    """
+    Truncate text to fit max_tokens for an Anthropic model.
+
+    Sizes come from a local o200k count scaled by the model's calibrated ratio, learnt from every
+    count_tokens answer. The remote count is asked for the whole text (skipped when the
+    calibrated estimate is clearly under or over the limit) and then for cuts, each corrected from
+    the previous answer, ANTHROPIC_MAX_REMOTE_CALLS calls in all. A cut left unverified is shrunk
+    by ANTHROPIC_UNVERIFIED_MARGIN more. All answers are memoized by text. `client` defaults to ANTHROPIC_CLIENT; anything with a compatible
+    messages.count_tokens can stand in for it.
+    """
+    client = client or ANTHROPIC_CLIENT
+    local_total = count_tokens_sync(text, ANTHROPIC_ESTIMATE_ENCODING)
+    if local_total == 0:
+        return text
+    ratio, samples = _calibration.get(model, (ANTHROPIC_DEFAULT_RATIO, 0))
+    calibrated = samples >= ANTHROPIC_MIN_SAMPLES
+    estimate = local_total * ratio
+    if calibrated and estimate <= max_tokens * (1 - ANTHROPIC_SKIP_MARGIN):
+        metrics.incr("anthropic_truncator.estimated_under")
+        return text
+
+    calls_left = ANTHROPIC_MAX_REMOTE_CALLS
+    if not (calibrated and estimate >= max_tokens * (1 + ANTHROPIC_SKIP_MARGIN)):
+        calls_left -= 1
+        total = _remote_count(client, model, text)
+        if total is not None:
+            _observe(model, local_total, total)
+            if total <= max_tokens:
+                return text
+            # This text's own ratio beats the model average
+            ratio = total / local_total
+
+    local_budget = int(max_tokens * (1 - ANTHROPIC_SAFETY_MARGIN) / ratio)
+    for _ in range(calls_left):
+        truncated = text[:cut_offset(text, local_budget, ANTHROPIC_ESTIMATE_ENCODING)]
+        count = _remote_count(client, model, truncated)
+        if count is None:
+            break
+        local_count = count_tokens_sync(truncated, ANTHROPIC_ESTIMATE_ENCODING)
+        _observe(model, local_count, count)
+        if count <= max_tokens:
             return truncated
-        
-        high -= 5000  # Reduce by 5000 characters at a time until we fit
\ No newline at end of file
+        # This cut's own ratio sizes the next one
+        local_budget = int(local_count * max_tokens * (1 - ANTHROPIC_SAFETY_MARGIN) / count)
+
+    # Out of calls: the last correction is applied unchecked, with room for its error
+    metrics.incr("anthropic_truncator.unverified")
+    local_budget = int(local_budget * (1 - ANTHROPIC_UNVERIFIED_MARGIN))
+    return text[:cut_offset(text, local_budget, ANTHROPIC_ESTIMATE_ENCODING)]
+
+async def anthropic_truncator_async(text, max_tokens=160000, model="claude-haiku-4-5", client=None):
+    """anthropic_truncator off the event loop; the Anthropic client is synchronous."""
+    return await asyncio.to_thread(anthropic_truncator, text, max_tokens, model, client)
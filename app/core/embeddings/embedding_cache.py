@@ -0,0 +1,201 @@
+"""
+Two-tier cache for query embeddings.
+
+Tier 1 is a per-worker BoundedCache, tier 2 is the query_embedding_cache table in the vector
+database, shared by every worker and surviving restarts. Keys are sha256(model, normalised text)
+and vectors are kept as packed float32 bytes (12 KB for text-embedding-3-large) rather than lists
+of Python floats. Rows older than EMBEDDING_CACHE_TTL_DAYS and the oldest rows beyond
+EMBEDDING_CACHE_MAX_ROWS are deleted every EMBEDDING_CACHE_PRUNE_SECONDS by one worker.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import unicodedata
+
+import numpy as np
+
+from app.constants import OPEN_AI_CLIENT
+from app.db.connections import vector_db_connection
+from app.utils import metrics
+from app.utils.cache import BoundedCache
+
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+EMBEDDING_CACHE_TTL_DAYS = float(os.getenv("EMBEDDING_CACHE_TTL_DAYS", 30))
+EMBEDDING_CACHE_MAX_ROWS = int(os.getenv("EMBEDDING_CACHE_MAX_ROWS", 500_000))
+EMBEDDING_CACHE_PRUNE_SECONDS = float(os.getenv("EMBEDDING_CACHE_PRUNE_SECONDS", 3600))
+EMBEDDING_CACHE_PRUNE_BATCH = 5000
+# Arbitrary application-wide key so only one worker prunes at a time
+EMBEDDING_CACHE_PRUNE_LOCK_ID = 724_311_002
+
+_embedding_cache = BoundedCache("embedding_cache", EMBEDDING_CACHE_MAX_BYTES)
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+def embedding_key(text: str, model: str = EMBEDDING_MODEL) -> bytes:
+    return hashlib.sha256(f"{model}\x00{normalize_text(text)}".encode("utf-8")).digest()
+
+def pack_vector(vector) -> bytes:
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+def unpack_vector(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.float32)
+
+async def _load_shared(key: bytes) -> bytes | None:
+    try:
+        async with vector_db_connection() as conn:
+            return await conn.fetchval(
+                "SELECT embedding FROM query_embedding_cache WHERE cache_key = $1",
+                key,
+            )
+    except Exception as e:
+        print(f"An error occurred while reading the shared embedding cache: {e}")
+        return None
+
+async def _store_shared(key: bytes, model: str, blob: bytes, dims: int):
+    try:
+        async with vector_db_connection() as conn:
+            await conn.execute(
+                """
+                INSERT INTO query_embedding_cache (cache_key, model, dims, embedding)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (cache_key) DO NOTHING
+                """,
+                key, model, dims, blob,
+            )
+    except Exception as e:
+        print(f"An error occurred while writing the shared embedding cache: {e}")
+
+async def _embed_remote(text: str, model: str) -> list[float]:
+    metrics.incr("embedding_cache.remote_calls")
+    response = await OPEN_AI_CLIENT.embeddings.create(model=model, input=text)
+    return response.data[0].embedding
+
+async def embed_query(text: str, model: str = EMBEDDING_MODEL) -> np.ndarray | None:
+    """Return the float32 embedding of text, from memory, then Postgres, then the embeddings API."""
+    key = embedding_key(text, model)
+
+    async def load() -> bytes | None:
+        blob = await _load_shared(key)
+        if blob is not None:
+            metrics.incr("embedding_cache.shared_hits")
+            return blob
+        embedding = await _embed_remote(text, model)
+        if not embedding:
+            return None
+        blob = pack_vector(embedding)
+        await _store_shared(key, model, blob, len(embedding))
+        return blob
+
+    blob = await _embedding_cache.get_or_load(key, load, size_of=len)
+    return unpack_vector(blob) if blob is not None else None
+
+async def embed_queries(texts: list[str], model: str = EMBEDDING_MODEL) -> list[np.ndarray | None]:
+    """
+    Batch form of embed_query: one shared-cache lookup and at most one embeddings request
+    for however many texts miss the in-process cache.
+    """
+    keys = [embedding_key(text, model) for text in texts]
+    blobs: dict[bytes, bytes] = {}
+    for key in keys:
+        blob = _embedding_cache.get(key)
+        if blob is not None:
+            blobs[key] = blob
+
+    missing = list(dict.fromkeys(key for key in keys if key not in blobs))
+    if missing:
+        try:
+            async with vector_db_connection() as conn:
+                rows = await conn.fetch(
+                    "SELECT cache_key, embedding FROM query_embedding_cache WHERE cache_key = ANY($1::bytea[])",
+                    missing,
+                )
+            for row in rows:
+                blobs[row["cache_key"]] = row["embedding"]
+                _embedding_cache.set(row["cache_key"], row["embedding"], len(row["embedding"]))
+            metrics.incr("embedding_cache.shared_hits", len(rows))
+        except Exception as e:
+            print(f"An error occurred while reading the shared embedding cache: {e}")
+
+    missing_texts = {}
+    for key, text in zip(keys, texts):
+        if key not in blobs:
+            missing_texts.setdefault(key, text)
+    if missing_texts:
+        metrics.incr("embedding_cache.remote_calls")
+        response = await OPEN_AI_CLIENT.embeddings.create(model=model, input=list(missing_texts.values()))
+        new_rows = []
+        for key, item in zip(missing_texts, sorted(response.data, key=lambda d: d.index)):
+            if not item.embedding:
+                continue
+            blob = pack_vector(item.embedding)
+            blobs[key] = blob
+            _embedding_cache.set(key, blob, len(blob))
+            new_rows.append((key, model, len(item.embedding), blob))
+        if new_rows:
+            try:
+                async with vector_db_connection() as conn:
+                    await conn.executemany(
+                        """
+                        INSERT INTO query_embedding_cache (cache_key, model, dims, embedding)
+                        VALUES ($1, $2, $3, $4)
+                        ON CONFLICT (cache_key) DO NOTHING
+                        """,
+                        new_rows,
+                    )
+            except Exception as e:
+                print(f"An error occurred while writing the shared embedding cache: {e}")
+
+    return [unpack_vector(blobs[key]) if key in blobs else None for key in keys]
+
+async def _delete_batches(conn, condition: str, *args) -> int:
+    """Delete rows matching condition oldest first, in batches, so no statement runs long."""
+    deleted = 0
+    while True:
+        result = await conn.execute(
+            f"""
+            DELETE FROM query_embedding_cache WHERE cache_key IN (
+                SELECT cache_key FROM query_embedding_cache
+                WHERE {condition}
+                ORDER BY created_at
+                LIMIT {EMBEDDING_CACHE_PRUNE_BATCH}
+            )
+            """,
+            *args,
+        )
+        count = int(result.split()[-1])
+        deleted += count
+        if count < EMBEDDING_CACHE_PRUNE_BATCH:
+            return deleted
+
+async def prune_shared_cache() -> int:
+    """Drop expired rows, then the oldest rows over the size cap. Returns the number deleted."""
+    async with vector_db_connection() as conn:
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", EMBEDDING_CACHE_PRUNE_LOCK_ID):
+            return 0
+        try:
+            deleted = await _delete_batches(
+                conn, "created_at < NOW() - make_interval(secs => $1)", EMBEDDING_CACHE_TTL_DAYS * 86400,
+            )
+            cutoff = await conn.fetchval(
+                "SELECT created_at FROM query_embedding_cache ORDER BY created_at DESC OFFSET $1 LIMIT 1",
+                EMBEDDING_CACHE_MAX_ROWS,
+            )
+            if cutoff is not None:
+                deleted += await _delete_batches(conn, "created_at <= $1", cutoff)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", EMBEDDING_CACHE_PRUNE_LOCK_ID)
+    metrics.incr("embedding_cache.pruned_rows", deleted)
+    return deleted
+
+async def prune_shared_cache_periodically():
+    """Runs for the life of the worker, started from the FastAPI lifespan."""
+    while True:
+        try:
+            await prune_shared_cache()
+        except Exception as e:
+            print(f"An error occurred while pruning the shared embedding cache: {e}")
+        await asyncio.sleep(EMBEDDING_CACHE_PRUNE_SECONDS)
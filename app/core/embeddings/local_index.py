@@ -0,0 +1,337 @@
+"""
+In-process retrieval for hot projects, in front of pgvector.
+
+A project's embeddings are snapshotted to LOCAL_INDEX_DIR as .npy files that every worker
+memory-maps, so the matrices live once in the page cache however many workers search them.
+Search is a coarse pass over the first LOCAL_INDEX_COARSE_DIMS dimensions (text-embedding-3
+vectors stay meaningful when truncated and renormalised), then an exact cosine rescore of
+top_k * LOCAL_INDEX_OVERSAMPLE candidates with the full vectors. Rows are served from the snapshot
+too, so a search never touches Postgres.
+
+A snapshot is used only while it is newer than the last project_updated notification seen by this
+worker and younger than LOCAL_INDEX_MAX_AGE_SECONDS; otherwise callers fall back to pgvector and
+schedule a rebuild. Projects become hot after LOCAL_INDEX_HOT_QUERIES searches in this worker, or
+by being listed in LOCAL_INDEX_PROJECTS.
+
+LOCAL_INDEX_DIR/<project hash>/
+    manifest.json           current version, replaced atomically
+    <version>/full.npy      unit-normalised float32 embeddings, rows x dims
+    <version>/coarse.npy    unit-normalised float32 prefix of each embedding, rows x coarse dims
+    <version>/rows.jsonl    search columns, one JSON object per line
+    <version>/offsets.npy   int64 byte offsets of the lines in rows.jsonl, rows + 1
+    .lock                   flock held by the worker building a snapshot
+    stale_since             time of the last project_updated seen by any worker
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import time
+import uuid
+from collections import defaultdict
+from typing import Optional
+
+import numpy as np
+
+from app.db.connections import vector_db_connection
+from app.db.vector_index import EMBEDDING_DIMENSIONS
+from app.utils import metrics
+
+LOCAL_INDEX_ENABLED = os.getenv("LOCAL_INDEX_ENABLED", "false").lower() == "true"
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "/tmp/harmony_local_index")
+LOCAL_INDEX_PROJECTS = {p.strip() for p in os.getenv("LOCAL_INDEX_PROJECTS", "").split(",") if p.strip()}
+LOCAL_INDEX_HOT_QUERIES = int(os.getenv("LOCAL_INDEX_HOT_QUERIES", 20))
+LOCAL_INDEX_MAX_ROWS = int(os.getenv("LOCAL_INDEX_MAX_ROWS", 100_000))
+LOCAL_INDEX_COARSE_DIMS = int(os.getenv("LOCAL_INDEX_COARSE_DIMS", 256))
+LOCAL_INDEX_OVERSAMPLE = int(os.getenv("LOCAL_INDEX_OVERSAMPLE", 8))
+LOCAL_INDEX_MAX_AGE_SECONDS = float(os.getenv("LOCAL_INDEX_MAX_AGE_SECONDS", 24 * 3600))
+# Larger projects are searched in a thread so the event loop is not held for the matmul
+LOCAL_INDEX_INLINE_ROWS = int(os.getenv("LOCAL_INDEX_INLINE_ROWS", 20_000))
+LOCAL_INDEX_RECHECK_SECONDS = 10
+LOCAL_INDEX_BUILD_BACKOFF_SECONDS = 60
+# Rows fetched per round trip while building; each batch is written in a thread
+LOCAL_INDEX_BUILD_BATCH = 2000
+
+_snapshots: dict[str, "Snapshot"] = {}
+_stale_since: dict[str, float] = {}
+_all_stale_since = 0.0
+_next_check: dict[str, float] = {}
+_next_build: dict[str, float] = {}
+_query_counts: dict[str, int] = defaultdict(int)
+_building: set[str] = set()
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class Snapshot:
+    """One memory-mapped snapshot version of a project."""
+
+    def __init__(self, path: str, manifest: dict):
+        self.version = manifest["version"]
+        self.built_at = manifest["built_at"]
+        self.coarse = np.load(os.path.join(path, "coarse.npy"), mmap_mode="r")
+        self.full = np.load(os.path.join(path, "full.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        with open(os.path.join(path, "rows.jsonl"), "rb") as rows_file:
+            self._rows = mmap.mmap(rows_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return self.coarse.shape[0]
+
+    def row(self, i: int) -> dict:
+        return json.loads(self._rows[self.offsets[i]:self.offsets[i + 1]])
+
+    def search(self, queries: np.ndarray, top_k: int) -> list[list[tuple[int, float]]]:
+        """(row, cosine distance) pairs for each unit-normalised query, closest first."""
+        n = len(self)
+        k = min(top_k, n)
+        candidates = min(n, top_k * LOCAL_INDEX_OVERSAMPLE)
+        coarse_queries = _normalize(queries[:, :self.coarse.shape[1]])
+        # rows x queries in one BLAS call, whatever the number of queries
+        scores = self.coarse @ coarse_queries.T
+        if candidates < n:
+            top = np.argpartition(-scores, candidates - 1, axis=0)[:candidates]
+        else:
+            top = np.broadcast_to(np.arange(n)[:, None], (n, len(queries)))
+
+        results = []
+        for j, query in enumerate(queries):
+            # Sorted row numbers read the full matrix in file order
+            rows = np.sort(top[:, j])
+            exact = self.full[rows] @ query
+            best = np.argsort(-exact)[:k]
+            results.append([(int(rows[b]), float(1.0 - exact[b])) for b in best])
+        return results
+
+
+def _project_dir(project_id: str) -> str:
+    return os.path.join(LOCAL_INDEX_DIR, hashlib.sha256(project_id.encode("utf-8")).hexdigest()[:32])
+
+def _read_manifest(project_id: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(_project_dir(project_id), "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _is_fresh(project_id: str, manifest: dict) -> bool:
+    return (manifest["built_at"] >= max(_all_stale_since, _stale_since.get(project_id, 0.0))
+            and time.time() - manifest["built_at"] < LOCAL_INDEX_MAX_AGE_SECONDS)
+
+def _read_stale_marker(project_id: str):
+    """Pick up a staleness another worker recorded, e.g. before this worker was started."""
+    try:
+        with open(os.path.join(_project_dir(project_id), "stale_since")) as f:
+            stale_since = float(f.read())
+    except (FileNotFoundError, ValueError):
+        return
+    if stale_since > _stale_since.get(project_id, 0.0):
+        _stale_since[project_id] = stale_since
+
+def _write_stale_marker(project_id: str, now: float):
+    project_dir = _project_dir(project_id)
+    if not os.path.isdir(project_dir):
+        return
+    try:
+        marker_tmp = os.path.join(project_dir, f"stale_since.{os.getpid()}.tmp")
+        with open(marker_tmp, "w") as f:
+            f.write(repr(now))
+        os.replace(marker_tmp, os.path.join(project_dir, "stale_since"))
+    except OSError as e:
+        print(f"An error occurred while marking the local index of {project_id} stale: {e}")
+
+def mark_stale(project_id: Optional[str]):
+    """
+    Stop serving snapshots built before now, for one project or (None) all of them. A project's
+    staleness is also recorded next to its snapshots for workers that missed the notification.
+    """
+    global _all_stale_since
+    now = time.time()
+    if project_id is None:
+        _all_stale_since = now
+        _snapshots.clear()
+        _next_check.clear()
+        _next_build.clear()
+    else:
+        _stale_since[project_id] = now
+        _snapshots.pop(project_id, None)
+        _next_check.pop(project_id, None)
+        _next_build.pop(project_id, None)
+        if LOCAL_INDEX_ENABLED:
+            _write_stale_marker(project_id, now)
+
+def is_hot(project_id: str) -> bool:
+    return project_id in LOCAL_INDEX_PROJECTS or _query_counts[project_id] >= LOCAL_INDEX_HOT_QUERIES
+
+def _get_snapshot(project_id: str) -> Optional[Snapshot]:
+    snapshot = _snapshots.get(project_id)
+    if snapshot is not None:
+        if _is_fresh(project_id, {"built_at": snapshot.built_at}):
+            return snapshot
+        _snapshots.pop(project_id, None)
+
+    # Another worker may have built one since the last look; the manifest is read at most
+    # every LOCAL_INDEX_RECHECK_SECONDS per project
+    now = time.monotonic()
+    if _next_check.get(project_id, 0.0) > now:
+        return None
+    _next_check[project_id] = now + LOCAL_INDEX_RECHECK_SECONDS
+    try:
+        _read_stale_marker(project_id)
+        manifest = _read_manifest(project_id)
+        if manifest is None or not _is_fresh(project_id, manifest):
+            return None
+        snapshot = Snapshot(os.path.join(_project_dir(project_id), manifest["version"]), manifest)
+    except Exception as e:
+        print(f"An error occurred while loading the local index of {project_id}: {e}")
+        return None
+    _snapshots[project_id] = snapshot
+    return snapshot
+
+async def search(project_id: str, embeddings: list, top_k: int) -> Optional[list[list[dict]]]:
+    """Top-k rows per embedding from the local snapshot, or None if the caller should use pgvector."""
+    if not LOCAL_INDEX_ENABLED:
+        return None
+    _query_counts[project_id] += 1
+    snapshot = _get_snapshot(project_id)
+    if snapshot is None or not len(snapshot):
+        metrics.incr("local_index.fallbacks")
+        return None
+    queries = _normalize(np.vstack([np.asarray(e, dtype=np.float32) for e in embeddings]))
+    if queries.shape[1] != snapshot.full.shape[1]:
+        metrics.incr("local_index.fallbacks")
+        return None
+
+    t0 = time.perf_counter()
+    if len(snapshot) > LOCAL_INDEX_INLINE_ROWS:
+        hits = await asyncio.to_thread(snapshot.search, queries, top_k)
+    else:
+        hits = snapshot.search(queries, top_k)
+    metrics.observe("local_index.search", time.perf_counter() - t0)
+    metrics.incr("local_index.hits")
+    return [[dict(snapshot.row(i), distance=distance) for i, distance in found] for found in hits]
+
+def wants_snapshot(project_id: str) -> bool:
+    """True when a hot project has no usable snapshot and nobody in this worker is building one."""
+    if not LOCAL_INDEX_ENABLED or not is_hot(project_id) or project_id in _building:
+        return False
+    now = time.monotonic()
+    if _next_build.get(project_id, 0.0) > now:
+        return False
+    _next_build[project_id] = now + LOCAL_INDEX_BUILD_BACKOFF_SECONDS
+    return True
+
+def _write_batch(batch: list, full: np.ndarray, offsets: np.ndarray, rows_file, start: int) -> int:
+    """Write fetched rows from index `start` on; returns the index after the last one."""
+    end = min(start + len(batch), len(full))
+    batch = batch[:end - start]
+    full[start:end] = _normalize(np.asarray([row["embedding"] for row in batch], dtype=np.float32))
+    for i, row in enumerate(batch, start=start):
+        payload = {key: value for key, value in row.items() if key != "embedding"}
+        rows_file.write(json.dumps(payload, default=str).encode("utf-8") + b"\n")
+        offsets[i + 1] = rows_file.tell()
+    return end
+
+def _finish_version(version_dir: str, full: np.ndarray, offsets: np.ndarray):
+    full.flush()
+    np.save(os.path.join(version_dir, "offsets.npy"), offsets)
+
+def _write_coarse(version_dir: str, rows: int):
+    full = np.load(os.path.join(version_dir, "full.npy"), mmap_mode="r")
+    coarse = np.lib.format.open_memmap(
+        os.path.join(version_dir, "coarse.npy"), mode="w+", dtype=np.float32,
+        shape=(rows, min(LOCAL_INDEX_COARSE_DIMS, full.shape[1])),
+    )
+    coarse[:] = _normalize(full[:, :coarse.shape[1]])
+    coarse.flush()
+
+async def build_snapshot(project_id: str, columns: str, joins: str = ""):
+    """
+    Write a new snapshot of the project's rows (`columns` of `embeddings e {joins}` plus the
+    embedding) and switch the manifest to it. Only one worker builds a project at a time, the
+    others keep falling back.
+    """
+    _building.add(project_id)
+    try:
+        project_dir = _project_dir(project_id)
+        os.makedirs(project_dir, exist_ok=True)
+        with open(os.path.join(project_dir, ".lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                metrics.incr("local_index.builds_skipped")
+                return
+            _read_stale_marker(project_id)
+            manifest = _read_manifest(project_id)
+            if manifest is None or not _is_fresh(project_id, manifest):
+                manifest = await _build_version(project_id, project_dir, columns, joins)
+            if manifest is not None and _is_fresh(project_id, manifest):
+                _snapshots[project_id] = Snapshot(os.path.join(project_dir, manifest["version"]), manifest)
+    except Exception as e:
+        metrics.incr("local_index.build_failures")
+        print(f"An error occurred while building the local index of {project_id}: {e}")
+    finally:
+        _building.discard(project_id)
+
+async def _build_version(project_id: str, project_dir: str, columns: str, joins: str) -> Optional[dict]:
+    # Rows committed after this instant may be missing, so the snapshot counts as built now
+    built_at = time.time()
+    t0 = time.perf_counter()
+    version = uuid.uuid4().hex
+    version_dir = os.path.join(project_dir, version)
+    os.makedirs(version_dir)
+    async with vector_db_connection() as conn:
+        # One consistent view for the count and the rows
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            rows = await conn.fetchval(
+                "SELECT count(*) FROM embeddings WHERE project_id = $1 AND embedding IS NOT NULL",
+                project_id,
+            )
+            if not rows or rows > LOCAL_INDEX_MAX_ROWS:
+                shutil.rmtree(version_dir, ignore_errors=True)
+                metrics.incr("local_index.builds_skipped")
+                return None
+            full = np.lib.format.open_memmap(
+                os.path.join(version_dir, "full.npy"), mode="w+", dtype=np.float32,
+                shape=(rows, EMBEDDING_DIMENSIONS),
+            )
+            offsets = np.zeros(rows + 1, dtype=np.int64)
+            with open(os.path.join(version_dir, "rows.jsonl"), "wb") as rows_file:
+                cursor = await conn.cursor(
+                    f"SELECT {columns}, e.embedding FROM embeddings e {joins} "
+                    "WHERE e.project_id = $1 AND e.embedding IS NOT NULL",
+                    project_id,
+                )
+                written = 0
+                while written < rows:
+                    batch = await cursor.fetch(LOCAL_INDEX_BUILD_BATCH)
+                    if not batch:
+                        break
+                    # Normalising and serialising a batch is CPU work, keep it off the event loop
+                    written = await asyncio.to_thread(_write_batch, batch, full, offsets, rows_file, written)
+    await asyncio.to_thread(_finish_version, version_dir, full, offsets)
+    del full
+    await asyncio.to_thread(_write_coarse, version_dir, rows)
+
+    manifest = {"version": version, "built_at": built_at, "rows": int(rows), "dims": EMBEDDING_DIMENSIONS}
+    manifest_tmp = os.path.join(project_dir, f"manifest.{version}.tmp")
+    with open(manifest_tmp, "w") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(manifest_tmp, os.path.join(project_dir, "manifest.json"))
+
+    # Workers that still map an old version keep it alive until they drop it
+    for entry in os.listdir(project_dir):
+        path = os.path.join(project_dir, entry)
+        if entry != version and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+    metrics.observe("local_index.build", time.perf_counter() - t0)
+    metrics.incr("local_index.builds")
+    return manifest
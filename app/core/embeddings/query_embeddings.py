@@ -1,59 +1,324 @@
-import json
-from app.constants import OPEN_AI_CLIENT
-from app.db.connections import get_vector_db_connection
+import asyncio
+import os
+from typing import Optional
 
+from app.core.codebase.context_packer import pack_chunks, render_chunk
+from app.core.embeddings import local_index
+from app.core.embeddings.embedding_cache import embed_query, embed_queries
+from app.db.chunk_meta import META_COLUMNS, META_JOIN, RENDER_MD5, meta_record, store_chunk_meta
+from app.db.connections import vector_db_connection
+from app.db.lexical_index import HYBRID_RETRIEVAL_ENABLED, lexical_search_sql, lexical_terms
+from app.db.notifications import register_project_listener
+from app.db.vector_index import VECTOR_ANN_ENABLED, VECTOR_ANN_OVERSAMPLE, candidate_search_sql
+from app.utils import background, metrics
+from app.utils.cache import BoundedCache
 
-query_cache = {}
-async def query_vectorDB(project_id: str, query: str, top_k: int = 4, similarity_threshold: float | None = None):
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", 3600))
+CHUNK_CACHE_MAX_BYTES = int(os.getenv("CHUNK_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+# Reciprocal rank fusion constant, the usual 60 keeps one list's top hit from dominating
+RRF_K = int(os.getenv("RRF_K", 60))
+
+# Ranked (id, file_path, distance) rows per (project, query, top_k). Bounded per worker and
+# dropped when the project is re-ingested, see invalidate_project_queries. Rows rather than
+# formatted text so batch lookups can deduplicate chunks across queries.
+query_cache = BoundedCache("query_cache", QUERY_CACHE_MAX_BYTES, ttl_seconds=QUERY_CACHE_TTL_SECONDS)
+# Chunk bodies by chunk id, shared by every query that ranks the chunk
+chunk_cache = BoundedCache("chunk_cache", CHUNK_CACHE_MAX_BYTES, ttl_seconds=QUERY_CACHE_TTL_SECONDS)
+
+# Retrieval is two-phase: ranking only reads these, the body columns are fetched afterwards for
+# the rows that survive the threshold and cross-query deduplication
+RANK_COLUMNS = """
+    id,
+    file_path
+"""
+BODY_COLUMNS = """
+    file_name,
+    summary,
+    document,
+    metadata
+"""
+# Snapshot rows also carry the stored rendering, so a local hit fills chunk_cache without
+# running the tokenizer
+SNAPSHOT_COLUMNS = f"e.id, e.file_path, e.file_name, e.summary, e.document, e.metadata, {META_COLUMNS}"
+BODY_KEYS = ("file_name", "summary", "document", "metadata", "token_count", "language", "title", "display_text")
+
+
+def invalidate_project_queries(project_id: Optional[str]):
+    query_cache.invalidate_project(project_id)
+    chunk_cache.invalidate_project(project_id)
+    local_index.mark_stale(project_id)
+
+register_project_listener(invalidate_project_queries)
+
+
+def _rows_size(rows: list[dict]) -> int:
+    return sum(len(value) for row in rows for value in row.values() if isinstance(value, str)) + 1
+
+async def query_vectorDB(project_id: str, query: str, top_k: int = 4, similarity_threshold: float | None = None,
+                         token_budget: int | None = None):
     """
     Improved query:
-      - caches by project_id + query
-      - uses cosine distance (embedding <=> $2)
+      - caches by project_id + query, concurrent identical lookups share one embedding and SQL call
+      - uses cosine distance (embedding <=> $2), fused with a lexical ranking for identifiers
       - returns structured, numbered entries including filename and similarity score
       - filters by optional distance threshold (lower is more similar)
+      - packs the chunks into token_budget tokens when one is given, see context_packer
     """
-
-    cache_key = f"{project_id}:{query}"
-    if cache_key in query_cache:
-        return query_cache[cache_key]
-
-    # 1) Embed the query
-    embedding_resp = await OPEN_AI_CLIENT.embeddings.create(
-        model="text-embedding-3-large",
-        input=query
+    rows = await query_cache.get_or_load(
+        (project_id, query, top_k),
+        lambda: _search_one(project_id, query, top_k),
+        size_of=_rows_size,
+        project_id=project_id,
     )
-    embed_list = embedding_resp.data[0].embedding
-    if not embed_list:
+    if rows is None:
         return "No embedding generated for query."
+    rows = await hydrate(project_id, _within_threshold(rows, similarity_threshold))
+    if token_budget is not None:
+        rows = pack_chunks(rows, token_budget, query)
+    return format_results(rows, similarity_threshold)
+
+async def query_vectorDB_batch(project_id: str, queries: list[str], top_k: int = 4, similarity_threshold: float | None = None,
+                               token_budget: int | None = None) -> list[str]:
+    """
+    Run several searches against one project with a single embeddings request and a single SQL
+    statement. Returns one formatted result per query, in order, each packed into token_budget
+    when given. A chunk found by several queries is only shown under the query it matched best,
+    and a repeated query is searched once.
+    """
+    unique_queries = list(dict.fromkeys(queries))
+    rows_by_query: dict[str, list[dict] | None] = {}
+    for query in unique_queries:
+        cached = query_cache.get((project_id, query, top_k))
+        if cached is not None:
+            rows_by_query[query] = cached
+
+    missing = [query for query in unique_queries if query not in rows_by_query]
+    if missing:
+        generation = query_cache.generation(project_id)
+        embeddings = await embed_queries(missing)
+        searchable = [(query, embedding) for query, embedding in zip(missing, embeddings)
+                      if embedding is not None and embedding.size]
+        results = await _search_many(project_id, [query for query, _ in searchable],
+                                     [embedding for _, embedding in searchable], top_k)
+        for (query, _), rows in zip(searchable, results):
+            rows_by_query[query] = rows
+            query_cache.set((project_id, query, top_k), rows, _rows_size(rows),
+                            project_id=project_id, generation=generation)
 
-    # convert to pgvector literal string
-    query_embedding = "[" + ",".join(str(x) for x in embed_list) + "]"
+    # Keep each chunk only under the query where it is closest
+    best_query_for_chunk: dict = {}
+    for query, rows in rows_by_query.items():
+        for row in rows or []:
+            distance = row["distance"] if row["distance"] is not None else float("inf")
+            best = best_query_for_chunk.get(row["id"])
+            if best is None or distance < best[1]:
+                best_query_for_chunk[row["id"]] = (query, distance)
+
+    kept_by_query = {
+        query: _within_threshold([row for row in rows if best_query_for_chunk[row["id"]][0] == query], similarity_threshold)
+        for query, rows in rows_by_query.items() if rows is not None
+    }
+    # One hydration query for every surviving chunk of the batch
+    bodies = {row["id"]: row for row in await hydrate(project_id, [row for kept in kept_by_query.values() for row in kept])}
+
+    outputs = []
+    seen_queries = set()
+    for query in queries:
+        if query in seen_queries:
+            outputs.append("Same query as an earlier search in this batch, see its results.")
+            continue
+        seen_queries.add(query)
+        rows = rows_by_query.get(query)
+        if rows is None:
+            outputs.append("No embedding generated for query.")
+            continue
+        kept = [bodies[row["id"]] for row in kept_by_query[query] if row["id"] in bodies]
+        if rows and not any(best_query_for_chunk[row["id"]][0] == query for row in rows):
+            outputs.append("All matches for this query were already returned for another query in this batch.")
+        else:
+            if token_budget is not None:
+                kept = pack_chunks(kept, token_budget, query)
+            outputs.append(format_results(kept, similarity_threshold))
+    return outputs
+
+async def _search_one(project_id: str, query: str, top_k: int) -> list[dict] | None:
+    # 1) Embed the query (cached across workers by model + normalised text)
+    embedding = await embed_query(query)
+    if embedding is None or not embedding.size:
+        return None
 
     # 2) Run DB query using cosine distance (lower = better)
-    conn = await get_vector_db_connection()
-    rows = await conn.fetch(
-        """
-        SELECT
-            id,
-            file_name,
-            file_path,
-            summary,
-            content,
-            document,
-            metadata,
-            (embedding <=> $2::vector) AS distance
-        FROM embeddings
-        WHERE project_id = $1
-        ORDER BY distance ASC
-        LIMIT $3
-        """,
-        project_id, query_embedding, top_k
+    return (await _search_many(project_id, [query], [embedding], top_k))[0]
+
+async def _search_many(project_id: str, queries: list[str], embeddings: list, top_k: int) -> list[list[dict]]:
+    """
+    Ranked (id, file_path, distance) rows for each query. With HYBRID_RETRIEVAL_ENABLED, queries
+    that name identifiers also get a lexical ranking, run concurrently and fused with the vector
+    ranking by reciprocal rank.
+    """
+    terms = [lexical_terms(query) for query in queries] if HYBRID_RETRIEVAL_ENABLED else []
+    if not any(terms):
+        return await _vector_search(project_id, embeddings, top_k)
+    vector_results, lexical_results = await asyncio.gather(
+        _vector_search(project_id, embeddings, top_k),
+        _lexical_search(project_id, embeddings, terms, top_k),
     )
+    return [fuse_rankings(vector_rows, lexical_rows, top_k)
+            for vector_rows, lexical_rows in zip(vector_results, lexical_results)]
+
+async def _vector_search(project_id: str, embeddings: list, top_k: int) -> list[list[dict]]:
+    """Ranked rows for each embedding, one round trip whatever the number of embeddings."""
+    if not embeddings:
+        return []
+    # Hot projects are served from the memory-mapped local snapshot when it is fresh
+    local = await local_index.search(project_id, embeddings, top_k)
+    if local is not None:
+        # The snapshot carries the bodies too, hand them to the hydration cache
+        for rows in local:
+            for row in rows:
+                _cache_body(project_id, row)
+        return [[{"id": row["id"], "file_path": row["file_path"], "distance": row["distance"]} for row in rows]
+                for rows in local]
+    if local_index.wants_snapshot(project_id):
+        background.spawn(local_index.build_snapshot(project_id, SNAPSHOT_COLUMNS, META_JOIN),
+                         name=f"local_index:{project_id}")
+
+    # One VALUES row per query vector; the statement text only depends on the count, so it is
+    # still served from the prepared statement cache
+    values = ", ".join(f"({i}, ${i + 3}::vector)" for i in range(len(embeddings)))
+    if VECTOR_ANN_ENABLED:
+        # HNSW candidates on the halfvec copy, rescored with the full-precision vector
+        search = candidate_search_sql(RANK_COLUMNS, "$1", "q.query_embedding", "$2", f"$2 * {VECTOR_ANN_OVERSAMPLE}")
+    else:
+        search = f"""
+            SELECT {RANK_COLUMNS},
+                (embedding <=> q.query_embedding) AS distance
+            FROM embeddings
+            WHERE project_id = $1
+            ORDER BY embedding <=> q.query_embedding
+            LIMIT $2
+        """
+    async with vector_db_connection() as conn:
+        rows = await conn.fetch(
+            f"""
+            WITH q(ord, query_embedding) AS (VALUES {values})
+            SELECT q.ord, e.*
+            FROM q
+            CROSS JOIN LATERAL ({search}) e
+            ORDER BY q.ord, e.distance
+            """,
+            project_id, top_k, *embeddings
+        )
+
+    results: list[list[dict]] = [[] for _ in embeddings]
+    for r in rows:
+        row = dict(r)
+        results[row.pop("ord")].append(row)
+    return results
+
+async def _lexical_search(project_id: str, embeddings: list, terms: list[str | None], top_k: int) -> list[list[dict]]:
+    """Rows matching each query's identifier terms, with lexical_rank and the vector distance."""
+    results: list[list[dict]] = [[] for _ in embeddings]
+    wanted = [i for i, query_terms in enumerate(terms) if query_terms]
+    values = ", ".join(f"({i}, ${2 * n + 3}::vector, ${2 * n + 4}::text)" for n, i in enumerate(wanted))
+    args = [value for i in wanted for value in (embeddings[i], terms[i])]
+    search = lexical_search_sql(RANK_COLUMNS, "$1", "q.query_embedding", "q.terms", "$2")
+    try:
+        async with vector_db_connection() as conn:
+            rows = await conn.fetch(
+                f"""
+                WITH q(ord, query_embedding, terms) AS (VALUES {values})
+                SELECT q.ord, l.*
+                FROM q
+                CROSS JOIN LATERAL ({search}) l
+                """,
+                project_id, top_k, *args
+            )
+    except Exception as e:
+        # The vector ranking alone is still a usable answer
+        print(f"An error occurred during lexical search: {e}")
+        return results
+    for r in rows:
+        row = dict(r)
+        results[row.pop("ord")].append(row)
+    return results
+
+def fuse_rankings(vector_rows: list[dict], lexical_rows: list[dict], top_k: int) -> list[dict]:
+    """Reciprocal rank fusion of the two rankings of one query, top_k rows, best first."""
+    scores: dict = {}
+    fused: dict = {}
+    for rank, row in enumerate(vector_rows, start=1):
+        scores[row["id"]] = scores.get(row["id"], 0.0) + 1.0 / (RRF_K + rank)
+        fused[row["id"]] = row
+    for row in lexical_rows:
+        scores[row["id"]] = scores.get(row["id"], 0.0) + 1.0 / (RRF_K + row["lexical_rank"])
+        fused.setdefault(row["id"], {"id": row["id"], "file_path": row["file_path"], "distance": row["distance"]})
+    ranked = sorted(fused.values(), key=lambda row: (-scores[row["id"]], row["distance"] if row["distance"] is not None else float("inf")))
+    vector_ids = {row["id"] for row in vector_rows}
+    metrics.incr("retrieval.lexical_only_hits", sum(1 for row in ranked[:top_k] if row["id"] not in vector_ids))
+    return ranked[:top_k]
+
+def _within_threshold(rows: list[dict], similarity_threshold: float | None) -> list[dict]:
+    return [row for row in rows if row["distance"] is not None
+            and (similarity_threshold is None or row["distance"] <= similarity_threshold)]
 
+def _cache_body(project_id: str, row: dict):
+    # Rows the snapshot holds no valid render for are left to hydrate, which reads the stored one
+    if row["id"] in chunk_cache or row.get("display_text") is None:
+        return
+    body = {key: row.get(key) for key in BODY_KEYS}
+    chunk_cache.set(row["id"], body, _rows_size([body]), project_id=project_id)
+
+async def hydrate(project_id: str, ranked: list[dict]) -> list[dict]:
+    """
+    Ranked rows joined with their bodies and rendering, in order. Bodies come from chunk_cache or
+    one ANY() query that also reads the stored rendering from embedding_chunk_meta.
+    """
+    bodies = {}
+    missing = []
+    for row in ranked:
+        body = chunk_cache.get(row["id"])
+        if body is not None:
+            bodies[row["id"]] = body
+        elif row["id"] not in missing:
+            missing.append(row["id"])
+
+    if missing:
+        generation = chunk_cache.generation(project_id)
+        async with vector_db_connection() as conn:
+            fetched = await conn.fetch(
+                f"""
+                SELECT e.id, e.file_path, e.file_name, e.summary, e.document, e.metadata, {META_COLUMNS},
+                    {RENDER_MD5} AS render_md5
+                FROM embeddings e
+                {META_JOIN}
+                WHERE e.project_id = $1 AND e.id = ANY($2)
+                """,
+                project_id, missing,
+            )
+        unrendered = []
+        for r in fetched:
+            body = dict(r)
+            chunk_id = body.pop("id")
+            file_path = body.pop("file_path")
+            render_md5 = body.pop("render_md5")
+            if body["display_text"] is None:
+                # Not rendered yet or rendered from older inputs
+                body.update(render_chunk(dict(body, file_path=file_path)))
+                unrendered.append(meta_record(chunk_id, project_id, render_md5, body))
+            bodies[chunk_id] = body
+            chunk_cache.set(chunk_id, body, _rows_size([body]), project_id=project_id, generation=generation)
+        if unrendered:
+            metrics.incr("chunk_meta.rendered_on_read", len(unrendered))
+            background.spawn(store_chunk_meta(unrendered), name="chunk_meta.store")
+
+    # A chunk deleted between ranking and hydration is dropped
+    return [dict(bodies[row["id"]], **row) for row in ranked if row["id"] in bodies]
+
+def format_results(rows: list[dict], similarity_threshold: float | None = None) -> str:
     if not rows:
-        output = "No relevant codebase content found for the generated query."
-        query_cache[cache_key] = output
-        return output
+        return "No relevant codebase content found for the generated query."
 
     # 3) Filter by threshold (if provided) and build nicely formatted output
     entries = []
@@ -65,32 +330,12 @@ async def query_vectorDB(project_id: str, query: str, top_k: int = 4, similarity
         if similarity_threshold is not None and dist > similarity_threshold:
             continue
 
-        # metadata may be stored as JSON string
-        meta = r['metadata']
-        if isinstance(meta, str):
-            try:
-                meta_obj = json.loads(meta)
-            except Exception:
-                meta_obj = None
-        else:
-            meta_obj = meta
-
-        fname = meta_obj.get("file_name") if meta_obj and meta_obj.get("file_name") else r.get("file_name") or "unknown"
-        fpath = meta_obj.get("file_path") if meta_obj and meta_obj.get("file_path") else r.get("file_path") or "unknown"
-        summary = r.get("summary") or (meta_obj.get("summary") if meta_obj else "") or ""
-        document = r.get("document") or ""
-
-        if any(token in document for token in ["def ", "class ", "import ", "{", "=>", ";"]):
-            code_block = f"```py\n{document}\n```"
-            content_display = code_block
-        else:
-            content_display = document
-
+        # Title and display text are rendered once per chunk, see app.db.chunk_meta
+        rendered = r if r.get("display_text") is not None else render_chunk(r)
         entries.append(
-            f"Document {i+1} — File: {fname} (path: {fpath})\n"
+            f"Document {i+1} — {rendered['title']}\n"
             f"Similarity distance (lower=better): {dist:.4f}\n"
-            f"Summary: {summary}\n\n"
-            f"Content:\n{content_display}"
+            f"{rendered['display_text']}"
         )
 
     if not entries:
@@ -98,6 +343,4 @@ async def query_vectorDB(project_id: str, query: str, top_k: int = 4, similarity
     else:
         output = "\n\n---\n\n".join(entries)
 
-    # cache by project+query
-    query_cache[cache_key] = output
     return output
\ No newline at end of file
@@ -1,282 +1,177 @@
-from app.db.connections import get_db_connection
+from app.db.connections import db_connection
+from app.db.schema import user_key
+from app.db.write_behind import WRITE_BEHIND
 
 
-async def create_user_conversation_table(email: str):
-    conn = None
-    try:
-        conn = await get_db_connection()
-        
-        table_name = f"conversations_{email.replace('@', '_').replace('.', '_')}"
-        create_table_query = f"""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                id SERIAL PRIMARY KEY,
-                project_id TEXT NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """
-        
-        await conn.execute(create_table_query)
-
-    except Exception as e:
-        print(f"An error occurred while creating the table: {e}")
-    finally:
-        if conn:
-            await conn.close()
+async def queue_turn_in_db(email: str, project_id: str, messages: list[tuple[str, str]]):
+    """Queue the (role, content) messages of one turn as a unit, so they are stored in order."""
+    key = user_key(email)
+    await WRITE_BEHIND.enqueue_many("conversation", [(key, project_id, role, content) for role, content in messages])
 
-async def store_conversation_in_db(email: str, project_id: str, role: str, content: str):
-    conn = None
+async def get_conversation_history_from_db(email: str, project_id: str) -> list[dict]:
     try:
-        conn = await get_db_connection()
-        
-        await create_user_conversation_table(email)
-        
-        table_name = f"conversations_{email.replace('@', '_').replace('.', '_')}"
-        insert_query = f"""
-            INSERT INTO {table_name} (project_id, role, content)
-            VALUES ($1, $2, $3)
+        select_query = """
+            SELECT id, role, content
+            FROM (
+                SELECT id, role, content, created_at
+                FROM conversation_messages
+                WHERE user_key = $1 AND project_id = $2
+                ORDER BY created_at DESC, id DESC
+                LIMIT 10
+            ) recent_messages
+            ORDER BY created_at ASC, id ASC
         """
-        
-        await conn.execute(insert_query, project_id, role, content)
 
-    except Exception as e:
-        print(f"An error occurred while storing the conversation: {e}")
-    finally:
-        if conn:
-            await conn.close()
-
-async def get_conversation_history_from_db(email: str, project_id: str) -> list[dict[str, str]]:
-    conn = None
-    try:
-        conn = await get_db_connection()
-        
-        table_name = f"conversations_{email.replace('@', '_').replace('.', '_')}"
-        
-        # Check if the table exists
-        table_exists = await conn.fetchval("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = $1
-            )
-        """, table_name)
-        
-        if not table_exists:
-            # If the table doesn't exist, create it
-            await create_user_conversation_table(email)
-
-
-        select_query = f"""
-            WITH ranked_messages AS (
-                SELECT role, content, created_at,
-                       ROW_NUMBER() OVER (ORDER BY created_at DESC) as row_num
-                FROM {table_name}
-                WHERE project_id = $1
-            )
-            SELECT role, content
-            FROM ranked_messages
-            WHERE row_num <= 10
-            ORDER BY created_at ASC
-        """
-        
-        results = await conn.fetch(select_query, project_id)
-        return [{"role": row["role"], "content": row["content"]} for row in results]
+        async with db_connection() as conn:
+            results = await conn.fetch(select_query, user_key(email), project_id)
+        return [{"id": row["id"], "role": row["role"], "content": row["content"]} for row in results]
 
     except Exception as e:
         print(f"An error occurred while retrieving the conversation: {e}")
         return []
-    finally:
-        if conn:
-            await conn.close()
 
-async def create_user_pin_table(email: str):
-    conn = None
+async def get_messages_between(email: str, project_id: str, after_id: int, up_to_id: int, limit: int) -> list[dict]:
+    """The newest `limit` messages with after_id < id <= up_to_id, oldest first."""
+    select_query = """
+        SELECT id, role, content
+        FROM conversation_messages
+        WHERE user_key = $1 AND project_id = $2 AND id > $3 AND id <= $4
+        ORDER BY id DESC
+        LIMIT $5
+    """
+
+    async with db_connection() as conn:
+        results = await conn.fetch(select_query, user_key(email), project_id, after_id, up_to_id, limit)
+    return [{"id": row["id"], "role": row["role"], "content": row["content"]} for row in reversed(results)]
+
+async def get_rolling_summary_from_db(email: str, project_id: str) -> tuple[str, int]:
+    """(summary, id of the last message it covers); ("", 0) for a conversation not summarized yet."""
     try:
-        conn = await get_db_connection()
-        
-        table_name = f"pins_{email.replace('@', '_').replace('.', '_')}"
-        create_table_query = f"""
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                id SERIAL PRIMARY KEY,
-                project_id TEXT NOT NULL,
-                topic_name TEXT NOT NULL,
-                pin_content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+        select_query = """
+            SELECT summary, last_message_id FROM conversation_summaries
+            WHERE user_key = $1 AND project_id = $2
         """
-        
-        await conn.execute(create_table_query)
+
+        async with db_connection() as conn:
+            row = await conn.fetchrow(select_query, user_key(email), project_id)
+        if row is None:
+            return "", 0
+        return row["summary"], row["last_message_id"]
 
     except Exception as e:
-        print(f"An error occurred while creating the pin table: {e}")
-    finally:
-        if conn:
-            await conn.close()
+        print(f"An error occurred while retrieving the conversation summary: {e}")
+        return "", 0
+
+async def store_rolling_summary_in_db(email: str, project_id: str, summary: str, last_message_id: int):
+    upsert_query = """
+        INSERT INTO conversation_summaries (user_key, project_id, last_message_id, summary)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (user_key, project_id) DO UPDATE
+        SET last_message_id = EXCLUDED.last_message_id, summary = EXCLUDED.summary, updated_at = CURRENT_TIMESTAMP
+        -- Another worker may have folded further already
+        WHERE conversation_summaries.last_message_id < EXCLUDED.last_message_id
+    """
+
+    async with db_connection() as conn:
+        await conn.execute(upsert_query, user_key(email), project_id, last_message_id, summary)
 
 async def create_pin_in_db(email: str, project_id: str, topic_name: str, pin_content: str):
-    conn = None
     try:
-        conn = await get_db_connection()
-        
-        await create_user_pin_table(email)
-        
-        table_name = f"pins_{email.replace('@', '_').replace('.', '_')}"
-        insert_query = f"""
-            INSERT INTO {table_name} (project_id, topic_name, pin_content)
-            VALUES ($1, $2, $3)
+        # Written synchronously: the user may list or delete the pin right away
+        insert_query = """
+            INSERT INTO project_pins (user_key, project_id, topic_name, pin_content)
+            VALUES ($1, $2, $3, $4)
         """
-        
-        await conn.execute(insert_query, project_id, topic_name, pin_content)
+
+        async with db_connection() as conn:
+            await conn.execute(insert_query, user_key(email), project_id, topic_name, pin_content)
 
     except Exception as e:
         print(f"An error occurred while storing the pin: {e}")
-    finally:
-        if conn:
-            await conn.close()
 
 async def delete_pin_from_db(email: str, pin_id: int):
-    conn = None
     try:
-        conn = await get_db_connection()
-        
-        # Construct the table name using the user's email
-        table_name = f"pins_{email.replace('@', '_').replace('.', '_')}"
-        
-        # Prepare the delete query for the specific pin by id
-        delete_query = f"DELETE FROM {table_name} WHERE id = $1"
-        
-        # Execute the delete query
-        result = await conn.execute(delete_query, pin_id)
-        
-        # Check if a record was deleted
-        if result == "DELETE 0":
-            print(f"No pin with id {pin_id} found for user {email}")
-            raise Exception(f"No pin with id {pin_id} found for user {email}")
+        async with db_connection() as conn:
+            # Prepare the delete query for the specific pin by id
+            delete_query = "DELETE FROM project_pins WHERE user_key = $1 AND id = $2"
+
+            # Execute the delete query
+            result = await conn.execute(delete_query, user_key(email), pin_id)
+
+            # Check if a record was deleted
+            if result == "DELETE 0":
+                print(f"No pin with id {pin_id} found for user {email}")
+                raise Exception(f"No pin with id {pin_id} found for user {email}")
 
     except Exception as e:
         print(f"An error occurred while deleting the pin: {e}")
-    finally:
-        if conn:
-            await conn.close()
 
 async def get_pins_from_db(email: str, project_id: str):
-    conn = None
     try:
-        conn = await get_db_connection()
-        
-        # Construct the table name using the user's email
-        table_name = f"pins_{email.replace('@', '_').replace('.', '_')}"
-        
-        # Prepare the select query to fetch pins based on project_id
-        select_query = f"SELECT * FROM {table_name} WHERE project_id = $1"
-        
-        # Execute the query and fetch results
-        pins = await conn.fetch(select_query, project_id)
-        
-        return pins
+        async with db_connection() as conn:
+            # Prepare the select query to fetch pins based on project_id
+            select_query = """
+                SELECT id, project_id, topic_name, pin_content, created_at
+                FROM project_pins
+                WHERE user_key = $1 AND project_id = $2
+            """
 
-    except Exception as e:
-        print(f"An error occurred while fetching the pins: {e}")
-        return None
-    finally:
-        if conn:
-            await conn.close()
+            # Execute the query and fetch results
+            pins = await conn.fetch(select_query, user_key(email), project_id)
 
-async def create_assistants_table():
-    conn = None
-    try:
-        conn = await get_db_connection()
-        
-        create_table_query = """
-            CREATE TABLE IF NOT EXISTS assistants_table (
-                id SERIAL PRIMARY KEY,
-                project_id TEXT NOT NULL,
-                assistant_name TEXT NOT NULL,
-                thread_id TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE (project_id, assistant_name)
-            )
-        """
-        
-        await conn.execute(create_table_query)
+            return pins
 
     except Exception as e:
-        print(f"An error occurred while creating the assistants table: {e}")
-    finally:
-        if conn:
-            await conn.close()
+        print(f"An error occurred while fetching the pins: {e}")
+        return None
 
 async def insert_new_thread(project_id: str, assistant_name: str, thread_id: str):
-    conn = None
     try:
-        conn = await get_db_connection()
-
-        insert_query = """
-            INSERT INTO assistants_table (project_id, assistant_name, thread_id)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (project_id, assistant_name)
-            DO NOTHING
-        """
+        async with db_connection() as conn:
+            insert_query = """
+                INSERT INTO assistants_table (project_id, assistant_name, thread_id)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (project_id, assistant_name)
+                DO NOTHING
+            """
 
-        await conn.execute(insert_query, project_id, assistant_name, thread_id)
-        print("New thread inserted successfully.")
+            await conn.execute(insert_query, project_id, assistant_name, thread_id)
+            print("New thread inserted successfully.")
 
     except Exception as e:
         print(f"An error occurred while inserting the new thread: {e}")
-    finally:
-        if conn:
-            await conn.close()
 
 async def get_thread(project_id: str, assistant_name: str):
-    conn = None
     try:
-        conn = await get_db_connection()
-        await create_assistants_table()
+        async with db_connection() as conn:
+            query_check_thread = """
+                SELECT thread_id FROM assistants_table 
+                WHERE project_id = $1 AND assistant_name = $2
+            """
 
-        query_check_thread = """
-            SELECT thread_id FROM assistants_table 
-            WHERE project_id = $1 AND assistant_name = $2
-        """
-        
-        row = await conn.fetchrow(query_check_thread, project_id, assistant_name)
-        
-        if row and row['thread_id']:
-            return row['thread_id']
-        else:
-            return "thread does not exist"
+            row = await conn.fetchrow(query_check_thread, project_id, assistant_name)
+
+            if row and row['thread_id']:
+                return row['thread_id']
+            else:
+                return "thread does not exist"
 
     except Exception as e:
         print(f"An error occurred while fetching the thread: {e}")
-    finally:
-        if conn:
-            await conn.close()
 
 async def update_thread_id(project_id: str, thread_id: str, assistant_name: str):
-    conn = None
     try:
-        conn = await get_db_connection()
-        await create_assistants_table()
-
-        query_update_thread = """
-            UPDATE assistants_table
-            SET thread_id = $1
-            WHERE project_id = $2 AND assistant_name = $3
-        """
-
-        # Use 'execute' and then fetch the number of rows affected
-        result = await conn.execute(query_update_thread, thread_id, project_id, assistant_name)
-
-        # The execute result typically returns a string like 'UPDATE <number>'
-        affected_rows = result.split()[-1]
-
-        if affected_rows == '0':
-            await insert_new_thread(project_id, assistant_name, thread_id)
-            print("No existing thread. New thread created.")
-        else:
+        async with db_connection() as conn:
+            # Insert or overwrite in one statement instead of UPDATE followed by INSERT
+            upsert_thread = """
+                INSERT INTO assistants_table (project_id, assistant_name, thread_id)
+                VALUES ($2, $3, $1)
+                ON CONFLICT (project_id, assistant_name)
+                DO UPDATE SET thread_id = EXCLUDED.thread_id
+            """
+
+            await conn.execute(upsert_thread, thread_id, project_id, assistant_name)
             print("Thread ID updated successfully.")
 
     except Exception as e:
         print(f"An error occurred while updating the thread ID: {e}")
-    finally:
-        if conn:
-            await conn.close()
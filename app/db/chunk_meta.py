@@ -0,0 +1,128 @@
+"""
+Per-chunk render of the embeddings table, kept in embedding_chunk_meta (created by
+bootstrap_vector_schema): token count, fence language, title and display text as the chat prompt
+shows them. Hydration reads them with META_JOIN so a request does not parse metadata, detect
+languages or run a tokenizer for chunks that have been rendered once.
+
+A row is only valid for the inputs it was rendered from: render_md5 hashes every column the
+render reads (summary, file_path, file_name, metadata, document), so a re-ingest that changes any
+of them invalidates it. The hash is only ever computed by Postgres (RENDER_MD5), which keeps the
+text form of metadata identical on both sides. Rows missing or stale at read time are rendered by
+the request and stored in the background; the ingestion pipeline can call store_chunk_meta right
+after inserting chunks, and `backfill` fills existing projects.
+
+    python -m app.db.chunk_meta backfill [--project-id P] [--batch-size 500]
+    python -m app.db.chunk_meta prune      # drop rows of chunks that no longer exist
+"""
+import argparse
+import asyncio
+
+from asyncpg import Connection
+
+from app.core.codebase.context_packer import render_chunk
+from app.db.connections import init_db_pools, close_db_pools, vector_db_connection
+
+META_COLUMNS = "m.token_count, m.language, m.title, m.display_text"
+# Hash of every render input of `embeddings e`, unit-separated
+RENDER_MD5 = """
+    md5(concat_ws(chr(31),
+        coalesce(e.summary::text, ''), coalesce(e.file_path::text, ''), coalesce(e.file_name::text, ''),
+        coalesce(e.metadata::text, ''), coalesce(e.document::text, '')))
+"""
+# Joins `embeddings e` to its still valid render, if any
+META_JOIN = f"""
+    LEFT JOIN embedding_chunk_meta m
+      ON m.chunk_id = e.id AND m.render_md5 = {RENDER_MD5}
+"""
+
+UPSERT_STATEMENT = """
+    INSERT INTO embedding_chunk_meta
+        (chunk_id, project_id, render_md5, token_count, language, title, display_text, updated_at)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, NOW())
+    ON CONFLICT (chunk_id) DO UPDATE SET
+        project_id = EXCLUDED.project_id,
+        render_md5 = EXCLUDED.render_md5,
+        token_count = EXCLUDED.token_count,
+        language = EXCLUDED.language,
+        title = EXCLUDED.title,
+        display_text = EXCLUDED.display_text,
+        updated_at = NOW()
+"""
+
+
+def meta_record(chunk_id, project_id: str, render_md5: str, rendered: dict) -> tuple:
+    """render_md5 is RENDER_MD5 selected with the row the render was made from."""
+    return (
+        chunk_id, project_id, render_md5, rendered["token_count"],
+        rendered["language"], rendered["title"], rendered["display_text"],
+    )
+
+async def store_chunk_meta(records: list[tuple]):
+    """Upsert meta_record tuples."""
+    if not records:
+        return
+    try:
+        async with vector_db_connection() as conn:
+            await conn.executemany(UPSERT_STATEMENT, records)
+    except Exception as e:
+        print(f"An error occurred while storing chunk meta: {e}")
+
+async def backfill(conn: Connection, project_id: str | None, batch_size: int):
+    total = 0
+    last_id = None
+    while True:
+        # Keyset on id, so a chunk whose render does not stick is not picked up again
+        rows = await conn.fetch(
+            f"""
+            SELECT e.id, e.project_id, e.file_name, e.file_path, e.summary, e.document, e.metadata,
+                {RENDER_MD5} AS render_md5
+            FROM embeddings e
+            {META_JOIN}
+            WHERE m.chunk_id IS NULL AND ($1::text IS NULL OR e.project_id = $1)
+              AND ($3::boolean OR e.id > $4)
+            ORDER BY e.id
+            LIMIT $2
+            """,
+            project_id, batch_size, last_id is None, last_id,
+        )
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        # Rendering is CPU bound, keep the event loop (and the connection's keepalive) responsive
+        records = await asyncio.to_thread(
+            lambda: [meta_record(row["id"], row["project_id"], row["render_md5"], render_chunk(dict(row))) for row in rows]
+        )
+        await conn.executemany(UPSERT_STATEMENT, records)
+        total += len(records)
+        print(f"rendered {total} chunks")
+    print(f"backfill done, {total} chunks")
+
+async def prune(conn: Connection):
+    result = await conn.execute(
+        """
+        DELETE FROM embedding_chunk_meta m
+        WHERE NOT EXISTS (SELECT 1 FROM embeddings e WHERE e.id = m.chunk_id)
+        """
+    )
+    print(f"pruned {result.split()[-1]} rows")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("step", choices=["backfill", "prune"])
+    parser.add_argument("--project-id")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    await init_db_pools()
+    try:
+        async with vector_db_connection() as conn:
+            if args.step == "backfill":
+                await backfill(conn, args.project_id, args.batch_size)
+            else:
+                await prune(conn)
+    finally:
+        await close_db_pools()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,142 +1,99 @@
 import json
 from typing import Optional, List, Dict
 
-from asyncpg import Connection
-from app.db.connections import get_db_connection, get_vector_db_connection
+from app.db.connections import db_connection, vector_db_connection
+from app.db.schema import user_key
+from app.db.summary_repository import (
+    load_project_summary, load_summary_variant, invalidate_project_summary, summary_variants,
+    SUMMARY_VARIANT_COLUMNS,
+)
 from app.utils.path_utils import encode_path, decode_path
 
 async def store_summary_in_db(emails: str, project_id: str, summary: str, status: str, executive_summary: str, project_diagrams: str):
-    conn: Optional[Connection] = None
     try:
-        conn = await get_db_connection()
         email_list = json.loads(emails)
+        user_keys = [user_key(email_info['email']) for email_info in email_list]
+
+        # Budgeted copies for the chat path, computed once here instead of on every turn
+        variants = await summary_variants(summary)
+
+        # One statement covers every collaborator of the project
+        variant_assignments = ",\n            ".join(
+            f"{column} = ${i}" for i, column in enumerate(SUMMARY_VARIANT_COLUMNS, start=7)
+        )
+        update_query = f"""
+            UPDATE project_summaries
+            SET summary = $2,
+            status = $3,
+            executive_summary = $4,
+            project_diagrams = $5,
+            {variant_assignments},
+            updated_at = CURRENT_TIMESTAMP
+            WHERE project_id = $1 AND user_key = ANY($6::text[]);
+        """
 
-        for email_info in email_list:
-            email = email_info['email'].replace('@', '_').replace('.', '_')
-            table_name = f"summaries_{email}"
-            update_query = f"""
-                UPDATE {table_name}
-                SET summary = $2,
-                status = $3,
-                executive_summary = $4,
-                project_diagrams = $5
-                WHERE project_id = $1;
-            """
-            
-            await conn.execute(update_query, project_id, summary, status, executive_summary, project_diagrams)
+        async with db_connection() as conn:
+            await conn.execute(update_query, project_id, summary, status, executive_summary, project_diagrams, user_keys,
+                               *(variants[column] for column in SUMMARY_VARIANT_COLUMNS))
+
+        # Other workers are told by the project_summaries trigger, this worker drops its copy right away
+        invalidate_project_summary(project_id)
 
     except Exception as e:
         print(f"An error occurred while storing the summary: {e}")
-    
-    finally:
-        if conn:
-            await conn.close()
 
 async def get_summary_from_db(email: str, project_id: str) -> Optional[str]:
-    conn = None
     try:
-        conn = await get_db_connection()
-        
-        table_name = f"summaries_{email.replace('@', '_').replace('.', '_')}"
-        select_query = f"""
-            SELECT summary FROM {table_name}
-            WHERE project_id = $1
-            ORDER BY created_at DESC
-            LIMIT 1
-        """
-        
-        result = await conn.fetchrow(select_query, project_id)
-        return result['summary'] if result else None
+        record = await load_project_summary(email, project_id)
+        return record['summary'] if record else None
 
     except Exception as e:
         print(f"An error occurred while retrieving the summary: {e}")
         return None
-    finally:
-        if conn:
-            await conn.close()
+
+async def get_chat_summary_from_db(email: str, project_id: str) -> Optional[str]:
+    """The summary cut to the chat prompt's budget, see SUMMARY_VARIANTS."""
+    try:
+        return await load_summary_variant(email, project_id, "summary_chat")
+
+    except Exception as e:
+        print(f"An error occurred while retrieving the chat summary: {e}")
+        return None
 
 async def get_executive_summary_from_db(email: str, project_id: str) -> Optional[str]:
-    conn = None
     try:
-        conn = await get_db_connection()
-        
-        table_name = f"summaries_{email.replace('@', '_').replace('.', '_')}"
-        select_query = f"""
-            SELECT  executive_summary FROM {table_name}
-            WHERE project_id = $1
-            ORDER BY created_at DESC
-            LIMIT 1
-        """
-        
-        result = await conn.fetchrow(select_query, project_id)
-        return result['executive_summary'] if result else None
+        record = await load_project_summary(email, project_id)
+        return record['executive_summary'] if record else None
 
     except Exception as e:
         print(f"An error occurred while retrieving the executive_summary: {e}")
         return None
-    
-    finally:
-        if conn:
-            await conn.close()
 
 async def get_project_diagrams_from_db(email: str, project_id: str) -> Optional[str]:
-    conn = None
     try:
-        conn = await get_db_connection()
-        
-        table_name = f"summaries_{email.replace('@', '_').replace('.', '_')}"
-        select_query = f"""
-            SELECT  project_diagrams FROM {table_name}
-            WHERE project_id = $1
-            ORDER BY created_at DESC
-            LIMIT 1
-        """
-        
-        result = await conn.fetchrow(select_query, project_id)
-        return result['project_diagrams'] if result else None
+        record = await load_project_summary(email, project_id)
+        return record['project_diagrams'] if record else None
 
     except Exception as e:
         print(f"An error occurred while retrieving the project_diagrams: {e}")
         return None
-    
-    finally:
-        if conn:
-            await conn.close()
-
-async def ensure_context_summaries_table_exists(conn: Connection):
-    create_table_query = """
-    CREATE TABLE IF NOT EXISTS context_summaries (
-        project_id VARCHAR PRIMARY KEY,
-        full_summaries TEXT
-    );
-    """
-    await conn.execute(create_table_query)
 
 async def insert_or_update_summary_in_context_summaries(project_id: str, full_summaries: str) -> None:
-    conn: Optional[Connection] = None
     try:
-        conn = await get_db_connection()
-        
-        # Ensure the table exists
-        await ensure_context_summaries_table_exists(conn)
-        
-        # Use an upsert query to insert or update
-        upsert_query = """
-        INSERT INTO context_summaries (project_id, full_summaries)
-        VALUES ($1, $2)
-        ON CONFLICT (project_id) DO UPDATE 
-        SET full_summaries = EXCLUDED.full_summaries;
-        """
-        
-        # Execute the upsert query
-        await conn.execute(upsert_query, project_id, full_summaries)
+        async with db_connection() as conn:
+            # Use an upsert query to insert or update
+            upsert_query = """
+            INSERT INTO context_summaries (project_id, full_summaries)
+            VALUES ($1, $2)
+            ON CONFLICT (project_id) DO UPDATE 
+            SET full_summaries = EXCLUDED.full_summaries;
+            """
+
+            # Execute the upsert query
+            await conn.execute(upsert_query, project_id, full_summaries)
 
     except Exception as e:
         print(f"An error occurred while inserting or updating the summary: {e}")
-    
-    finally:
-        if conn:
-            await conn.close()
 
 async def get_files_list(project_id: str) -> List[Dict[str, str]]:
     """
@@ -152,25 +109,23 @@ async def get_files_list(project_id: str) -> List[Dict[str, str]]:
             - summary_snippet: a concise snippet from file summary or content.
         If no embeddings are found, returns an empty list.
     """
-    conn = None
     try:
-        conn = await get_vector_db_connection()
-
-        # Step 1: Check if any embeddings exist for this project
-        count_query = "SELECT COUNT(*) FROM embeddings WHERE project_id = $1"
-        embeddings_count = await conn.fetchval(count_query, project_id)
-        if embeddings_count == 0:
-            # No embeddings found for the project, return empty list
-            return []
-
-        # Step 2: Retrieve file details
-        files_query = """
-            SELECT file_path, file_name, summary, content
-            FROM embeddings
-            WHERE project_id = $1
-            ORDER BY file_path ASC
-        """
-        records = await conn.fetch(files_query, project_id)
+        async with vector_db_connection() as conn:
+            # Step 1: Check if any embeddings exist for this project
+            count_query = "SELECT COUNT(*) FROM embeddings WHERE project_id = $1"
+            embeddings_count = await conn.fetchval(count_query, project_id)
+            if embeddings_count == 0:
+                # No embeddings found for the project, return empty list
+                return []
+
+            # Step 2: Retrieve file details
+            files_query = """
+                SELECT file_path, file_name, summary, content
+                FROM embeddings
+                WHERE project_id = $1
+                ORDER BY file_path ASC
+            """
+            records = await conn.fetch(files_query, project_id)
 
         result = []
         for record in records:
@@ -205,24 +160,17 @@ async def get_files_list(project_id: str) -> List[Dict[str, str]]:
         print(f"Error in get_files_list for project_id={project_id}: {str(e)}")
         return []
 
-    finally:
-        if conn:
-            await conn.close()
-            
 async def get_file_summary(project_id: str, file_id: str) -> str:
     """
     Retrieve the latest content or summary for a specific file in a project
     from the embeddings table, filtered by project_id and file_path.
     """
-    conn = None
     try:
         try:
             file_path = decode_path(file_id)
         except ValueError as dec_e:
             print(f"Error decoding file_id '{file_id}': {dec_e}")
             return f"Error: Invalid file ID format."
-        
-        conn = await get_vector_db_connection()
 
         query = """
             SELECT content, summary, metadata
@@ -232,8 +180,8 @@ async def get_file_summary(project_id: str, file_id: str) -> str:
             LIMIT 1
         """
 
-        file_path = file_path
-        row = await conn.fetchrow(query, project_id, file_path)
+        async with vector_db_connection() as conn:
+            row = await conn.fetchrow(query, project_id, file_path)
 
         if row:
             # Return a dictionary containing both fields.
@@ -248,7 +196,3 @@ async def get_file_summary(project_id: str, file_id: str) -> str:
     except Exception as e:
         print(f"Error in get_file_content_or_summary: {e}")
         return f"Error: {e}"
-
-    finally:
-        if conn:
-            await conn.close()
\ No newline at end of file
@@ -1,6 +1,12 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
+from typing import Optional
+
 import asyncpg
 
+from app.db.vector_codec import register_vector_codecs
+
 
 VECTOR_DB_PARAMS = {
     'database': os.environ.get('DB_VECTOR'),
@@ -18,8 +24,101 @@ CORE_DB_PARAMS = {
     'port': os.environ.get('DB_PORT')
 }
 
-async def  get_vector_db_connection():
-    return await asyncpg.connect(**VECTOR_DB_PARAMS)
+# Pool sizing is per uvicorn worker, so the server-side total is roughly
+# workers * (core max + vector max). Keep that well under max_connections.
+POOL_SETTINGS = {
+    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+    'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+    'statement_cache_size': int(os.getenv('DB_STATEMENT_CACHE_SIZE', 256)),
+    'max_inactive_connection_lifetime': float(os.getenv('DB_POOL_MAX_IDLE_SECONDS', 300)),
+    'command_timeout': float(os.getenv('DB_COMMAND_TIMEOUT_SECONDS', 60)),
+}
+# pgvector HNSW search settings for every vector connection. Iterative scans (pgvector >= 0.8)
+# keep the project_id filter from starving the index scan of candidates.
+VECTOR_SERVER_SETTINGS = {
+    'hnsw.ef_search': os.getenv('VECTOR_HNSW_EF_SEARCH', '100'),
+    'hnsw.iterative_scan': os.getenv('VECTOR_HNSW_ITERATIVE_SCAN', 'relaxed_order'),
+}
+POOL_ACQUIRE_TIMEOUT = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT_SECONDS', 10))
+POOL_CLOSE_TIMEOUT = float(os.getenv('DB_POOL_CLOSE_TIMEOUT_SECONDS', 10))
+
+_core_pool: Optional[asyncpg.Pool] = None
+_vector_pool: Optional[asyncpg.Pool] = None
+
+
+async def init_db_pools():
+    """Create both pools. Called once from the FastAPI lifespan of combined_app."""
+    global _core_pool, _vector_pool
+    if _core_pool is None:
+        _core_pool = await asyncpg.create_pool(**CORE_DB_PARAMS, **POOL_SETTINGS)
+    if _vector_pool is None:
+        # Vectors travel in pgvector's binary format on every vector connection
+        _vector_pool = await asyncpg.create_pool(
+            **VECTOR_DB_PARAMS, **POOL_SETTINGS, init=register_vector_codecs,
+            server_settings=VECTOR_SERVER_SETTINGS,
+        )
+
+async def close_db_pools():
+    """Close both pools, waiting for checked-out connections to be released."""
+    global _core_pool, _vector_pool
+    for pool in (_core_pool, _vector_pool):
+        if pool is None:
+            continue
+        try:
+            await asyncio.wait_for(pool.close(), timeout=POOL_CLOSE_TIMEOUT)
+        except Exception as e:
+            print(f"An error occurred while closing a database pool: {e}")
+            pool.terminate()
+    _core_pool = None
+    _vector_pool = None
+
+def get_db_pool() -> asyncpg.Pool:
+    if _core_pool is None:
+        raise RuntimeError("Core database pool is not initialised")
+    return _core_pool
+
+def get_vector_db_pool() -> asyncpg.Pool:
+    if _vector_pool is None:
+        raise RuntimeError("Vector database pool is not initialised")
+    return _vector_pool
+
+@asynccontextmanager
+async def db_connection():
+    """Borrow a core database connection from the pool for the duration of the block."""
+    async with get_db_pool().acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        yield conn
+
+@asynccontextmanager
+async def vector_db_connection():
+    """Borrow a vector database connection from the pool for the duration of the block."""
+    async with get_vector_db_pool().acquire(timeout=POOL_ACQUIRE_TIMEOUT) as conn:
+        yield conn
+
+def _pool_stats(pool: Optional[asyncpg.Pool]) -> dict:
+    if pool is None:
+        return {"status": "down"}
+    return {
+        "size": pool.get_size(),
+        "idle": pool.get_idle_size(),
+        "min_size": pool.get_min_size(),
+        "max_size": pool.get_max_size(),
+    }
 
-async def  get_db_connection():
-    return await asyncpg.connect(**CORE_DB_PARAMS)
\ No newline at end of file
+async def check_db_pools() -> dict:
+    """Round-trip a trivial query on each pool and report pool occupancy."""
+    report = {}
+    for name, pool, acquire in (
+        ("core", _core_pool, db_connection),
+        ("vector", _vector_pool, vector_db_connection),
+    ):
+        stats = _pool_stats(pool)
+        if pool is not None:
+            try:
+                async with acquire() as conn:
+                    await conn.fetchval("SELECT 1")
+                stats["status"] = "ok"
+            except Exception as e:
+                stats["status"] = "error"
+                stats["error"] = str(e)
+        report[name] = stats
+    return report
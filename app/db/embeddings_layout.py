@@ -0,0 +1,367 @@
+"""
+Managed layout for the embeddings table: LIST partitioned on project_id, one partition per project
+plus a DEFAULT partition for projects that have not been given their own yet. Every query in this
+app filters embeddings by project_id, so each query prunes to one partition, a big tenant's index
+never slows a small one, and a re-ingest only rewrites its own project's index pages.
+
+Indexes are declared on the parent and built per partition:
+    (project_id, file_path, created_at DESC)   file listings and latest-version lookups
+    HNSW on embedding_half                     ANN retrieval, see app.db.vector_index
+    GIN on search_tsv                          lexical retrieval, see app.db.lexical_index
+
+    python -m app.db.embeddings_layout migrate
+    python -m app.db.embeddings_layout build-indexes
+    python -m app.db.embeddings_layout create-partition --project-id P
+    python -m app.db.embeddings_layout reindex --project-id P
+    python -m app.db.embeddings_layout vacuum --project-id P
+    python -m app.db.embeddings_layout list
+
+The derived columns behind those indexes (embedding_half, search_tsv) are filled and indexed with
+the helpers below: setup_derived_column, backfill_derived_column and create_embeddings_index.
+"""
+import argparse
+import asyncio
+import hashlib
+
+from asyncpg import Connection
+
+from app.db.connections import init_db_pools, close_db_pools, vector_db_connection
+
+DEFAULT_PARTITION = "embeddings_default"
+INDEX_BUILD_TIMEOUT_SECONDS = 24 * 3600
+
+# parent index name: (definition, column it needs or None), built on every partition and
+# attached to the parent; indexes on optional columns are skipped until their setup step has run
+PARTITION_INDEXES = {
+    "embeddings_project_file_created_idx": ("(project_id, file_path, created_at DESC)", None),
+    "embeddings_embedding_half_hnsw": ("USING hnsw (embedding_half halfvec_cosine_ops)", "embedding_half"),
+    "embeddings_search_tsv_gin": ("USING gin (search_tsv)", "search_tsv"),
+}
+
+def partition_name(project_id: str) -> str:
+    # Project ids are not valid identifiers, a stable hash is
+    return f"embeddings_p_{hashlib.md5(project_id.encode('utf-8')).hexdigest()[:16]}"
+
+async def is_partitioned(conn: Connection) -> bool:
+    return await conn.fetchval("SELECT relkind = 'p' FROM pg_class WHERE oid = 'embeddings'::regclass")
+
+async def _literal(conn: Connection, value: str) -> str:
+    # DDL cannot take bind parameters, let Postgres quote the value
+    return await conn.fetchval("SELECT format('%L', $1::text)", value)
+
+async def _has_column(conn: Connection, table_name: str, column: str) -> bool:
+    return await conn.fetchval(
+        """
+        SELECT EXISTS (
+            SELECT 1 FROM pg_attribute
+            WHERE attrelid = $1::regclass AND attname = $2 AND NOT attisdropped
+        )
+        """,
+        table_name, column,
+    )
+
+async def _partitions(conn: Connection) -> list[str]:
+    rows = await conn.fetch("SELECT inhrelid::regclass::text AS name FROM pg_inherits WHERE inhparent = 'embeddings'::regclass")
+    return [row["name"] for row in rows]
+
+async def _build_partition_index(conn: Connection, table_name: str, parent_index: str):
+    definition, column = PARTITION_INDEXES[parent_index]
+    if column and not await _has_column(conn, table_name, column):
+        return
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS {parent_index} ON ONLY embeddings {definition}")
+    index_name = f"{table_name}_{parent_index.removeprefix('embeddings_')}"
+    await conn.execute(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON {table_name} {definition}",
+        timeout=INDEX_BUILD_TIMEOUT_SECONDS,
+    )
+    await conn.execute(f"ALTER INDEX {parent_index} ATTACH PARTITION {index_name}")
+
+async def build_partition_indexes(conn: Connection, table_name: str):
+    """Build every parent index on one partition without blocking its writers, then attach it."""
+    for parent_index in PARTITION_INDEXES:
+        await _build_partition_index(conn, table_name, parent_index)
+
+async def create_embeddings_index(conn: Connection, parent_index: str, maintenance_work_mem: str | None = None):
+    """
+    Build one of PARTITION_INDEXES without blocking writers: directly on a plain embeddings table,
+    partition by partition on a partitioned one (CONCURRENTLY does not work on the parent).
+    """
+    definition, _ = PARTITION_INDEXES[parent_index]
+    # CONCURRENTLY cannot run inside a transaction block, the pooled connection is in autocommit
+    if maintenance_work_mem:
+        await conn.execute(f"SET maintenance_work_mem = '{maintenance_work_mem}'")
+    try:
+        if await is_partitioned(conn):
+            for table_name in await _partitions(conn):
+                await _build_partition_index(conn, table_name, parent_index)
+        else:
+            await conn.execute(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {parent_index} ON embeddings {definition}",
+                timeout=INDEX_BUILD_TIMEOUT_SECONDS,
+            )
+    finally:
+        if maintenance_work_mem:
+            await conn.execute("RESET maintenance_work_mem")
+    print(f"{parent_index} created")
+
+def derived_column_statements(column: str, column_type: str, expression: str, source_columns: list[str]) -> list[str]:
+    """
+    DDL for a column of embeddings computed from other columns by a BEFORE trigger. expression is
+    a template whose {row} is replaced with the row prefix, "NEW." in the trigger.
+    """
+    return [
+        f"ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS {column} {column_type}",
+        f"""
+        CREATE OR REPLACE FUNCTION embeddings_fill_{column}() RETURNS trigger AS $$
+        BEGIN
+            NEW.{column} := {expression.format(row="NEW.")};
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        f"""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_trigger
+                WHERE tgname = 'embeddings_fill_{column}' AND tgrelid = 'embeddings'::regclass
+            ) THEN
+                CREATE TRIGGER embeddings_fill_{column}
+                BEFORE INSERT OR UPDATE OF {', '.join(source_columns)} ON embeddings
+                FOR EACH ROW EXECUTE FUNCTION embeddings_fill_{column}();
+            END IF;
+        END $$
+        """,
+    ]
+
+async def setup_derived_column(conn: Connection, column: str, column_type: str, expression: str, source_columns: list[str]):
+    for statement in derived_column_statements(column, column_type, expression, source_columns):
+        await conn.execute(statement)
+    print(f"{column} column and trigger are in place")
+
+async def backfill_derived_column(conn: Connection, column: str, expression: str, project_id: str | None,
+                                  batch_size: int, condition: str = "TRUE"):
+    """Fill a derived column on rows written before its trigger existed; condition skips rows without input."""
+    total = 0
+    while True:
+        # Small batches keep row locks short on a table ingestion keeps writing to
+        result = await conn.execute(
+            f"""
+            UPDATE embeddings SET {column} = {expression.format(row="")}
+            WHERE id IN (
+                SELECT id FROM embeddings
+                WHERE {column} IS NULL AND {condition}
+                  AND ($1::text IS NULL OR project_id = $1)
+                LIMIT $2
+            )
+            """,
+            project_id, batch_size,
+        )
+        updated = int(result.split()[-1])
+        total += updated
+        if updated == 0:
+            break
+        print(f"backfilled {total} rows")
+    print(f"backfill done, {total} rows")
+
+async def create_partition(conn: Connection, project_id: str) -> str:
+    """
+    Give a project its own partition, moving any rows it already has out of the DEFAULT partition.
+    Safe to call repeatedly, e.g. from ingestion before the first insert of a project.
+    """
+    table_name = partition_name(project_id)
+    exists = await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", table_name)
+    if not exists:
+        literal = await _literal(conn, project_id)
+        async with conn.transaction():
+            await conn.execute(f"CREATE TABLE {table_name} (LIKE embeddings INCLUDING DEFAULTS)")
+            moved = await conn.execute(
+                f"""
+                WITH moved AS (
+                    DELETE FROM {DEFAULT_PARTITION} WHERE project_id = $1 RETURNING *
+                )
+                INSERT INTO {table_name} SELECT * FROM moved
+                """,
+                project_id,
+            )
+            # Attaching builds the parent's indexes on the new partition
+            await conn.execute(f"ALTER TABLE embeddings ATTACH PARTITION {table_name} FOR VALUES IN ({literal})")
+        print(f"{table_name}: partition for {project_id} created, {moved.split()[-1]} rows moved")
+    return table_name
+
+async def reindex_project(conn: Connection, project_id: str):
+    table_name = partition_name(project_id)
+    await conn.execute(f"REINDEX TABLE CONCURRENTLY {table_name}", timeout=INDEX_BUILD_TIMEOUT_SECONDS)
+    print(f"{table_name}: reindexed")
+
+async def vacuum_project(conn: Connection, project_id: str):
+    table_name = partition_name(project_id)
+    await conn.execute(f"VACUUM (ANALYZE) {table_name}", timeout=INDEX_BUILD_TIMEOUT_SECONDS)
+    print(f"{table_name}: vacuumed and analyzed")
+
+async def list_partitions(conn: Connection):
+    rows = await conn.fetch(
+        """
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound,
+               pg_total_relation_size(c.oid) AS bytes
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'embeddings'::regclass
+        ORDER BY bytes DESC
+        """
+    )
+    for row in rows:
+        print(f"{row['relname']:<32} {row['bytes'] / 1024 / 1024:10.1f} MB  {row['bound']}")
+
+async def _has_id_index(conn: Connection, table_name: str) -> bool:
+    return await conn.fetchval(
+        """
+        SELECT EXISTS (
+            SELECT 1 FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = $1::regclass AND a.attname = 'id'
+        )
+        """,
+        table_name,
+    )
+
+async def migrate(conn: Connection):
+    """
+    Convert a plain embeddings table into the partitioned layout.
+    Rows are copied per project while the old table keeps serving. Every write made to it from
+    the start of the copy has its id recorded in embeddings_migration_log by a trigger, so the
+    final catch-up, the only step that blocks writers (readers are not blocked), re-copies just
+    those ids instead of comparing the two tables.
+    """
+    if await is_partitioned(conn):
+        print("embeddings is already partitioned")
+        return
+
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS embeddings_partitioned (
+            LIKE embeddings INCLUDING DEFAULTS,
+            PRIMARY KEY (id, project_id)
+        )
+        PARTITION BY LIST (project_id)
+        """
+    )
+    await conn.execute(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF embeddings_partitioned DEFAULT")
+    # Start over after an interrupted run, its rows may have changed since without being logged
+    await conn.execute("TRUNCATE embeddings_partitioned")
+    if not await _has_id_index(conn, "embeddings"):
+        # The catch-up looks logged ids up in the old table
+        await conn.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS embeddings_migration_id_idx ON embeddings (id)",
+                           timeout=INDEX_BUILD_TIMEOUT_SECONDS)
+
+    await conn.execute("CREATE UNLOGGED TABLE IF NOT EXISTS embeddings_migration_log AS SELECT id FROM embeddings WITH NO DATA")
+    await conn.execute(
+        """
+        CREATE OR REPLACE FUNCTION log_embeddings_migration() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                INSERT INTO embeddings_migration_log VALUES (OLD.id);
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                INSERT INTO embeddings_migration_log VALUES (NEW.id);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    # Creating the trigger waits for in-flight writers, so whatever the copy's snapshot misses is logged
+    await conn.execute("DROP TRIGGER IF EXISTS embeddings_migration_log ON embeddings")
+    await conn.execute("TRUNCATE embeddings_migration_log")
+    await conn.execute(
+        """
+        CREATE TRIGGER embeddings_migration_log
+        AFTER INSERT OR UPDATE OR DELETE ON embeddings
+        FOR EACH ROW EXECUTE FUNCTION log_embeddings_migration()
+        """
+    )
+
+    project_ids = [row["project_id"] for row in await conn.fetch("SELECT DISTINCT project_id FROM embeddings")]
+    for project_id in project_ids:
+        table_name = partition_name(project_id)
+        literal = await _literal(conn, project_id)
+        await conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table_name} PARTITION OF embeddings_partitioned FOR VALUES IN ({literal})"
+        )
+        # One statement per project; the old table only takes an ACCESS SHARE lock meanwhile
+        copied = await conn.execute(
+            "INSERT INTO embeddings_partitioned SELECT * FROM embeddings WHERE project_id = $1",
+            project_id, timeout=INDEX_BUILD_TIMEOUT_SECONDS,
+        )
+        print(f"{table_name}: copied {copied.split()[-1]} rows of {project_id}")
+
+    async with conn.transaction():
+        await conn.execute("LOCK TABLE embeddings IN EXCLUSIVE MODE")
+        # Rows inserted, updated or deleted by ingestion while the bulk copy ran
+        await conn.execute(
+            """
+            DELETE FROM embeddings_partitioned p
+            USING (SELECT DISTINCT id FROM embeddings_migration_log) l
+            WHERE p.id = l.id
+            """,
+            timeout=INDEX_BUILD_TIMEOUT_SECONDS,
+        )
+        caught_up = await conn.execute(
+            """
+            INSERT INTO embeddings_partitioned
+            SELECT e.* FROM embeddings e
+            WHERE e.id IN (SELECT id FROM embeddings_migration_log)
+            """,
+            timeout=INDEX_BUILD_TIMEOUT_SECONDS,
+        )
+        id_sequence = await conn.fetchval("SELECT pg_get_serial_sequence('embeddings', 'id')")
+        await conn.execute("DROP TRIGGER embeddings_migration_log ON embeddings")
+        # Triggers stay with the old table, e.g. the derived column ones; copy them to the new one
+        trigger_definitions = await conn.fetch(
+            "SELECT pg_get_triggerdef(oid) AS definition FROM pg_trigger WHERE tgrelid = 'embeddings'::regclass AND NOT tgisinternal"
+        )
+        await conn.execute("ALTER TABLE embeddings RENAME TO embeddings_unpartitioned")
+        await conn.execute("ALTER TABLE embeddings_partitioned RENAME TO embeddings")
+        for row in trigger_definitions:
+            # Read before the rename, the definition's table name now resolves to the new table
+            await conn.execute(row["definition"])
+        if id_sequence:
+            # The copied id default still uses it; owned by the new column, the old table can be dropped
+            await conn.execute(f"ALTER SEQUENCE {id_sequence} OWNED BY embeddings.id")
+        await conn.execute("DROP TABLE embeddings_migration_log")
+    print(f"swapped tables, {caught_up.split()[-1]} rows caught up; old table kept as embeddings_unpartitioned")
+    await build_indexes(conn)
+
+async def build_indexes(conn: Connection):
+    for table_name in await _partitions(conn):
+        await build_partition_indexes(conn, table_name)
+        print(f"{table_name}: indexes built")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("step", choices=["migrate", "build-indexes", "create-partition", "reindex", "vacuum", "list"])
+    parser.add_argument("--project-id")
+    args = parser.parse_args()
+    if args.step in ("create-partition", "reindex", "vacuum") and not args.project_id:
+        parser.error(f"{args.step} needs --project-id")
+
+    await init_db_pools()
+    try:
+        async with vector_db_connection() as conn:
+            if args.step == "migrate":
+                await migrate(conn)
+            elif args.step == "build-indexes":
+                await build_indexes(conn)
+            elif args.step == "create-partition":
+                await create_partition(conn, args.project_id)
+            elif args.step == "reindex":
+                await reindex_project(conn, args.project_id)
+            elif args.step == "vacuum":
+                await vacuum_project(conn, args.project_id)
+            else:
+                await list_partitions(conn)
+    finally:
+        await close_db_pools()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
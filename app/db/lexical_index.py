@@ -0,0 +1,104 @@
+"""
+Lexical index for the embeddings table, used next to the vector search for questions that name
+identifiers (`AsyncRateLimiter`, `store_summary_in_db`) that cosine search tends to miss.
+
+search_tsv is a 'simple' (no stemming, no stop words) tsvector of file_path and document, kept
+up to date by a trigger and indexed with GIN. Retrieval fuses its ranking with the vector
+ranking, see app.core.embeddings.query_embeddings.
+
+    python -m app.db.lexical_index setup          # column + trigger, cheap
+    python -m app.db.lexical_index backfill [--project-id P] [--batch-size 500]
+    python -m app.db.lexical_index create-index   # CREATE INDEX CONCURRENTLY, after the backfill
+
+Set HYBRID_RETRIEVAL_ENABLED=true once the index exists.
+"""
+import argparse
+import asyncio
+import os
+import re
+
+from asyncpg import Connection
+
+from app.db.connections import init_db_pools, close_db_pools, vector_db_connection
+from app.db.embeddings_layout import backfill_derived_column, create_embeddings_index, setup_derived_column
+
+HYBRID_RETRIEVAL_ENABLED = os.getenv("HYBRID_RETRIEVAL_ENABLED", "false").lower() == "true"
+
+SEARCH_TSV_EXPRESSION = "to_tsvector('simple', coalesce({row}file_path, '') || ' ' || coalesce({row}document, ''))"
+
+_BACKTICKED = re.compile(r"`([^`]+)`")
+_WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*")
+
+
+def _looks_like_identifier(word: str) -> bool:
+    return ("_" in word or "." in word or any(c.isdigit() for c in word)
+            or re.search(r"[a-z][A-Z]", word) is not None)
+
+def lexical_terms(text: str) -> str | None:
+    """
+    A to_tsquery('simple', ...) OR-query of the identifiers named in a search text, or None when
+    it names none and the lexical side should be skipped. Backticked words always count;
+    snake_case becomes a phrase, which is how the parser splits it in documents. A dotted name
+    is kept whole next to its parts: the parser indexes `app.db.chat` as one host token.
+    """
+    quoted = {word for span in _BACKTICKED.findall(text) for word in _WORD.findall(span)}
+    words = quoted | {word for word in _WORD.findall(text) if _looks_like_identifier(word)}
+    terms = set()
+    for word in words:
+        if "." in word:
+            terms.add(word.lower())
+        for part in word.split("."):
+            pieces = [piece.lower() for piece in part.split("_") if piece]
+            if not pieces or (len(pieces) == 1 and len(pieces[0]) < 3):
+                continue
+            terms.add(pieces[0] if len(pieces) == 1 else "(" + " <-> ".join(pieces) + ")")
+    return " | ".join(sorted(terms)) or None
+
+def lexical_search_sql(columns: str, project_param: str, vector_expr: str, terms_expr: str, limit_param: str) -> str:
+    """
+    Body of a LATERAL subquery: rows matching the terms, best ts_rank_cd first. Produces `columns`,
+    the full-precision `distance` to the query vector and `lexical_rank` (1-based).
+    """
+    return f"""
+        SELECT {columns}, distance, row_number() OVER (ORDER BY score DESC) AS lexical_rank
+        FROM (
+            SELECT {columns}, (embedding <=> {vector_expr}) AS distance,
+                   ts_rank_cd(search_tsv, tsq) AS score
+            FROM embeddings, to_tsquery('simple', {terms_expr}) tsq
+            WHERE project_id = {project_param} AND search_tsv @@ tsq
+            ORDER BY score DESC
+            LIMIT {limit_param}
+        ) matched
+    """
+
+async def setup(conn: Connection):
+    await setup_derived_column(conn, "search_tsv", "tsvector", SEARCH_TSV_EXPRESSION, ["document", "file_path"])
+
+async def backfill(conn: Connection, project_id: str | None, batch_size: int):
+    await backfill_derived_column(conn, "search_tsv", SEARCH_TSV_EXPRESSION, project_id, batch_size)
+
+async def create_index(conn: Connection):
+    await create_embeddings_index(conn, "embeddings_search_tsv_gin")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("step", choices=["setup", "backfill", "create-index"])
+    parser.add_argument("--project-id")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    await init_db_pools()
+    try:
+        async with vector_db_connection() as conn:
+            if args.step == "setup":
+                await setup(conn)
+            elif args.step == "backfill":
+                await backfill(conn, args.project_id, args.batch_size)
+            else:
+                await create_index(conn)
+    finally:
+        await close_db_pools()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,176 @@
+"""
+Online copy of the legacy per-user tables into the consolidated, partitioned tables.
+
+    summaries_{user_key}      -> project_summaries
+    conversations_{user_key}  -> conversation_messages
+    pins_{user_key}           -> project_pins
+
+The copy is idempotent (ON CONFLICT DO NOTHING) and runs in small batches, so it can be re-run
+while the app is serving traffic and again right before the legacy tables are dropped.
+Row ids of conversations and pins are preserved, pin ids are what the frontend deletes by.
+
+Run the `prepare` step before deploying code that writes the new tables: it lifts the id
+sequences above every legacy id so new rows can never collide with rows still to be copied.
+
+    python -m app.db.migrations.consolidate_user_tables prepare
+    python -m app.db.migrations.consolidate_user_tables copy [--batch-size 5000]
+    python -m app.db.migrations.consolidate_user_tables verify
+    python -m app.db.migrations.consolidate_user_tables drop-legacy
+"""
+import argparse
+import asyncio
+
+from asyncpg import Connection
+
+from app.db.connections import init_db_pools, close_db_pools, db_connection
+from app.db.schema import bootstrap_schema
+
+LEGACY_TABLES = {
+    # legacy prefix: consolidated table
+    "summaries": "project_summaries",
+    "conversations": "conversation_messages",
+    "pins": "project_pins",
+}
+
+
+async def list_legacy_tables(conn: Connection, prefix: str) -> dict[str, str]:
+    """Map legacy table name -> user_key for every {prefix}_{user_key} table in the public schema."""
+    rows = await conn.fetch(
+        """
+        SELECT tablename FROM pg_tables
+        WHERE schemaname = 'public' AND tablename LIKE $1
+        ORDER BY tablename
+        """,
+        f"{prefix}\\_%",
+    )
+    return {row["tablename"]: row["tablename"][len(prefix) + 1:] for row in rows}
+
+async def prepare(conn: Connection):
+    for prefix in ("conversations", "pins"):
+        target = LEGACY_TABLES[prefix]
+        max_id = 0
+        for table_name in await list_legacy_tables(conn, prefix):
+            max_id = max(max_id, await conn.fetchval(f'SELECT COALESCE(MAX(id), 0) FROM "{table_name}"'))
+        if max_id:
+            await conn.execute(
+                f"""
+                SELECT setval(pg_get_serial_sequence($1, 'id'),
+                              GREATEST($2::bigint, (SELECT COALESCE(MAX(id), 0) FROM {target})))
+                """,
+                target, max_id,
+            )
+        print(f"{target}: id sequence is above legacy max id {max_id}")
+
+async def copy_summaries(conn: Connection, table_name: str, key: str) -> int:
+    # Summaries are one logical row per project, keep the newest legacy row of each.
+    # Rows already written by the app are newer and are left alone.
+    result = await conn.execute(
+        f"""
+        INSERT INTO project_summaries (user_key, project_id, summary, status, executive_summary,
+                                       project_diagrams, created_at)
+        SELECT DISTINCT ON (project_id)
+            $1, project_id, summary, status, executive_summary, project_diagrams, created_at
+        FROM "{table_name}"
+        ORDER BY project_id, created_at DESC
+        ON CONFLICT (project_id, user_key) DO NOTHING
+        """,
+        key,
+    )
+    return int(result.split()[-1])
+
+async def copy_by_id(conn: Connection, table_name: str, key: str, target: str, columns: list[str], batch_size: int) -> int:
+    column_list = ", ".join(columns)
+    copied = 0
+    last_id = 0
+    while True:
+        # Keyset pagination keeps every batch a short transaction on a live table
+        batch = await conn.fetchrow(
+            f"""
+            WITH batch AS (
+                SELECT id, {column_list} FROM "{table_name}"
+                WHERE id > $2
+                ORDER BY id
+                LIMIT $3
+            ), inserted AS (
+                INSERT INTO {target} (user_key, id, {column_list})
+                SELECT $1, id, {column_list} FROM batch
+                ON CONFLICT (user_key, id) DO NOTHING
+                RETURNING 1
+            )
+            SELECT (SELECT MAX(id) FROM batch) AS max_id,
+                   (SELECT COUNT(*) FROM inserted) AS inserted
+            """,
+            key, last_id, batch_size,
+        )
+        if batch["max_id"] is None:
+            return copied
+        last_id = batch["max_id"]
+        copied += batch["inserted"]
+
+async def copy(conn: Connection, batch_size: int):
+    for table_name, key in (await list_legacy_tables(conn, "summaries")).items():
+        print(f"{table_name}: copied {await copy_summaries(conn, table_name, key)} rows")
+
+    for table_name, key in (await list_legacy_tables(conn, "conversations")).items():
+        copied = await copy_by_id(conn, table_name, key, "conversation_messages",
+                                  ["project_id", "role", "content", "created_at"], batch_size)
+        print(f"{table_name}: copied {copied} rows")
+
+    for table_name, key in (await list_legacy_tables(conn, "pins")).items():
+        copied = await copy_by_id(conn, table_name, key, "project_pins",
+                                  ["project_id", "topic_name", "pin_content", "created_at"], batch_size)
+        print(f"{table_name}: copied {copied} rows")
+
+async def verify(conn: Connection) -> bool:
+    """True when every legacy row has a counterpart in the consolidated tables."""
+    ok = True
+    for prefix, target in LEGACY_TABLES.items():
+        key_column = "project_id" if prefix == "summaries" else "id"
+        for table_name, key in (await list_legacy_tables(conn, prefix)).items():
+            missing = await conn.fetchval(
+                f"""
+                SELECT COUNT(*) FROM (SELECT DISTINCT {key_column} AS k FROM "{table_name}") legacy
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {target} t WHERE t.user_key = $1 AND t.{key_column} = legacy.k
+                )
+                """,
+                key,
+            )
+            if missing:
+                ok = False
+                print(f"{table_name}: {missing} rows not yet in {target}")
+    print("verify: ok" if ok else "verify: incomplete, run copy again")
+    return ok
+
+async def drop_legacy(conn: Connection):
+    if not await verify(conn):
+        return
+    for prefix in LEGACY_TABLES:
+        for table_name in await list_legacy_tables(conn, prefix):
+            await conn.execute(f'DROP TABLE "{table_name}"')
+            print(f"dropped {table_name}")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("step", choices=["prepare", "copy", "verify", "drop-legacy"])
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    await init_db_pools()
+    try:
+        await bootstrap_schema()
+        async with db_connection() as conn:
+            if args.step == "prepare":
+                await prepare(conn)
+            elif args.step == "copy":
+                await copy(conn, args.batch_size)
+            elif args.step == "verify":
+                await verify(conn)
+            else:
+                await drop_legacy(conn)
+    finally:
+        await close_db_pools()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
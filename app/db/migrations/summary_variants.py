@@ -0,0 +1,71 @@
+"""
+Backfill the budgeted summary variants (summary_chat, summary_prompt and the token counts) for
+project_summaries rows written before store_summary_in_db computed them, or whose summary was
+rewritten by another service since (the clear_summary_variants trigger nulls their variants).
+
+Collaborators of a project share one summary, so each distinct summary is tokenized once. Rows
+are updated in small keyset batches; each update fires project_updated like any summary write.
+
+    python -m app.db.migrations.summary_variants [--batch-size 200]
+"""
+import argparse
+import asyncio
+
+from asyncpg import Connection
+
+from app.db.connections import init_db_pools, close_db_pools, db_connection
+from app.db.schema import bootstrap_schema
+from app.db.summary_repository import SUMMARY_VARIANT_COLUMNS, summary_variants
+
+
+async def backfill(conn: Connection, batch_size: int):
+    assignments = ", ".join(f"{column} = ${i}" for i, column in enumerate(SUMMARY_VARIANT_COLUMNS, start=4))
+    update_query = f"""
+        UPDATE project_summaries SET {assignments}
+        WHERE project_id = $1 AND user_key = $2 AND summary IS NOT DISTINCT FROM $3
+    """
+    last_key = ("", "")
+    total = 0
+    while True:
+        rows = await conn.fetch(
+            """
+            SELECT project_id, user_key, summary FROM project_summaries
+            WHERE (project_id, user_key) > ($1, $2)
+              AND summary IS NOT NULL AND summary_chat IS NULL
+            ORDER BY project_id, user_key
+            LIMIT $3
+            """,
+            last_key[0], last_key[1], batch_size,
+        )
+        if not rows:
+            break
+        last_key = (rows[-1]["project_id"], rows[-1]["user_key"])
+
+        records = []
+        for row in rows:
+            # Repeated summaries hit the tokenization memo
+            variants = await summary_variants(row["summary"])
+            # The summary check skips rows rewritten by the app since they were read
+            records.append((row["project_id"], row["user_key"], row["summary"],
+                            *(variants[column] for column in SUMMARY_VARIANT_COLUMNS)))
+        await conn.executemany(update_query, records)
+        total += len(records)
+        print(f"backfilled {total} rows")
+    print(f"backfill done, {total} rows")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=200)
+    args = parser.parse_args()
+
+    await init_db_pools()
+    try:
+        await bootstrap_schema()
+        async with db_connection() as conn:
+            await backfill(conn, args.batch_size)
+    finally:
+        await close_db_pools()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,69 @@
+"""
+Cross-worker invalidation over Postgres LISTEN/NOTIFY.
+
+A trigger on project_summaries (see app.db.schema) sends the project id on PROJECT_UPDATED_CHANNEL
+whenever a summary row changes, whichever process made the change. Every worker keeps one pooled
+connection listening on the channel and fans notifications out to the registered callbacks.
+A callback receives a project id, or None when notifications may have been missed and
+everything must be treated as stale.
+"""
+import asyncio
+from typing import Callable, Optional
+
+from app.db.connections import db_connection
+
+PROJECT_UPDATED_CHANNEL = "project_updated"
+LISTENER_RETRY_SECONDS = 5
+
+_project_listeners: list[Callable[[Optional[str]], None]] = []
+_listener_task: Optional[asyncio.Task] = None
+
+
+def register_project_listener(callback: Callable[[Optional[str]], None]):
+    if callback not in _project_listeners:
+        _project_listeners.append(callback)
+
+def project_updated(project_id: Optional[str]):
+    """Run every registered callback in this process."""
+    for callback in _project_listeners:
+        try:
+            callback(project_id)
+        except Exception as e:
+            print(f"An error occurred in a project update listener: {e}")
+
+def _on_notification(_conn, _pid, _channel, payload: str):
+    project_updated(payload or None)
+
+async def _listen_forever():
+    connected_before = False
+    while True:
+        try:
+            async with db_connection() as conn:
+                closed = asyncio.Event()
+                conn.add_termination_listener(lambda _conn: closed.set())
+                await conn.add_listener(PROJECT_UPDATED_CHANNEL, _on_notification)
+                if connected_before:
+                    # Anything could have changed while the connection was down
+                    project_updated(None)
+                connected_before = True
+                await closed.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Project update listener failed, retrying: {e}")
+        await asyncio.sleep(LISTENER_RETRY_SECONDS)
+
+async def start_project_listener():
+    global _listener_task
+    if _listener_task is None:
+        _listener_task = asyncio.create_task(_listen_forever())
+
+async def stop_project_listener():
+    global _listener_task
+    if _listener_task is not None:
+        _listener_task.cancel()
+        try:
+            await _listener_task
+        except asyncio.CancelledError:
+            pass
+        _listener_task = None
@@ -0,0 +1,267 @@
+import os
+
+from app.db.connections import db_connection, vector_db_connection
+from app.db.notifications import PROJECT_UPDATED_CHANNEL
+
+# Arbitrary application-wide key so only one uvicorn worker runs the bootstrap DDL at a time
+SCHEMA_BOOTSTRAP_LOCK_ID = 724_311_001
+
+# Number of hash partitions for each consolidated per-user table. Changing it later means
+# re-partitioning, so pick it once per deployment.
+HASH_PARTITIONS = int(os.getenv("DB_HASH_PARTITIONS", 16))
+
+SHARED_TABLES = {
+    "checklist_table": """
+        CREATE TABLE IF NOT EXISTS checklist_table (
+            id SERIAL PRIMARY KEY,
+            project_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            content JSONB NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            updated_at TIMESTAMP DEFAULT NOW(),
+            UNIQUE (project_id, title)
+        )
+    """,
+    "assistants_table": """
+        CREATE TABLE IF NOT EXISTS assistants_table (
+            id SERIAL PRIMARY KEY,
+            project_id TEXT NOT NULL,
+            assistant_name TEXT NOT NULL,
+            thread_id TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (project_id, assistant_name)
+        )
+    """,
+    "context_summaries": """
+        CREATE TABLE IF NOT EXISTS context_summaries (
+            project_id VARCHAR PRIMARY KEY,
+            full_summaries TEXT
+        )
+    """,
+}
+
+# Tables this app owns in the vector database. The embeddings table itself belongs to ingestion.
+VECTOR_SHARED_TABLES = {
+    "query_embedding_cache": """
+        CREATE TABLE IF NOT EXISTS query_embedding_cache (
+            cache_key BYTEA PRIMARY KEY,
+            model TEXT NOT NULL,
+            dims INTEGER NOT NULL,
+            embedding BYTEA NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        -- Expiry and size pruning walk it oldest first, see app.core.embeddings.embedding_cache
+        CREATE INDEX IF NOT EXISTS query_embedding_cache_created_idx ON query_embedding_cache (created_at)
+    """,
+    # Render of each chunk for the chat prompt, see app.db.chunk_meta. chunk_id takes the type of
+    # embeddings.id, which the ingestion pipeline owns
+    "embedding_chunk_meta": """
+        DO $$
+        DECLARE
+            id_type TEXT;
+        BEGIN
+            SELECT format_type(atttypid, atttypmod) INTO id_type
+            FROM pg_attribute WHERE attrelid = to_regclass('embeddings') AND attname = 'id';
+            IF id_type IS NOT NULL THEN
+                EXECUTE format(
+                    'CREATE TABLE IF NOT EXISTS embedding_chunk_meta (
+                        chunk_id %s PRIMARY KEY,
+                        project_id TEXT NOT NULL,
+                        render_md5 TEXT NOT NULL,
+                        token_count INTEGER NOT NULL,
+                        language TEXT,
+                        title TEXT NOT NULL,
+                        display_text TEXT NOT NULL,
+                        updated_at TIMESTAMP DEFAULT NOW()
+                    )', id_type);
+                -- Renders stored under the old document-only hash no longer match and are redone
+                IF EXISTS (
+                    SELECT 1 FROM pg_attribute
+                    WHERE attrelid = 'embedding_chunk_meta'::regclass AND attname = 'document_md5' AND NOT attisdropped
+                ) THEN
+                    ALTER TABLE embedding_chunk_meta RENAME COLUMN document_md5 TO render_md5;
+                END IF;
+                CREATE INDEX IF NOT EXISTS embedding_chunk_meta_project_idx ON embedding_chunk_meta (project_id);
+            END IF;
+        END $$
+    """,
+}
+
+"""
+Consolidated replacements for the old summaries_{email}, conversations_{email} and pins_{email}
+tables. Rows are keyed by user_key, the same normalised email the old table names were built from,
+so rows copied from the legacy tables and rows written by the app share one key.
+"""
+PARTITIONED_TABLES = {
+    # Partitioned by project so the collaborator fan-out in store_summary_in_db touches one partition
+    "project_summaries": {
+        "columns": """
+            user_key TEXT NOT NULL,
+            project_id TEXT NOT NULL,
+            summary TEXT,
+            status TEXT,
+            executive_summary TEXT,
+            project_diagrams TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (project_id, user_key)
+        """,
+        "partition_key": "project_id",
+        "indexes": [],
+    },
+    "conversation_messages": {
+        "columns": """
+            id BIGSERIAL,
+            user_key TEXT NOT NULL,
+            project_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_key, id)
+        """,
+        "partition_key": "user_key",
+        "indexes": ["(user_key, project_id, created_at DESC)"],
+    },
+    # Rolling summary of each conversation up to last_message_id, see app.utils.chat_utils
+    "conversation_summaries": {
+        "columns": """
+            user_key TEXT NOT NULL,
+            project_id TEXT NOT NULL,
+            last_message_id BIGINT NOT NULL,
+            summary TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_key, project_id)
+        """,
+        "partition_key": "user_key",
+        "indexes": [],
+    },
+    "project_pins": {
+        "columns": """
+            id BIGSERIAL,
+            user_key TEXT NOT NULL,
+            project_id TEXT NOT NULL,
+            topic_name TEXT NOT NULL,
+            pin_content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_key, id)
+        """,
+        "partition_key": "user_key",
+        "indexes": ["(user_key, project_id)"],
+    },
+}
+
+# Summary changes are broadcast to every worker no matter which process wrote them
+TRIGGERS = [
+    f"""
+    CREATE OR REPLACE FUNCTION notify_project_updated() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{PROJECT_UPDATED_CHANNEL}', COALESCE(NEW.project_id, OLD.project_id));
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger
+            WHERE tgname = 'project_summaries_notify' AND tgrelid = 'project_summaries'::regclass
+        ) THEN
+            CREATE TRIGGER project_summaries_notify
+            AFTER INSERT OR UPDATE OR DELETE ON project_summaries
+            FOR EACH ROW EXECUTE FUNCTION notify_project_updated();
+        END IF;
+    END $$
+    """,
+    # Other services rewrite summary without the budgeted variants; clearing them makes readers
+    # recompute on read and the summary_variants backfill pick the row up again
+    """
+    CREATE OR REPLACE FUNCTION clear_summary_variants() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.summary_tokens IS NOT DISTINCT FROM OLD.summary_tokens
+           AND NEW.summary_chat IS NOT DISTINCT FROM OLD.summary_chat
+           AND NEW.summary_prompt IS NOT DISTINCT FROM OLD.summary_prompt THEN
+            NEW.summary_tokens := NULL;
+            NEW.summary_chat := NULL;
+            NEW.summary_chat_tokens := NULL;
+            NEW.summary_prompt := NULL;
+            NEW.summary_prompt_tokens := NULL;
+        END IF;
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger
+            WHERE tgname = 'project_summaries_clear_variants' AND tgrelid = 'project_summaries'::regclass
+        ) THEN
+            CREATE TRIGGER project_summaries_clear_variants
+            BEFORE UPDATE ON project_summaries
+            FOR EACH ROW WHEN (NEW.summary IS DISTINCT FROM OLD.summary)
+            EXECUTE FUNCTION clear_summary_variants();
+        END IF;
+    END $$
+    """,
+]
+
+
+def user_key(email: str) -> str:
+    # Lower-cased like the unquoted legacy table names were folded by Postgres
+    return email.replace('@', '_').replace('.', '_').lower()
+
+def partitioned_table_ddl(table_name: str) -> list[str]:
+    spec = PARTITIONED_TABLES[table_name]
+    statements = [
+        f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            {spec["columns"]}
+        ) PARTITION BY HASH ({spec["partition_key"]})
+        """
+    ]
+    for remainder in range(HASH_PARTITIONS):
+        statements.append(f"""
+            CREATE TABLE IF NOT EXISTS {table_name}_p{remainder:02d}
+            PARTITION OF {table_name}
+            FOR VALUES WITH (MODULUS {HASH_PARTITIONS}, REMAINDER {remainder})
+        """)
+    for i, columns in enumerate(spec["indexes"]):
+        # Created on the parent so every partition gets its own copy
+        statements.append(f"CREATE INDEX IF NOT EXISTS {table_name}_idx{i} ON {table_name} {columns}")
+    return statements
+
+# Columns added after the tables first shipped; CREATE TABLE IF NOT EXISTS does not add them
+COLUMN_ADDITIONS = [
+    # Budgeted copies of summary written with it, see app.db.summary_repository.SUMMARY_VARIANTS
+    "ALTER TABLE project_summaries ADD COLUMN IF NOT EXISTS summary_tokens INTEGER",
+    "ALTER TABLE project_summaries ADD COLUMN IF NOT EXISTS summary_chat TEXT",
+    "ALTER TABLE project_summaries ADD COLUMN IF NOT EXISTS summary_chat_tokens INTEGER",
+    "ALTER TABLE project_summaries ADD COLUMN IF NOT EXISTS summary_prompt TEXT",
+    "ALTER TABLE project_summaries ADD COLUMN IF NOT EXISTS summary_prompt_tokens INTEGER",
+]
+
+
+async def bootstrap_schema():
+    """Create the shared tables once at startup. Called from the FastAPI lifespan."""
+    async with db_connection() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_BOOTSTRAP_LOCK_ID)
+            for ddl in SHARED_TABLES.values():
+                await conn.execute(ddl)
+            for table_name in PARTITIONED_TABLES:
+                for ddl in partitioned_table_ddl(table_name):
+                    await conn.execute(ddl)
+            for ddl in COLUMN_ADDITIONS:
+                await conn.execute(ddl)
+            for ddl in TRIGGERS:
+                await conn.execute(ddl)
+
+async def bootstrap_vector_schema():
+    """Create the app-owned tables in the vector database once at startup."""
+    async with vector_db_connection() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_BOOTSTRAP_LOCK_ID)
+            for ddl in VECTOR_SHARED_TABLES.values():
+                await conn.execute(ddl)
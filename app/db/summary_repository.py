@@ -0,0 +1,114 @@
+"""
+Project summary repository. The summary, executive summary and diagrams of a (user, project) row
+are read together in one query and kept in a bounded in-process cache, so repeat chats and page
+loads on the same project do not touch Postgres. Entries are dropped by store_summary_in_db in the
+writing worker and by the project_updated notification in every other worker.
+
+The summary is also stored in budgeted variants (SUMMARY_VARIANTS), computed once when it is
+written, so the chat path reads the 10k-token copy instead of fetching and cutting the full text
+on every turn.
+"""
+import os
+from typing import Optional
+
+from app.constants import TOKEN_LIMIT
+from app.core.codebase.tokenization import count_tokens, truncate
+from app.db.connections import db_connection
+from app.db.notifications import register_project_listener
+from app.db.schema import user_key
+from app.utils.cache import BoundedCache
+
+SUMMARY_CACHE_MAX_BYTES = int(os.getenv("SUMMARY_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", 2000))
+
+SUMMARY_COLUMNS = ("summary", "executive_summary", "project_diagrams")
+
+CHAT_SUMMARY_TOKENS = 10000
+# column: (token budget, encoding). summary_chat goes into chat_pro's system prompt (gpt-4.1
+# family), summary_prompt is the TOKEN_LIMIT cut the websocket used to make with the gpt-4 encoding
+SUMMARY_VARIANTS = {
+    "summary_chat": (CHAT_SUMMARY_TOKENS, "o200k_base"),
+    "summary_prompt": (TOKEN_LIMIT, "cl100k_base"),
+}
+SUMMARY_VARIANT_COLUMNS = ("summary_tokens",) + tuple(
+    name for column in SUMMARY_VARIANTS for name in (column, f"{column}_tokens")
+)
+
+_summary_cache = BoundedCache("summary_cache", SUMMARY_CACHE_MAX_BYTES, SUMMARY_CACHE_MAX_ENTRIES)
+
+
+async def load_project_summary(email: str, project_id: str) -> Optional[dict]:
+    """Return {summary, executive_summary, project_diagrams} for the user's project, or None."""
+    key = (project_id, user_key(email))
+    cached = _summary_cache.get(key)
+    if cached is not None:
+        return cached
+
+    generation = _summary_cache.generation(project_id)
+    select_query = """
+        SELECT summary, executive_summary, project_diagrams
+        FROM project_summaries
+        WHERE project_id = $1 AND user_key = $2
+    """
+    async with db_connection() as conn:
+        row = await conn.fetchrow(select_query, project_id, key[1])
+    if row is None:
+        # Not cached: the row may be created by the ingestion pipeline at any moment
+        return None
+
+    record = {column: row[column] for column in SUMMARY_COLUMNS}
+    size = sum(len(value) for value in record.values() if value)
+    _summary_cache.set(key, record, size, project_id=project_id, generation=generation)
+    return record
+
+async def summary_variants(summary: Optional[str]) -> dict:
+    """Values of SUMMARY_VARIANT_COLUMNS for a summary, tokenized off the event loop."""
+    if summary is None:
+        return {column: None for column in SUMMARY_VARIANT_COLUMNS}
+    values = {"summary_tokens": await count_tokens(summary)}
+    for column, (budget, encoding) in SUMMARY_VARIANTS.items():
+        text, _ = await truncate(summary, budget, encoding)
+        values[column] = text
+        values[f"{column}_tokens"] = await count_tokens(text, encoding)
+    return values
+
+async def load_summary_variant(email: str, project_id: str, variant: str) -> Optional[str]:
+    """One budgeted variant of the user's project summary, or None if there is no summary."""
+    budget, encoding = SUMMARY_VARIANTS[variant]
+    key = (project_id, user_key(email), variant)
+    cached = _summary_cache.get(key)
+    if cached is not None:
+        return cached
+
+    generation = _summary_cache.generation(project_id)
+    async with db_connection() as conn:
+        row = await conn.fetchrow(
+            f"""
+            SELECT {variant} AS text, summary IS NOT NULL AND {variant} IS NULL AS missing
+            FROM project_summaries
+            WHERE project_id = $1 AND user_key = $2
+            """,
+            project_id, key[1],
+        )
+        if row is None:
+            return None
+        text = row["text"]
+        if row["missing"]:
+            # Written before the variants existed, or rewritten by a service that does not set them
+            # (the clear_summary_variants trigger nulls them then); not backfilled yet
+            summary = await conn.fetchval(
+                "SELECT summary FROM project_summaries WHERE project_id = $1 AND user_key = $2",
+                project_id, key[1],
+            )
+            text, _ = await truncate(summary, budget, encoding) if summary is not None else (None, None)
+    if text is None:
+        return None
+
+    _summary_cache.set(key, text, len(text), project_id=project_id, generation=generation)
+    return text
+
+def invalidate_project_summary(project_id: Optional[str]):
+    _summary_cache.invalidate_project(project_id)
+
+
+register_project_listener(invalidate_project_summary)
@@ -0,0 +1,56 @@
+"""
+Binary asyncpg codecs for the pgvector `vector` and `halfvec` types.
+
+Wire format (pgvector vector_send / halfvec_send): int16 dimensions, int16 unused, then one
+big-endian float4 (vector) or float2 (halfvec) per dimension. Encoding a NumPy float32 array is a
+byteswap and a copy instead of formatting 3072 floats as text for Postgres to parse again.
+"""
+import struct
+
+import numpy as np
+from asyncpg import Connection
+
+_HEADER = struct.Struct(">HH")
+
+
+def _encoder(dtype: str):
+    def encode(value) -> bytes:
+        array = np.asarray(value, dtype=dtype)
+        if array.ndim != 1:
+            raise ValueError(f"expected a 1-D vector, got shape {array.shape}")
+        return _HEADER.pack(array.shape[0], 0) + array.tobytes()
+    return encode
+
+def _decoder(dtype: str):
+    def decode(data: bytes) -> np.ndarray:
+        dims, _ = _HEADER.unpack_from(data)
+        return np.frombuffer(data, dtype=dtype, count=dims, offset=_HEADER.size).astype(np.float32)
+    return decode
+
+encode_vector = _encoder(">f4")
+decode_vector = _decoder(">f4")
+encode_halfvec = _encoder(">f2")
+decode_halfvec = _decoder(">f2")
+
+VECTOR_CODECS = {
+    "vector": (encode_vector, decode_vector),
+    "halfvec": (encode_halfvec, decode_halfvec),
+}
+
+
+async def register_vector_codecs(conn: Connection):
+    """Register the binary codecs for whichever pgvector types exist in this database."""
+    rows = await conn.fetch(
+        """
+        SELECT t.typname, n.nspname
+        FROM pg_type t JOIN pg_namespace n ON n.oid = t.typnamespace
+        WHERE t.typname = ANY($1::text[])
+        """,
+        list(VECTOR_CODECS),
+    )
+    for row in rows:
+        encoder, decoder = VECTOR_CODECS[row["typname"]]
+        await conn.set_type_codec(
+            row["typname"], schema=row["nspname"],
+            encoder=encoder, decoder=decoder, format="binary",
+        )
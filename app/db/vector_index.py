@@ -0,0 +1,140 @@
+"""
+Approximate nearest-neighbour index for the embeddings table.
+
+pgvector cannot HNSW-index a 3072-dimension `vector`, but it can index `halfvec` up to 4000
+dimensions. embedding_half keeps a half-precision copy of every embedding (filled by a trigger
+for new rows and by `backfill` for existing ones). Retrieval takes top_k * VECTOR_ANN_OVERSAMPLE
+candidates from the HNSW index and rescores them with the full-precision embedding.
+
+    python -m app.db.vector_index setup          # column + trigger, cheap
+    python -m app.db.vector_index backfill [--project-id P] [--batch-size 500]
+    python -m app.db.vector_index create-index   # CREATE INDEX CONCURRENTLY, after the backfill
+    python -m app.db.vector_index report --project-id P [--samples 50] [--top-k 4]
+
+Set VECTOR_ANN_ENABLED=true once the index exists.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from asyncpg import Connection
+
+from app.db.connections import init_db_pools, close_db_pools, vector_db_connection
+from app.db.embeddings_layout import backfill_derived_column, create_embeddings_index, setup_derived_column
+
+EMBEDDING_DIMENSIONS = 3072
+VECTOR_ANN_ENABLED = os.getenv("VECTOR_ANN_ENABLED", "false").lower() == "true"
+VECTOR_ANN_OVERSAMPLE = int(os.getenv("VECTOR_ANN_OVERSAMPLE", 4))
+
+EMBEDDING_HALF_EXPRESSION = f"{{row}}embedding::halfvec({EMBEDDING_DIMENSIONS})"
+
+
+def candidate_search_sql(columns: str, project_param: str, vector_expr: str, limit_param: str, candidate_limit_expr: str) -> str:
+    """
+    Body of a LATERAL subquery: ANN candidates from the halfvec index, rescored exactly.
+    Produces `columns` plus a full-precision `distance`.
+    """
+    return f"""
+        SELECT {columns}, (c.embedding <=> {vector_expr}) AS distance
+        FROM (
+            SELECT {columns}, embedding
+            FROM embeddings
+            WHERE project_id = {project_param}
+            ORDER BY embedding_half <=> ({vector_expr})::halfvec({EMBEDDING_DIMENSIONS})
+            LIMIT {candidate_limit_expr}
+        ) c
+        ORDER BY distance
+        LIMIT {limit_param}
+    """
+
+async def setup(conn: Connection):
+    await setup_derived_column(conn, "embedding_half", f"halfvec({EMBEDDING_DIMENSIONS})", EMBEDDING_HALF_EXPRESSION, ["embedding"])
+
+async def backfill(conn: Connection, project_id: str | None, batch_size: int):
+    await backfill_derived_column(conn, "embedding_half", EMBEDDING_HALF_EXPRESSION, project_id, batch_size,
+                                  condition="embedding IS NOT NULL")
+
+async def create_index(conn: Connection):
+    await create_embeddings_index(conn, "embeddings_embedding_half_hnsw", maintenance_work_mem="2GB")
+
+async def report(conn: Connection, project_id: str, samples: int, top_k: int):
+    """Recall@k and latency of ANN + rescoring against exact search, for several ef_search values."""
+    sample_rows = await conn.fetch(
+        """
+        SELECT embedding FROM embeddings
+        WHERE project_id = $1 AND embedding IS NOT NULL
+        ORDER BY random()
+        LIMIT $2
+        """,
+        project_id, samples,
+    )
+    queries = [row["embedding"] for row in sample_rows]
+    if not queries:
+        print("no embeddings for this project")
+        return
+
+    exact_sql = """
+        SELECT id FROM embeddings
+        WHERE project_id = $1
+        ORDER BY embedding <=> $2::vector
+        LIMIT $3
+    """
+    ann_sql = f"""
+        SELECT id FROM ({candidate_search_sql("id", "$1", "$2::vector", "$3", "$4")}) ranked
+    """
+
+    exact_ids, exact_latencies = [], []
+    for query in queries:
+        t0 = time.perf_counter()
+        exact_ids.append({row["id"] for row in await conn.fetch(exact_sql, project_id, query, top_k)})
+        exact_latencies.append(time.perf_counter() - t0)
+    print(f"project={project_id} samples={len(queries)} top_k={top_k}")
+    print(f"exact            p50 {statistics.median(exact_latencies) * 1000:8.2f} ms")
+
+    for ef_search in (40, 80, 160, 320):
+        for oversample in (1, VECTOR_ANN_OVERSAMPLE, 10):
+            recalls, latencies = [], []
+            async with conn.transaction():
+                await conn.execute("SELECT set_config('hnsw.ef_search', $1, true)", str(ef_search))
+                for query, expected in zip(queries, exact_ids):
+                    t0 = time.perf_counter()
+                    rows = await conn.fetch(ann_sql, project_id, query, top_k, top_k * oversample)
+                    latencies.append(time.perf_counter() - t0)
+                    recalls.append(len(expected & {row["id"] for row in rows}) / max(len(expected), 1))
+            print(
+                f"ef_search={ef_search:<4} oversample={oversample:<3} "
+                f"recall {statistics.mean(recalls):.3f}  "
+                f"p50 {statistics.median(latencies) * 1000:8.2f} ms  "
+                f"p95 {sorted(latencies)[int(len(latencies) * 0.95) - 1] * 1000:8.2f} ms"
+            )
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("step", choices=["setup", "backfill", "create-index", "report"])
+    parser.add_argument("--project-id")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--top-k", type=int, default=4)
+    args = parser.parse_args()
+    if args.step == "report" and not args.project_id:
+        parser.error("report needs --project-id")
+
+    await init_db_pools()
+    try:
+        async with vector_db_connection() as conn:
+            if args.step == "setup":
+                await setup(conn)
+            elif args.step == "backfill":
+                await backfill(conn, args.project_id, args.batch_size)
+            elif args.step == "create-index":
+                await create_index(conn)
+            else:
+                await report(conn, args.project_id, args.samples, args.top_k)
+    finally:
+        await close_db_pools()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,162 @@
+"""
+Bounded write-behind queue for rows the request path does not need to wait for: chat turns
+and checklist audit messages, which nothing reads back within the turn. User-facing CRUD such as
+pins is written synchronously. Rows are flushed in batches with executemany,
+so one flush is one round trip per table instead of one connection per row.
+"""
+import asyncio
+import os
+import time
+from collections import defaultdict
+from typing import Optional
+
+from app.db.connections import db_connection
+from app.utils import metrics
+
+BATCH_STATEMENTS = {
+    "conversation": """
+        INSERT INTO conversation_messages (user_key, project_id, role, content)
+        VALUES ($1, $2, $3, $4)
+    """,
+}
+
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", 10000))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 500))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_SECONDS", 0.2))
+# A failed batch is retried with exponential backoff from WRITE_BEHIND_RETRY_SECONDS before it
+# is dropped; the queue fills up meanwhile and callers feel backpressure
+WRITE_BEHIND_WRITE_ATTEMPTS = int(os.getenv("WRITE_BEHIND_WRITE_ATTEMPTS", 4))
+WRITE_BEHIND_RETRY_SECONDS = float(os.getenv("WRITE_BEHIND_RETRY_SECONDS", 0.5))
+# Callers still wait for room after this long, it only gets the wait counted and logged
+WRITE_BEHIND_PUT_TIMEOUT = float(os.getenv("WRITE_BEHIND_PUT_TIMEOUT_SECONDS", 5))
+
+
+class WriteBehindQueue:
+    def __init__(self, max_rows: int, batch_size: int, flush_interval: float, put_timeout: float):
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_rows)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop accepting rows and flush everything still queued. Called on lifespan shutdown."""
+        if not self.running:
+            return
+        await self._queue.put(None)
+        await self._worker
+        self._worker = None
+
+    async def enqueue(self, kind: str, row: tuple):
+        await self.enqueue_many(kind, [row])
+
+    async def enqueue_many(self, kind: str, rows: list[tuple]):
+        """Queue rows that belong together, e.g. the two messages of a chat turn; they are written in order in one batch."""
+        if kind not in BATCH_STATEMENTS:
+            raise ValueError(f"Unknown write-behind row kind: {kind}")
+        if not self.running:
+            # No background writer (scripts, startup failures): write through
+            metrics.incr(f"write_behind.written_through.{kind}", len(rows))
+            await self._write(kind, rows)
+            return
+
+        if self._queue.full():
+            # Backpressure: the caller waits for the writer to catch up instead of growing memory
+            metrics.incr("write_behind.backpressure_waits")
+        while True:
+            try:
+                await asyncio.wait_for(self._queue.put((kind, rows)), timeout=self.put_timeout)
+                break
+            except asyncio.TimeoutError:
+                # Writing through here could land these rows before rows queued ahead of them
+                metrics.incr("write_behind.put_timeouts")
+                print(f"Write-behind queue still full after {self.put_timeout}s, waiting for the writer")
+        metrics.incr(f"write_behind.enqueued.{kind}", len(rows))
+        metrics.set_gauge("write_behind.queue_depth", self._queue.qsize())
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            batch = []
+            if item is None:
+                stopping = True
+            else:
+                batch.append(item)
+                # Give the batch a short window to fill up before flushing
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+
+            if stopping:
+                # Drain whatever was queued ahead of the stop marker
+                while not self._queue.empty():
+                    item = self._queue.get_nowait()
+                    if item is not None:
+                        batch.append(item)
+
+            if batch:
+                await self._flush(batch)
+            metrics.set_gauge("write_behind.queue_depth", self._queue.qsize())
+
+    async def _flush(self, batch: list[tuple[str, tuple]]):
+        rows_by_kind = defaultdict(list)
+        for kind, rows in batch:
+            rows_by_kind[kind].extend(rows)
+        for kind, rows in rows_by_kind.items():
+            for start in range(0, len(rows), self.batch_size):
+                await self._write(kind, rows[start:start + self.batch_size])
+
+    async def _write(self, kind: str, rows: list[tuple]):
+        t0 = time.monotonic()
+        try:
+            for attempt in range(1, WRITE_BEHIND_WRITE_ATTEMPTS + 1):
+                try:
+                    async with db_connection() as conn:
+                        # One transaction, so a failed attempt leaves nothing behind to duplicate
+                        async with conn.transaction():
+                            await conn.executemany(BATCH_STATEMENTS[kind], rows)
+                    metrics.incr(f"write_behind.flushed_rows.{kind}", len(rows))
+                    return
+                except Exception as e:
+                    if attempt == WRITE_BEHIND_WRITE_ATTEMPTS:
+                        metrics.incr(f"write_behind.dropped_rows.{kind}", len(rows))
+                        # Keys only, the contents can be large and private
+                        dropped = sorted({(row[0], row[1]) for row in rows})
+                        print(f"An error occurred while flushing {len(rows)} {kind} rows, dropped them "
+                              f"after {attempt} attempts: {e}; (user_key, project_id) affected: {dropped}")
+                        return
+                    metrics.incr(f"write_behind.retries.{kind}")
+                    print(f"An error occurred while flushing {len(rows)} {kind} rows, retrying: {e}")
+                    await asyncio.sleep(WRITE_BEHIND_RETRY_SECONDS * 2 ** (attempt - 1))
+        finally:
+            metrics.observe("write_behind.flush_seconds", time.monotonic() - t0)
+
+
+WRITE_BEHIND = WriteBehindQueue(
+    max_rows=WRITE_BEHIND_MAX_ROWS,
+    batch_size=WRITE_BEHIND_BATCH_SIZE,
+    flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+    put_timeout=WRITE_BEHIND_PUT_TIMEOUT,
+)
@@ -0,0 +1,35 @@
+"""
+Fire-and-forget work that must not be garbage collected mid-flight or lost silently. Tasks are kept
+referenced until they finish, failures are printed and counted, and the lifespan cancels whatever
+is still running on shutdown.
+"""
+import asyncio
+from typing import Coroutine
+
+from app.utils import metrics
+
+_tasks: set[asyncio.Task] = set()
+
+
+def _done(task: asyncio.Task):
+    _tasks.discard(task)
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None:
+        metrics.incr("background.failures")
+        print(f"An error occurred in background task {task.get_name()}: {error}")
+
+def spawn(coro: Coroutine, name: str) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    _tasks.add(task)
+    task.add_done_callback(_done)
+    metrics.incr("background.started")
+    return task
+
+async def shutdown():
+    """Cancel every tracked task and wait for them to unwind."""
+    tasks = list(_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
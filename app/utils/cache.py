@@ -0,0 +1,163 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from app.utils import metrics
+
+
+class BoundedCache:
+    """
+    In-process LRU bounded by an approximate byte size, with an optional TTL. Entries can be tagged
+    with a project id so everything belonging to a project can be dropped at once when the project
+    changes. Concurrent get_or_load calls for the same missing key share one load, which is
+    cancelled once every caller waiting on it has been cancelled.
+    """
+
+    def __init__(self, name: str, max_bytes: int, max_entries: Optional[int] = None, ttl_seconds: Optional[float] = None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int, Optional[str], Optional[float]]] = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self._waiters: dict[asyncio.Task, int] = {}
+        self._by_project: dict[str, set] = {}
+        # Bumped on invalidation so loads that started before it do not store stale values
+        self._epoch = 0
+        self._generations: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Presence check that neither counts as a hit or miss nor refreshes recency."""
+        entry = self._entries.get(key)
+        return entry is not None and (entry[3] is None or entry[3] > time.monotonic())
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[3] is not None and entry[3] <= time.monotonic():
+            self._remove(key)
+            metrics.incr(f"{self.name}.expirations")
+            entry = None
+        if entry is None:
+            self.misses += 1
+            metrics.incr(f"{self.name}.misses")
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        metrics.incr(f"{self.name}.hits")
+        return entry[0]
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], size_of: Callable[[Any], int],
+                          project_id: Optional[str] = None) -> Any:
+        """Return the cached value or run loader() once, however many callers are waiting on the key."""
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            metrics.incr(f"{self.name}.coalesced")
+        else:
+            generation = self.generation(project_id) if project_id is not None else None
+
+            async def load():
+                loaded = await loader()
+                if loaded is not None:
+                    self.set(key, loaded, size_of(loaded), project_id=project_id, generation=generation)
+                return loaded
+
+            task = asyncio.create_task(load())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._load_done(key, done))
+        # Shielded so one waiter going away does not cancel the load for the others; the last one
+        # going away does, nobody would read the value before it is loaded again
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task in self._waiters and self._waiters[task] == 1 and not task.done():
+                task.cancel()
+                metrics.incr(f"{self.name}.cancelled_loads")
+            raise
+        finally:
+            if task in self._waiters:
+                self._waiters[task] -= 1
+
+    def _load_done(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        self._waiters.pop(task, None)
+        if not task.cancelled():
+            # Mark the exception as retrieved, the waiters already received it
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "coalesced": self.coalesced,
+        }
+
+    def generation(self, project_id: str) -> tuple[int, int]:
+        return self._epoch, self._generations.get(project_id, 0)
+
+    def set(self, key: Hashable, value: Any, size: int, project_id: Optional[str] = None, generation: Optional[tuple[int, int]] = None):
+        if project_id is not None and generation is not None and generation != self.generation(project_id):
+            # The project was invalidated while this value was being loaded
+            return
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        self._entries[key] = (value, size, project_id, expires_at)
+        self.bytes += size
+        if project_id is not None:
+            self._by_project.setdefault(project_id, set()).add(key)
+        while self.bytes > self.max_bytes or (self.max_entries and len(self._entries) > self.max_entries):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+            metrics.incr(f"{self.name}.evictions")
+        metrics.set_gauge(f"{self.name}.bytes", self.bytes)
+        metrics.set_gauge(f"{self.name}.entries", len(self._entries))
+
+    def invalidate_project(self, project_id: Optional[str]):
+        """Drop every entry of a project, or the whole cache when project_id is None."""
+        if project_id is None:
+            self._entries.clear()
+            self._by_project.clear()
+            self._epoch += 1
+            self.bytes = 0
+        else:
+            self._generations[project_id] = self._generations.get(project_id, 0) + 1
+            for key in self._by_project.pop(project_id, set()):
+                self._remove(key)
+        metrics.incr(f"{self.name}.invalidations")
+        metrics.set_gauge(f"{self.name}.bytes", self.bytes)
+        metrics.set_gauge(f"{self.name}.entries", len(self._entries))
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, size, project_id, _ = entry
+        self.bytes -= size
+        if project_id is not None:
+            keys = self._by_project.get(project_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_project[project_id]
@@ -1,28 +1,67 @@
+import os
+import time
+
 from app.constants import OPEN_AI_CLIENT
-from app.db.chat import store_conversation_in_db
+from app.db.chat import (
+    get_messages_between,
+    get_rolling_summary_from_db,
+    queue_turn_in_db,
+    store_rolling_summary_in_db,
+)
+from app.utils import metrics
+
+# Most messages folded into the rolling summary per update; older unsummarized ones (conversations
+# from before the summary was kept) are skipped like they fell out of the history window before
+ROLLING_SUMMARY_BATCH = int(os.getenv("ROLLING_SUMMARY_BATCH", 20))
 
-# Summarize early messages
-async def summarize_early_exchanges(messages: list[dict], num_exchanges: int = 4) -> str:
-    if len(messages) <= num_exchanges:
-        return ""
+# (user, project) pairs with an update in flight in this worker
+_summary_updates: set[tuple[str, str]] = set()
 
-    early_messages = messages[:num_exchanges * 2]
-    summary_prompt = "\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in early_messages])
-    input_text = f"Summarize the following conversation concisely:\n\n{summary_prompt}"
+
+# Fold new messages into the running summary of the conversation
+async def summarize_exchanges(summary: str, messages: list[dict]) -> str:
+    conversation = "\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in messages])
+    input_text = f"Summary so far:\n{summary or '(none)'}\n\nNew messages:\n{conversation}"
 
     response = await OPEN_AI_CLIENT.chat.completions.create(
         model="gpt-4.1-nano",
         messages=[{"role": "system", "content": "You summarize conversations concisely."},
-                  {"role": "user", "content": f"Provide a brief summary. Here is the conversation: {input_text}"}],
+                  {"role": "user", "content": f"Update the summary with the new messages and return only the updated brief summary. {input_text}"}],
         max_tokens=500,
         temperature=0.1
     )
     return response.choices[0].message.content
 
+async def update_rolling_summary(email_id: str, project_id: str, up_to_id: int):
+    """
+    Bring the stored summary up to message up_to_id, the newest message that leaves the verbatim
+    window once the current turn is stored. Runs in the background after each turn.
+    """
+    key = (email_id, project_id)
+    if key in _summary_updates:
+        # The running update or the next turn's picks these messages up
+        return
+    _summary_updates.add(key)
+    try:
+        summary, last_message_id = await get_rolling_summary_from_db(email_id, project_id)
+        if last_message_id >= up_to_id:
+            return
+        messages = await get_messages_between(email_id, project_id, last_message_id, up_to_id, ROLLING_SUMMARY_BATCH)
+        if not messages:
+            return
+        t0 = time.monotonic()
+        summary = await summarize_exchanges(summary, messages)
+        await store_rolling_summary_in_db(email_id, project_id, summary, messages[-1]["id"])
+        metrics.observe("chat.rolling_summary.update_seconds", time.monotonic() - t0)
+        metrics.incr("chat.rolling_summary.folded_messages", len(messages))
+    finally:
+        _summary_updates.discard(key)
+
 async def store_chat_in_db(email_id, project_id, user_question, raw_response_full, checklist_title, checklistAssistant=False):
     if not checklistAssistant:
-        await store_conversation_in_db(email_id, project_id, "user", user_question)
-        await store_conversation_in_db(email_id, project_id, "assistant", raw_response_full)
+        await queue_turn_in_db(email_id, project_id, [("user", user_question), ("assistant", raw_response_full)])
     else:
-        await store_conversation_in_db(email_id, project_id, "user", f"User requested checklist creation")
-        await store_conversation_in_db(email_id, project_id, "assistant", f"Checklist created: {checklist_title}. The checklist will appear in the 'Task Checklist' section after some time. If not, please refresh the page to view it.")
\ No newline at end of file
+        await queue_turn_in_db(email_id, project_id, [
+            ("user", f"User requested checklist creation"),
+            ("assistant", f"Checklist created: {checklist_title}. The checklist will appear in the 'Task Checklist' section after some time. If not, please refresh the page to view it."),
+        ])
\ No newline at end of file
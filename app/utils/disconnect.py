@@ -0,0 +1,48 @@
+"""
+Stop a websocket's work as soon as the client goes away. Without a pending receive the server only
+learns about a closed tab on its next send, which for a chat turn can be after query generation,
+the tool loop and most of the answer have been paid for. A watcher task keeps a receive pending
+for the whole turn and cancels the work when the disconnect arrives.
+"""
+import asyncio
+import time
+from typing import Any, Coroutine
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from app.utils import metrics
+
+
+async def _wait_for_disconnect(websocket: WebSocket) -> int:
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return message.get("code", 1000)
+        # The client sends nothing else during a turn; anything it does is ignored like before
+        metrics.incr("websocket.ignored_messages")
+
+async def run_until_disconnect(websocket: WebSocket, coro: Coroutine, name: str) -> Any:
+    """
+    Await coro unless the client disconnects first. On a disconnect the task running coro is
+    cancelled (tasks it awaits are cancelled with it) and WebSocketDisconnect is raised.
+    """
+    work = asyncio.create_task(coro, name=name)
+    watcher = asyncio.create_task(_wait_for_disconnect(websocket), name=f"{name}.disconnect_watcher")
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        work.cancel()
+        watcher.cancel()
+        raise
+
+    if work.done():
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+        return work.result()
+
+    t0 = time.monotonic()
+    work.cancel()
+    await asyncio.gather(work, return_exceptions=True)
+    metrics.incr(f"{name}.cancelled_on_disconnect")
+    metrics.observe(f"{name}.cancel_seconds", time.monotonic() - t0)
+    raise WebSocketDisconnect(code=watcher.result())
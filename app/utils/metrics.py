@@ -0,0 +1,29 @@
+"""
+Minimal in-process metrics. Each uvicorn worker keeps its own numbers; /metrics reports the
+worker that served the request.
+"""
+from collections import defaultdict
+
+_counters: dict[str, int] = defaultdict(int)
+_gauges: dict[str, float] = {}
+_timings: dict[str, dict[str, float]] = {}
+
+
+def incr(name: str, value: int = 1):
+    _counters[name] += value
+
+def set_gauge(name: str, value: float):
+    _gauges[name] = value
+
+def observe(name: str, seconds: float):
+    timing = _timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0})
+    timing["count"] += 1
+    timing["total"] += seconds
+    timing["max"] = max(timing["max"], seconds)
+    timing["last"] = seconds
+
+def snapshot() -> dict:
+    timings = {}
+    for name, timing in _timings.items():
+        timings[name] = dict(timing, avg=timing["total"] / timing["count"] if timing["count"] else 0.0)
+    return {"counters": dict(_counters), "gauges": dict(_gauges), "timings": timings}
@@ -0,0 +1,90 @@
+"""
+Coalesces streamed text into fewer websocket frames. The OpenAI stream yields a delta every few
+tokens; sending each as its own frame costs a send call, a frame header and, with permessage-deflate,
+a compressor flush per delta. Text is buffered until STREAM_FLUSH_BYTES are pending or the oldest
+pending text is STREAM_FLUSH_MS old, whichever comes first, so the client still sees text arrive
+continuously.
+"""
+import asyncio
+import os
+from typing import Awaitable, Callable, Optional
+
+from app.utils import metrics
+
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", 1024))
+STREAM_FLUSH_MS = float(os.getenv("STREAM_FLUSH_MS", 25))
+
+
+class StreamCoalescer:
+    def __init__(self, send: Callable[[str], Awaitable], max_bytes: int = STREAM_FLUSH_BYTES,
+                 max_delay: float = STREAM_FLUSH_MS / 1000):
+        self._send = send
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self._parts: list[str] = []
+        self._pending_bytes = 0
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timed_flush: Optional[asyncio.Task] = None
+        self._error: Optional[BaseException] = None
+        self.frames = 0
+
+    async def __aenter__(self) -> "StreamCoalescer":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.close()
+        else:
+            # The socket is likely gone; drop what is buffered
+            self._cancel_timer()
+            self._parts.clear()
+
+    async def write(self, text: str):
+        if self._error is not None:
+            raise self._error
+        if not text:
+            return
+        self._parts.append(text)
+        self._pending_bytes += len(text.encode("utf-8"))
+        if self._pending_bytes >= self.max_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._on_timer)
+
+    async def flush(self):
+        self._cancel_timer()
+        async with self._lock:
+            if not self._parts:
+                return
+            text = "".join(self._parts)
+            self._parts.clear()
+            sent_bytes, self._pending_bytes = self._pending_bytes, 0
+            await self._send(text)
+            self.frames += 1
+            metrics.incr("stream.frames")
+            metrics.incr("stream.bytes", sent_bytes)
+
+    async def close(self):
+        """Send whatever is still buffered."""
+        if self._timed_flush is not None:
+            await asyncio.gather(self._timed_flush, return_exceptions=True)
+        if self._error is not None:
+            raise self._error
+        await self.flush()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _on_timer(self):
+        self._timer = None
+        self._timed_flush = asyncio.create_task(self._flush_in_background())
+
+    async def _flush_in_background(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            # Surfaced to the writer on its next write or on close
+            self._error = e
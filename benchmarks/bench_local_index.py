@@ -0,0 +1,59 @@
+"""
+Micro-benchmark: local snapshot search latency on synthetic embeddings.
+
+    python -m benchmarks.bench_local_index [--rows 10000 100000] [--queries 1 4] [--top-k 4]
+
+Builds a throwaway snapshot in a temporary directory and reports per-call wall time of
+Snapshot.search, plus recall@k against an exact full-dimension scan. Random vectors do not have
+the prefix structure of text-embedding-3 vectors, so recall here is a lower bound.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from app.core.embeddings.local_index import LOCAL_INDEX_COARSE_DIMS, Snapshot, _normalize
+
+
+def write_snapshot(path: str, full: np.ndarray):
+    np.save(os.path.join(path, "full.npy"), full)
+    np.save(os.path.join(path, "coarse.npy"), _normalize(full[:, :LOCAL_INDEX_COARSE_DIMS]))
+    offsets = np.zeros(len(full) + 1, dtype=np.int64)
+    with open(os.path.join(path, "rows.jsonl"), "wb") as rows_file:
+        for i in range(len(full)):
+            rows_file.write(json.dumps({"id": i}).encode("utf-8") + b"\n")
+            offsets[i + 1] = rows_file.tell()
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--queries", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--dims", type=int, default=3072)
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for rows in args.rows:
+        full = _normalize(rng.standard_normal((rows, args.dims), dtype=np.float32))
+        with tempfile.TemporaryDirectory() as path:
+            write_snapshot(path, full)
+            snapshot = Snapshot(path, {"version": "bench", "built_at": time.time()})
+            for count in args.queries:
+                queries = _normalize(rng.standard_normal((count, args.dims), dtype=np.float32))
+                exact = [set(np.argsort(-(full @ q))[:args.top_k]) for q in queries]
+                snapshot.search(queries, args.top_k)
+                t0 = time.perf_counter()
+                for _ in range(args.runs):
+                    hits = snapshot.search(queries, args.top_k)
+                per_call = (time.perf_counter() - t0) / args.runs
+                recall = np.mean([len(e & {i for i, _ in h}) / args.top_k for e, h in zip(exact, hits)])
+                print(f"rows={rows:<7} queries={count:<3} {per_call * 1000:8.3f} ms/call  recall@{args.top_k} {recall:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark: websocket frames and CPU per streamed answer, one frame per delta vs StreamCoalescer.
+
+    python -m benchmarks.bench_stream_coalescer [--streams 200] [--deltas 1500] [--deflate]
+
+Each stream replays an answer as OpenAI-sized deltas (a few characters, arriving every
+--interval-ms) into a fake socket that pays for what a real send costs per frame: UTF-8 encoding,
+a frame header and, with --deflate, a permessage-deflate compressor flush. All streams run
+concurrently on one event loop, like the chats of one worker.
+"""
+import argparse
+import asyncio
+import random
+import time
+import zlib
+
+from app.utils.stream_coalescer import StreamCoalescer
+
+
+class FakeSocket:
+    def __init__(self, deflate: bool):
+        self.frames = 0
+        self.wire_bytes = 0
+        self._compressor = zlib.compressobj(wbits=-15) if deflate else None
+
+    async def send_text(self, text: str):
+        payload = text.encode("utf-8")
+        if self._compressor is not None:
+            # permessage-deflate flushes the compressor at the end of every message
+            payload = self._compressor.compress(payload) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.frames += 1
+        self.wire_bytes += len(payload) + (2 if len(payload) < 126 else 4)
+        # Hand control back to the loop like a socket write does
+        await asyncio.sleep(0)
+
+def make_deltas(count: int, seed: int) -> list[str]:
+    rng = random.Random(seed)
+    words = ["the", "function", "returns", "a", "list", "of", "rows", "from", "`query_vectorDB`", "and",
+             "each", "chunk", "is", "packed", "into", "budget", "\n", "-", "**Purpose**:", "config"]
+    return ["".join(rng.choice(words) + " " for _ in range(rng.randint(1, 2))) for _ in range(count)]
+
+async def run_stream(deltas: list[str], coalesce: bool, deflate: bool, interval: float) -> FakeSocket:
+    socket = FakeSocket(deflate)
+    if coalesce:
+        async with StreamCoalescer(socket.send_text) as stream:
+            for delta in deltas:
+                await stream.write(delta)
+                await asyncio.sleep(interval)
+    else:
+        for delta in deltas:
+            await socket.send_text(delta)
+            await asyncio.sleep(interval)
+    return socket
+
+async def bench(label: str, args, coalesce: bool):
+    answers = [make_deltas(args.deltas, seed) for seed in range(args.streams)]
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    sockets = await asyncio.gather(*(run_stream(deltas, coalesce, args.deflate, args.interval_ms / 1000)
+                                     for deltas in answers))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    frames = sum(socket.frames for socket in sockets) / len(sockets)
+    wire = sum(socket.wire_bytes for socket in sockets) / len(sockets)
+    print(f"{label:<12} {frames:9.0f} frames/stream  {wire / 1024:8.1f} KiB/stream  "
+          f"{cpu / len(sockets) * 1000:8.2f} ms CPU/stream  {wall:6.2f} s wall")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--deltas", type=int, default=1500)
+    parser.add_argument("--interval-ms", type=float, default=2)
+    parser.add_argument("--deflate", action="store_true")
+    args = parser.parse_args()
+
+    asyncio.run(bench("per delta", args, coalesce=False))
+    asyncio.run(bench("coalesced", args, coalesce=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark: prefix-bounded truncation against encoding the whole text, on real summaries.
+
+    python -m benchmarks.bench_truncation --from-db 5 [--budgets 10000 20000 170000]
+    python -m benchmarks.bench_truncation --files big_summary.md ... [--encoding o200k_base]
+
+--from-db takes the N longest summaries from project_summaries. Every result is checked against
+decoding the first max_tokens tokens of a full encode, which is what the truncators used to
+return, and the memo is bypassed so each run does the real work.
+"""
+import argparse
+import asyncio
+import time
+
+from app.core.codebase.tokenization import PREFIX_SAFE_ENCODINGS, _prefix_cut, get_encoder
+
+
+def full_truncate(text: str, max_tokens: int, encoding: str) -> str:
+    encoder = get_encoder(encoding)
+    return encoder.decode(encoder.encode_ordinary(text)[:max_tokens])
+
+def prefix_truncate(text: str, max_tokens: int, encoding: str) -> str:
+    cut = _prefix_cut(text, max_tokens, get_encoder(encoding)) if encoding in PREFIX_SAFE_ENCODINGS else None
+    if cut is None:
+        return full_truncate(text, max_tokens, encoding)
+    _, offset, split = cut
+    return text[:offset] + ("\ufffd" if split else "")
+
+def bench(fn, runs: int) -> float:
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn()
+    return (time.perf_counter() - start) / runs
+
+async def load_summaries(limit: int) -> list[tuple[str, str]]:
+    from app.db.connections import init_db_pools, close_db_pools, db_connection
+
+    await init_db_pools()
+    try:
+        async with db_connection() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT DISTINCT ON (length(summary)) project_id, summary
+                FROM project_summaries
+                WHERE summary IS NOT NULL
+                ORDER BY length(summary) DESC
+                LIMIT $1
+                """,
+                limit,
+            )
+    finally:
+        await close_db_pools()
+    return [(row["project_id"], row["summary"]) for row in rows]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from-db", type=int, default=0)
+    parser.add_argument("--files", nargs="*", default=[])
+    parser.add_argument("--budgets", type=int, nargs="+", default=[10000, 20000, 170000])
+    parser.add_argument("--encoding", default="o200k_base")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    texts = []
+    for path in args.files:
+        with open(path, encoding="utf-8") as f:
+            texts.append((path, f.read()))
+    if args.from_db:
+        texts.extend(asyncio.run(load_summaries(args.from_db)))
+    if not texts:
+        parser.error("nothing to benchmark, pass --files or --from-db")
+
+    encoder = get_encoder(args.encoding)
+    for name, text in texts:
+        total = len(encoder.encode_ordinary(text))
+        print(f"{name}: {len(text)} chars, {total} tokens")
+        for budget in args.budgets:
+            expected = full_truncate(text, budget, args.encoding)
+            assert prefix_truncate(text, budget, args.encoding) == expected, f"mismatch at budget {budget}"
+            full = bench(lambda: full_truncate(text, budget, args.encoding), args.runs)
+            prefix = bench(lambda: prefix_truncate(text, budget, args.encoding), args.runs)
+            print(f"  budget {budget:>7}  full {full * 1000:8.2f} ms  prefix {prefix * 1000:8.2f} ms  "
+                  f"speedup {full / prefix:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
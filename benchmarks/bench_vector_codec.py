@@ -0,0 +1,54 @@
+"""
+Micro-benchmark: text pgvector literal vs the binary codec for one query vector.
+
+    python -m benchmarks.bench_vector_codec [--dims 3072] [--runs 2000]
+
+Measures client-side CPU per encode and the bytes sent for the parameter. The text path also
+costs server-side parsing (vector_in), which is not measured here.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.db.vector_codec import decode_vector, encode_vector
+
+
+def text_literal(embedding: list[float]) -> str:
+    # What query_vectorDB used to send
+    return "[" + ",".join(str(x) for x in embedding) + "]"
+
+def bench(label: str, fn, runs: int) -> float:
+    start = time.process_time()
+    for _ in range(runs):
+        fn()
+    per_call = (time.process_time() - start) / runs
+    print(f"{label:<32} {per_call * 1e6:10.1f} us/call")
+    return per_call
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dims", type=int, default=3072)
+    parser.add_argument("--runs", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    as_float32 = rng.standard_normal(args.dims).astype(np.float32)
+    # The OpenAI client returns a list of Python floats
+    as_list = as_float32.astype(np.float64).tolist()
+
+    text_payload = text_literal(as_list).encode("utf-8")
+    binary_payload = encode_vector(as_float32)
+    assert np.array_equal(decode_vector(binary_payload), as_float32)
+
+    print(f"dims={args.dims} runs={args.runs}")
+    text_cpu = bench("text literal (list[float])", lambda: text_literal(as_list), args.runs)
+    binary_cpu = bench("binary codec (float32 array)", lambda: encode_vector(as_float32), args.runs)
+    bench("binary codec (list[float])", lambda: encode_vector(as_list), args.runs)
+    print(f"{'text payload':<32} {len(text_payload):10d} bytes")
+    print(f"{'binary payload':<32} {len(binary_payload):10d} bytes")
+    print(f"cpu ratio {text_cpu / binary_cpu:.1f}x, payload ratio {len(text_payload) / len(binary_payload):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
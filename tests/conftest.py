@@ -0,0 +1,37 @@
+"""
+Keeps the suite offline: tiktoken downloads its vocabularies on first use, so every test runs
+against a small byte-level BPE built here instead of o200k_base/cl100k_base.
+"""
+import os
+
+import pytest
+import tiktoken
+
+# app.constants builds the API clients at import time
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+
+from app.core.codebase import tokenization
+
+# Splits like the cl100k/o200k patterns where tokenization relies on it: a newline followed by
+# anything but whitespace always ends a piece
+_PATTERN = r"""\S+|\s+(?!\S)|\s+"""
+_MERGES = [b"de", b"ef", b"re", b"tu", b"rn", b"se", b"lf", b"pr", b"oj", b"im", b"po", b"rt"]
+
+
+def _local_encoding() -> tiktoken.Encoding:
+    ranks = {bytes([i]): i for i in range(256)}
+    for merge in _MERGES:
+        ranks[merge] = len(ranks)
+    return tiktoken.Encoding(name="local_test", pat_str=_PATTERN, mergeable_ranks=ranks, special_tokens={})
+
+
+_ENCODING = _local_encoding()
+
+
+@pytest.fixture(autouse=True)
+def local_encoder(monkeypatch):
+    monkeypatch.setattr(tokenization, "get_encoder", lambda encoding=tokenization.DEFAULT_ENCODING: _ENCODING)
+    with tokenization._memo_lock:
+        tokenization._memo.clear()
+    yield _ENCODING
@@ -0,0 +1,79 @@
+"""
+BoundedCache.get_or_load: shared loads and their cancellation.
+
+    python -m pytest tests/test_cache.py
+"""
+import asyncio
+
+from app.utils.cache import BoundedCache
+
+
+class SlowLoader:
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.cancelled = False
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        self.started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return "value"
+
+
+def test_concurrent_callers_share_one_load():
+    async def scenario():
+        cache = BoundedCache("test", max_bytes=1024)
+        calls = 0
+
+        async def loader():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "value"
+
+        values = await asyncio.gather(*(cache.get_or_load("key", loader, size_of=len) for _ in range(3)))
+        assert values == ["value"] * 3
+        assert calls == 1
+        assert cache.get("key") == "value"
+
+    asyncio.run(scenario())
+
+
+def test_cancelling_the_only_waiter_cancels_the_load():
+    async def scenario():
+        cache = BoundedCache("test", max_bytes=1024)
+        loader = SlowLoader()
+        waiter = asyncio.create_task(cache.get_or_load("key", loader, size_of=len))
+        await loader.started.wait()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert loader.cancelled
+        assert not cache._inflight
+
+    asyncio.run(scenario())
+
+
+def test_load_survives_while_another_caller_waits():
+    async def scenario():
+        cache = BoundedCache("test", max_bytes=1024)
+        loader = SlowLoader()
+        first = asyncio.create_task(cache.get_or_load("key", loader, size_of=len))
+        second = asyncio.create_task(cache.get_or_load("key", loader, size_of=len))
+        await loader.started.wait()
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert not loader.cancelled
+        second.cancel()
+        await asyncio.gather(second, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert loader.cancelled
+        assert loader.calls == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,39 @@
+"""
+lexical_terms against what to_tsvector('simple', ...) stores for the same text.
+
+    python -m pytest tests/test_lexical_index.py
+"""
+import re
+
+from app.db.lexical_index import lexical_terms
+
+# SELECT to_tsvector('simple', 'from app.db.chat import get_messages_between')
+DOTTED_DOCUMENT = "from app.db.chat import get_messages_between"
+DOTTED_TSVECTOR = "'app.db.chat':2 'between':6 'from':1 'get':4 'import':3 'messages':5"
+
+
+def tsvector_lexemes(tsvector: str) -> dict[str, int]:
+    return {lexeme: int(position) for lexeme, position in re.findall(r"'([^']+)':(\d+)", tsvector)}
+
+def phrase_matches(phrase: str, lexemes: dict[str, int]) -> bool:
+    """Whether an `a <-> b` phrase (or a single lexeme) of to_tsquery matches at adjacent positions."""
+    pieces = phrase.strip("()").split(" <-> ")
+    if any(piece not in lexemes for piece in pieces):
+        return False
+    return all(lexemes[b] == lexemes[a] + 1 for a, b in zip(pieces, pieces[1:]))
+
+
+def test_dotted_name_matches_the_host_token():
+    lexemes = tsvector_lexemes(DOTTED_TSVECTOR)
+    terms = lexical_terms("where does app.db.chat store turns").split(" | ")
+    assert "app.db.chat" in terms
+    assert any(phrase_matches(term, lexemes) for term in terms)
+
+def test_every_identifier_of_a_document_is_found_by_its_terms():
+    lexemes = tsvector_lexemes(DOTTED_TSVECTOR)
+    terms = lexical_terms(DOTTED_DOCUMENT).split(" | ")
+    assert phrase_matches("(get <-> messages <-> between)", lexemes)
+    assert {"app.db.chat", "(get <-> messages <-> between)"} <= set(terms)
+
+def test_plain_prose_has_no_terms():
+    assert lexical_terms("how are turns stored") is None
@@ -0,0 +1,100 @@
+"""
+anthropic_truncator against a local stand-in for messages.count_tokens.
+
+    python -m pytest tests/test_truncator.py
+"""
+import math
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from app.core.codebase import truncator
+from app.core.codebase.tokenization import count_tokens_sync
+
+MODEL = "claude-test"
+
+
+class FakeCountClient:
+    """Counts like a model whose tokenizer yields `ratio` tokens per local o200k token."""
+
+    def __init__(self, ratio: float):
+        self.ratio = ratio
+        self.calls = 0
+        self.messages = self
+
+    def count(self, text: str) -> int:
+        return math.ceil(count_tokens_sync(text, truncator.ANTHROPIC_ESTIMATE_ENCODING) * self.ratio)
+
+    def count_tokens(self, model, messages):
+        self.calls += 1
+        return SimpleNamespace(input_tokens=self.count(messages[0]["content"]))
+
+
+def make_text(words: int, seed: int) -> str:
+    rng = random.Random(seed)
+    vocabulary = ["def", "return", "self", "query_vectorDB", "project_id", "tokens", "{", "}", "\n",
+                  "import", "asyncio", "the", "summary", "of", "codebase", "=", "(", ")", ":"]
+    return " ".join(rng.choice(vocabulary) for _ in range(words))
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    truncator._calibration.clear()
+    truncator._prefix_counts.clear()
+    yield
+    truncator._calibration.clear()
+    truncator._prefix_counts.clear()
+
+
+def test_text_under_the_limit_is_returned_whole():
+    client = FakeCountClient(1.3)
+    text = make_text(200, seed=0)
+    assert truncator.anthropic_truncator(text, max_tokens=10_000, model=MODEL, client=client) == text
+    assert client.calls <= 1
+
+
+@pytest.mark.parametrize("ratio", [0.9, 1.3, 1.7])
+def test_cut_fits_within_two_remote_calls(ratio):
+    max_tokens = 2_000
+    for seed in range(6):
+        client = FakeCountClient(ratio)
+        text = make_text(8_000, seed=seed)
+        truncated = truncator.anthropic_truncator(text, max_tokens=max_tokens, model=MODEL, client=client)
+        assert text.startswith(truncated)
+        assert client.count(truncated) <= max_tokens
+        assert client.calls <= truncator.ANTHROPIC_MAX_REMOTE_CALLS
+
+
+def test_calibration_learns_the_model_ratio():
+    for seed in range(8):
+        client = FakeCountClient(1.4)
+        truncator.anthropic_truncator(make_text(6_000, seed=seed), max_tokens=1_500, model=MODEL, client=client)
+    ratio, samples = truncator._calibration[MODEL]
+    assert samples >= truncator.ANTHROPIC_MIN_SAMPLES
+    assert ratio == pytest.approx(1.4, rel=0.03)
+
+
+def test_calibrated_model_skips_the_whole_text_count():
+    for seed in range(4):
+        truncator.anthropic_truncator(make_text(6_000, seed=seed), max_tokens=1_500, model=MODEL,
+                                      client=FakeCountClient(1.4))
+    client = FakeCountClient(1.4)
+    text = make_text(20_000, seed=99)
+    truncated = truncator.anthropic_truncator(text, max_tokens=1_500, model=MODEL, client=client)
+    # Far over the limit: no call for the whole text, the first cut is verified and fits
+    assert client.calls == 1
+    assert client.count(truncated) <= 1_500
+
+
+def test_failed_counts_still_return_a_shrunk_cut():
+    class FailingClient(FakeCountClient):
+        def count_tokens(self, model, messages):
+            self.calls += 1
+            raise RuntimeError("count_tokens unavailable")
+
+    client = FailingClient(1.0)
+    text = make_text(8_000, seed=1)
+    truncated = truncator.anthropic_truncator(text, max_tokens=2_000, model=MODEL, client=client)
+    assert client.calls <= truncator.ANTHROPIC_MAX_REMOTE_CALLS
+    assert client.count(truncated) <= 2_000